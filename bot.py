@@ -6,24 +6,37 @@ import time
 import re
 import json
 import io
-import requests
+import httpx
+import aiohttp
 import hmac
 import hashlib
 import base64
 import csv
 import unicodedata
 import inspect
+import functools
+import random
+import signal
+import sys
+import copy
+import sqlite3
+import heapq
+import bisect
+from array import array
+from collections import OrderedDict, deque
 from pathlib import Path
 from datetime import datetime
 from urllib.parse import urlencode
 from decimal import Decimal, InvalidOperation
-from typing import Tuple, Optional, Dict, Any, List
+from typing import Tuple, Optional, Dict, Any, List, Callable, Awaitable
 from io import BytesIO  # для работы с изображениями в памяти
 from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
 
 from bs4 import BeautifulSoup
-from flask import Flask, request, jsonify
+from aiohttp import web
 
+from telegram import __version_info__ as PTB_VERSION_INFO
 from telegram import (
     Update, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, ReplyKeyboardRemove,
@@ -31,20 +44,22 @@ from telegram import (
 )
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters, ConversationHandler,
+    ContextTypes, filters, ConversationHandler, BaseUpdateProcessor,
+    BasePersistence, PersistenceInput,
 )
-from telegram.ext import Application  # для аннотации в post_init
+from telegram.ext import Application  # для аннотации в post_init и BotApplication
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 from PIL import Image  # для проверки/конвертации картинок
 
 # Google Sheets
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
-# Cron и ретраи
+# Cron
 import aiocron
-from tenacity import retry, wait_fixed, stop_after_attempt
 
 # 🔐 Конфиг (токены/ключи)
 from config import (
@@ -56,12 +71,23 @@ from config import (
     API_SECRET,
 )
 
+# Метрики (/metrics) и трассировка апдейтов
+from metrics import Counter, Histogram, GaugeFunc, REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from tracing import Tracer, JsonlExporter, OtlpHttpExporter
+
+# Планировщик запросов к OpenAI (слоты, бюджет токенов, честная очередь)
+from openai_scheduler import OpenAIScheduler, PRIORITY_PAID, PRIORITY_FREE
+
+# Разбор торгового плана из ответа модели (вход / стоп / тейки / DCA)
+from trade_plan import TradePlan, extract_trade_plan, plan_from_json, SMC_RESPONSE_FORMAT, STRATEGY_RESPONSE_FORMAT
+
 # =====================[ CONSTANTS / GLOBALS ]=====================
 # Scopes для Google Sheets
 SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 
 # Инициализация OpenAI-клиента (используется в ask_gpt_vision / handle_strategy_* и т.п.)
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Встроенные ретраи SDK выключены: повторы и паузы делает openai_chat (AIMD + Retry-After)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
 # Глобальный bot для уведомлений из вебхуков (инициализируй в main())
 global_bot = None
@@ -82,12 +108,6 @@ POST_VIDEO_URL = os.getenv("POST_VIDEO_URL", "").strip()          # опцион
 CHANNEL_USERNAME = "@TBXtrade"
 VIP_CHANNEL_ID = -1002747865995  # приватный VIP-канал
 
-app_flask = Flask(__name__)  # создаём один раз глобально
-
-# анти-дубликаты (idempotency)
-PROCESSED_PAYMENTS: Dict[str, float] = {}  # хранит уникальные payment_id/tx_id/комбинации
-PROCESSED_TTL_SEC = 3600  # 1 час
-
 # 1) Состояние для шага "точка входа"
 SETUP_WAIT_ENTRY = 101  # любое уникальное число
 
@@ -114,6 +134,92 @@ except Exception as e:
     logging.exception("❌ Google Sheets init failed")
     raise
 
+# =====================[ METRICS ]=====================
+# Отдаются на GET /metrics (тот же HTTP-порт, что health-check). Серии с метками создаются
+# здесь один раз — в хендлерах только .inc()/.observe() у готовых объектов.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()  # если задан — ?token=... или Bearer
+
+VISION_SECONDS = Histogram("gpt_vision_request_seconds", "GPT-Vision call latency", ("outcome",))
+VISION_OK = VISION_SECONDS.labels("ok")
+VISION_ERROR = VISION_SECONDS.labels("error")
+IMAGE_DOWNLOAD_SECONDS = Histogram("telegram_image_download_seconds", "get_file + download of a chart image")
+IMAGE_PREPARE_SECONDS = Histogram("image_prepare_seconds", "Decode/resize/JPEG-encode of a chart image")
+_SHEETS_SECONDS = Histogram("sheets_call_seconds", "Google Sheets API call latency", ("op",))
+SHEETS_READ_SECONDS = _SHEETS_SECONDS.labels("read")
+SHEETS_APPEND_SECONDS = _SHEETS_SECONDS.labels("append")
+TELEGRAM_SECONDS = Histogram("telegram_api_seconds", "Bot API request latency", ("method",))
+# Методы, которые реально шлёт бот; остальное — в "other" (getUpdates идёт отдельным клиентом)
+TELEGRAM_METHODS = {
+    name: TELEGRAM_SECONDS.labels(name)
+    for name in (
+        "sendMessage", "editMessageText", "sendPhoto", "sendVideo", "sendAnimation", "sendDocument",
+        "answerCallbackQuery", "getFile", "deleteMessage", "setWebhook", "deleteWebhook", "other",
+    )
+}
+# Считается один раз на ответ модели — там, где он получен (ask_gpt_vision, стратегия)
+REFUSALS = Counter("gpt_refusals_total", "Model answers that are refusals (message.refusal or refusal text)")
+_RETRIES = Counter("retries_total", "Retried calls", ("kind",))
+OPENAI_RETRIES = _RETRIES.labels("openai")
+VISION_RETRIES = _RETRIES.labels("vision_refusal")
+# Не ретраи: Bot API ответил 429, повторять ли — решает вызывающий код
+TELEGRAM_FLOOD_WAITS = Counter("telegram_flood_waits_total", "Bot API responses with 429 Too Many Requests")
+_CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups by cache and result", ("cache", "result"))
+VISION_CACHE_RESULTS = {r: _CACHE_LOOKUPS.labels("vision", r) for r in ("hit", "near", "miss")}
+MEDIA_CACHE_HIT = _CACHE_LOOKUPS.labels("media_file_id", "hit")
+MEDIA_CACHE_MISS = _CACHE_LOOKUPS.labels("media_file_id", "miss")
+PRICE_CACHE_HIT = _CACHE_LOOKUPS.labels("price", "hit")
+PRICE_CACHE_MISS = _CACHE_LOOKUPS.labels("price", "miss")
+_IPN_EVENTS = Counter("ipn_events_total", "CryptoCloud IPN outcomes", ("outcome",))
+IPN_OUTCOMES = {
+    name: _IPN_EVENTS.labels(name)
+    for name in (
+        "paid", "duplicate", "ignored", "invalid_signature", "bad_payload", "bad_order_id",
+        "validation_failed", "storage_error",
+    )
+}
+
+
+# =====================[ TRACING ]=====================
+# Дерево спанов на апдейт: корень — unified_text_handler / button_handler, внутри — скачивание,
+# подготовка картинки, очередь и запрос к OpenAI, разбор ответа, каждый вызов Bot API.
+# Записываются все трейсы, наружу уходят выборка TRACE_SAMPLE_RATE и все медленные (> TRACE_SLOW_MS);
+# медленный апдейт ещё и пишется деревом в лог.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))  # 0..1
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "20000"))       # 0 — без лога медленных
+TRACE_FILE = os.getenv("TRACE_FILE", "").strip()                 # JSONL, по трейсу на строку
+TRACE_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "").strip()  # напр. http://otel-collector:4318
+TRACE_OTLP_HEADERS = os.getenv("OTEL_EXPORTER_OTLP_HEADERS", "").strip()    # "k1=v1,k2=v2"
+TRACE_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "gpt-trader-bot").strip()
+
+
+def _trace_exporters() -> list:
+    exporters = []
+    if TRACE_FILE:
+        exporters.append(JsonlExporter(TRACE_FILE))
+    if TRACE_OTLP_ENDPOINT:
+        headers = dict(
+            (k.strip(), v.strip()) for k, _, v in (part.partition("=") for part in TRACE_OTLP_HEADERS.split(",")) if v
+        )
+        exporters.append(OtlpHttpExporter(TRACE_OTLP_ENDPOINT, TRACE_SERVICE_NAME, headers=headers))
+    return exporters
+
+
+TRACER = Tracer(TRACE_SAMPLE_RATE, TRACE_SLOW_MS, _trace_exporters())
+
+
+def traced_update(name: str):
+    """Декоратор хендлера: корневой спан на апдейт (update_id, user_id)."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context):
+            user = getattr(update, "effective_user", None)
+            with TRACER.root(name, update_id=getattr(update, "update_id", None),
+                             user_id=user.id if user else None):
+                return await fn(update, context)
+        return wrapper
+    return decorator
+
+
 # =====================[ UTILS / HELPERS ]=====================
 # Детектор отказов модели (refusal)
 _REFUSAL_RE = re.compile(
@@ -146,195 +252,1823 @@ def _calc_rr(entry, stop, tp1):
     except Exception:
         return None
 
-# Конвертация BytesIO -> JPEG Base64 (оставь, если где-то нужен именно BytesIO)
-def _bytes_to_jpeg_b64(bio: BytesIO) -> str:
-    bio.seek(0)
-    im = Image.open(bio).convert("RGB")
-    out = BytesIO()
-    im.save(out, format="JPEG", quality=90, optimize=True)
-    out.seek(0)
-    return base64.b64encode(out.read()).decode("ascii")
+# =====================[ VISION CACHE ]=====================
+# Версии промптов: меняешь текст промпта — поднимай версию, иначе кеш вернёт старые ответы
+SMC_PROMPT_VERSION = "smc-v3"
+STRATEGY_PROMPT_VERSION = "strategy-v2"
+NEWS_PROMPT_VERSION = "news-v1"
+
+VISION_CACHE_TTL_SEC = int(os.getenv("VISION_CACHE_TTL_SEC", str(6 * 3600)))
+VISION_CACHE_MAX_ITEMS = int(os.getenv("VISION_CACHE_MAX_ITEMS", "512"))
+VISION_CACHE_DB = os.getenv("VISION_CACHE_DB", "").strip()  # путь к SQLite; пусто — только память
+# Почти-дубликаты (пережатый Telegram'ом / слегка обрезанный скрин): dHash + расстояние Хэмминга
+VISION_PHASH_MAX_DISTANCE = int(os.getenv("VISION_PHASH_MAX_DISTANCE", "10"))  # из 256 бит
+VISION_PHASH_TTL_SEC = int(os.getenv("VISION_PHASH_TTL_SEC", "1800"))  # похожие берём только «свежие»
+
+
+def _dhash(im: Image.Image, size: int = 16) -> int:
+    """
+    Difference-hash (256 бит): серое 17x16, сравнение соседних пикселей по строкам.
+    Для графиков на белом фоне 64 бит мало — разные скрины слишком легко «совпадают».
+    Устойчив к пережатию JPEG, смене формата и обрезке в пару пикселей.
+    """
+    small = im.convert("L").resize((size + 1, size), Image.BILINEAR)
+    px = small.tobytes()
+    h = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            h = (h << 1) | (px[base + col] > px[base + col + 1])
+    return h
+
+
+class PerceptualIndex:
+    """
+    Небольшой in-memory индекс: namespace -> {cache_key: (phash, ts)}.
+    Поиск — линейный скан по namespace (сотни записей, XOR + bit_count — микросекунды).
+    """
+
+    def __init__(self, max_items: int = 512, ttl_sec: int = 1800, max_distance: int = 10):
+        self.max_items = max(1, max_items)
+        self.ttl_sec = ttl_sec
+        self.max_distance = max_distance
+        self._by_ns: Dict[str, "OrderedDict[str, tuple[int, float]]"] = {}
+
+    def add(self, namespace: str, key: str, phash: int) -> None:
+        bucket = self._by_ns.setdefault(namespace, OrderedDict())
+        bucket[key] = (phash, time.time())
+        bucket.move_to_end(key)
+        while len(bucket) > self.max_items:
+            bucket.popitem(last=False)
+
+    def find(self, namespace: str, phash: int) -> str | None:
+        bucket = self._by_ns.get(namespace)
+        if not bucket:
+            return None
+        now = time.time()
+        best_key, best_dist = None, self.max_distance + 1
+        for key, (h, ts) in list(bucket.items()):
+            if now - ts > self.ttl_sec:
+                bucket.pop(key, None)
+                continue
+            dist = (h ^ phash).bit_count()
+            if dist < best_dist:
+                best_key, best_dist = key, dist
+                if dist == 0:
+                    break
+        return best_key
+
+
+class VisionCache:
+    """
+    Кеш ответов GPT-Vision.
+    Ключ = sha256(нормализованный JPEG, см. PreparedImage.digest) + рынок/режим + версия промпта.
+    В памяти — LRU с TTL; опционально дублируется в SQLite (переживает рестарт).
+    Если точного совпадения нет — ищем свежий почти-дубликат по dHash (PerceptualIndex).
+    """
+
+    def __init__(self, max_items: int = 512, ttl_sec: int = 6 * 3600, db_path: str | None = None):
+        self.max_items = max(1, max_items)
+        self.ttl_sec = ttl_sec
+        self._mem: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._phash = PerceptualIndex(
+            max_items=self.max_items,
+            ttl_sec=VISION_PHASH_TTL_SEC,
+            max_distance=VISION_PHASH_MAX_DISTANCE,
+        )
+        self._db = None
+        self._puts = 0
+        if db_path:
+            try:
+                Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS vision_cache ("
+                    "key TEXT PRIMARY KEY, created REAL NOT NULL, value TEXT NOT NULL)"
+                )
+                self._db.commit()
+            except Exception:
+                logging.exception("[VisionCache] SQLite init failed — работаем только в памяти")
+                self._db = None
+
+    @staticmethod
+    def make_key(kind: str, image_digest: str, *parts: str) -> str:
+        return ":".join([kind, *[str(p) for p in parts], image_digest])
+
+    @staticmethod
+    def _namespace(key: str) -> str:
+        return key.rsplit(":", 1)[0]
+
+    def _count(self, kind: str, field: str) -> None:
+        c = self._counters.setdefault(kind, {"hit": 0, "near": 0, "miss": 0})
+        c[field] += 1
+        VISION_CACHE_RESULTS[field].inc()
+
+    def _get(self, key: str) -> str | None:
+        now = time.time()
+        item = self._mem.get(key)
+        if item is not None:
+            created, value = item
+            if now - created <= self.ttl_sec:
+                self._mem.move_to_end(key)
+                return value
+            self._mem.pop(key, None)
+
+        if self._db is not None:
+            try:
+                row = self._db.execute(
+                    "SELECT created, value FROM vision_cache WHERE key = ?", (key,)
+                ).fetchone()
+            except Exception:
+                logging.exception("[VisionCache] SQLite read failed")
+                row = None
+            if row and now - row[0] <= self.ttl_sec:
+                self._mem_put(key, row[0], row[1])
+                return row[1]
+        return None
+
+    def get(self, key: str, kind: str, phash: int | None = None) -> str | None:
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                self._count(kind, "hit")
+                return value
+
+            if phash is not None:
+                near_key = self._phash.find(self._namespace(key), phash)
+                if near_key is not None:
+                    value = self._get(near_key)
+                    if value is not None:
+                        self._count(kind, "near")
+                        return value
+
+            self._count(kind, "miss")
+            return None
+
+    def put(self, key: str, value: str, phash: int | None = None) -> None:
+        if not value:
+            return
+        now = time.time()
+        with self._lock:
+            self._mem_put(key, now, value)
+            if phash is not None:
+                self._phash.add(self._namespace(key), key, phash)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO vision_cache (key, created, value) VALUES (?, ?, ?)",
+                        (key, now, value),
+                    )
+                    self._puts += 1
+                    # периодически чистим протухшее, чтобы файл не рос бесконечно
+                    if self._puts % 50 == 0:
+                        self._db.execute("DELETE FROM vision_cache WHERE created < ?", (now - self.ttl_sec,))
+                    self._db.commit()
+                except Exception:
+                    logging.exception("[VisionCache] SQLite write failed")
+
+    def _mem_put(self, key: str, created: float, value: str) -> None:
+        self._mem[key] = (created, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    async def aget(self, key: str, kind: str, phash: int | None = None) -> str | None:
+        with TRACER.span("vision_cache.get", kind=kind) as span:
+            if self._db is None:
+                value = self.get(key, kind, phash)
+            else:
+                value = await asyncio.to_thread(self.get, key, kind, phash)
+            span.set("hit", value is not None)
+            return value
+
+    async def aput(self, key: str, value: str, phash: int | None = None) -> None:
+        if self._db is None:
+            return self.put(key, value, phash)
+        await asyncio.to_thread(self.put, key, value, phash)
+
+    def stats_lines(self) -> List[str]:
+        lines = []
+        for kind, c in sorted(self._counters.items()):
+            total = c["hit"] + c["near"] + c["miss"]
+            rate = ((c["hit"] + c["near"]) / total * 100) if total else 0.0
+            lines.append(
+                f"• Vision-кеш [{kind}]: hit {c['hit']} / похожие {c['near']} / miss {c['miss']} ({rate:.0f}%)"
+            )
+        lines.append(f"• Vision-кеш записей в памяти: {len(self._mem)}")
+        return lines
+
+
+VISION_CACHE = VisionCache(
+    max_items=VISION_CACHE_MAX_ITEMS,
+    ttl_sec=VISION_CACHE_TTL_SEC,
+    db_path=VISION_CACHE_DB or None,
+)
+
+# =====================[ IMAGE PIPELINE ]=====================
+# Единственная точка подготовки скринов для Vision: одно декодирование, даунскейл, один JPEG.
+# gpt-4o (detail=high) вписывает картинку в 2048x2048 и ужимает короткую сторону до 768 —
+# всё, что крупнее, модель всё равно не увидит, а мы платим CPU и трафиком.
+VISION_MAX_SIDE = 2048
+VISION_SHORT_SIDE = 768
+VISION_JPEG_QUALITY = 85
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
 
-# ---- image utils (единые версии; удалите дубли в файле) ----
 IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff", ".heic")
 
-async def _extract_image_bytes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> BytesIO | None:
+_IMAGE_POOL = ThreadPoolExecutor(max_workers=max(1, IMAGE_WORKERS), thread_name_prefix="image-prep")
+# Ограничиваем очередь к пулу: при всплеске не держим в памяти сотни декодированных скринов
+_IMAGE_SLOTS = asyncio.Semaphore(max(1, IMAGE_WORKERS) * 4)
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    """Скрин, готовый к отправке в Vision (переиспользуется кешем и ретраями)."""
+    b64: str            # сырой base64 без префикса 'data:'
+    mime: str
+    width: int
+    height: int
+    digest: str         # sha256 итогового JPEG — ключ VisionCache
+    phash: int          # dHash для поиска почти-дубликатов
+    source_bytes: int   # размер исходного файла из Telegram
+
+
+def _vision_target_size(width: int, height: int) -> tuple[int, int]:
+    scale = min(1.0, VISION_MAX_SIDE / max(width, height))
+    short_side = min(width, height) * scale
+    if short_side > VISION_SHORT_SIDE:
+        scale *= VISION_SHORT_SIDE / short_side
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _prepare_image_sync(data: bytes) -> PreparedImage:
+    """CPU-часть пайплайна; выполняется в _IMAGE_POOL, не на event loop."""
+    with Image.open(BytesIO(data)) as src:
+        target = _vision_target_size(*src.size)
+        if src.format == "JPEG":
+            # JPEG-декодер умеет сразу отдавать 1/2, 1/4, 1/8 — не распаковываем полный размер
+            src.draft("RGB", target)
+        im = src
+        # reduce() не умеет P / 1 / I;16 (палитровые PNG, GIF) — такие сначала в RGB
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        factor = min(im.width // target[0], im.height // target[1])
+        if factor >= 2:
+            im = im.reduce(factor)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        if im.size != target and (im.width > target[0] or im.height > target[1]):
+            im = im.resize(target, Image.LANCZOS)
+
+        phash = _dhash(im)
+        out = BytesIO()
+        im.save(out, format="JPEG", quality=VISION_JPEG_QUALITY)
+        jpeg = out.getvalue()
+        width, height = im.size
+
+    return PreparedImage(
+        b64=base64.b64encode(jpeg).decode("ascii"),
+        mime="image/jpeg",
+        width=width,
+        height=height,
+        digest=hashlib.sha256(jpeg).hexdigest(),
+        phash=phash,
+        source_bytes=len(data),
+    )
+
+
+async def prepare_image(src: BytesIO | bytes | bytearray) -> PreparedImage:
+    """BytesIO/bytes из Telegram -> PreparedImage (в ограниченном пуле потоков)."""
+    data = src.getvalue() if isinstance(src, BytesIO) else bytes(src)
+    with TRACER.span("image.prepare", bytes=len(data)):  # вместе с ожиданием слота пула
+        async with _IMAGE_SLOTS:
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            try:
+                return await loop.run_in_executor(_IMAGE_POOL, _prepare_image_sync, data)
+            finally:
+                IMAGE_PREPARE_SECONDS.observe(time.perf_counter() - started)
+
+
+def _is_image_document(doc) -> bool:
+    mt = (getattr(doc, "mime_type", None) or "").lower()
+    fn = (getattr(doc, "file_name", None) or "").lower()
+    return mt.startswith("image/") or any(fn.endswith(ext) for ext in IMAGE_EXTS)
+
+
+def _pick_image_attachment(msg) -> PhotoSize | Document | None:
     """
-    Возвращает BytesIO с данными изображения из:
-      • message.photo
+    Находит изображение в сообщении:
+      • message.photo (берём самое крупное)
       • message.effective_attachment (альбом)
       • message.document с image/* или подходящим расширением
     """
-    msg = update.effective_message
+    if not msg:
+        return None
 
     # 1) Обычное фото
     if getattr(msg, "photo", None):
-        file_id = msg.photo[-1].file_id
-        tg_file = await context.bot.get_file(file_id)
-        bio = BytesIO()
-        await tg_file.download_to_memory(out=bio)
-        bio.seek(0)
-        return bio
+        return msg.photo[-1]
 
     # 2) Альбом / effective_attachment
     att = getattr(msg, "effective_attachment", None)
     if isinstance(att, list) and att:
         for a in reversed(att):  # крупные обычно в конце
             if isinstance(a, PhotoSize):
-                tg_file = await context.bot.get_file(a.file_id)
-                bio = BytesIO()
-                await tg_file.download_to_memory(out=bio)
-                bio.seek(0)
-                return bio
-            if isinstance(a, Document):
-                a_mt = (a.mime_type or "").lower()
-                a_fn = (a.file_name or "").lower()
-                if a_mt.startswith("image/") or any(a_fn.endswith(ext) for ext in IMAGE_EXTS):
-                    tg_file = await context.bot.get_file(a.file_id)
-                    bio = BytesIO()
-                    await tg_file.download_to_memory(out=bio)
-                    bio.seek(0)
-                    return bio
+                return a
+            if isinstance(a, Document) and _is_image_document(a):
+                return a
 
     # 3) Документ-картинка
     doc = getattr(msg, "document", None)
-    if isinstance(doc, Document):
-        mt = (doc.mime_type or "").lower()
-        fn = (doc.file_name or "").lower()
-        if mt.startswith("image/") or any(fn.endswith(ext) for ext in IMAGE_EXTS):
-            tg_file = await context.bot.get_file(doc.file_id)
-            bio = BytesIO()
-            await tg_file.download_to_memory(out=bio)
-            bio.seek(0)
-            return bio
+    if isinstance(doc, Document) and _is_image_document(doc):
+        return doc
 
     return None
 
-def _to_jpeg_base64(bio: BytesIO) -> str:
-    """BytesIO -> JPEG -> base64 (ascii)"""
+
+async def _extract_image_bytes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> BytesIO | None:
+    """Скачивает изображение из сообщения в BytesIO (или None, если картинки нет)."""
+    item = _pick_image_attachment(update.effective_message)
+    if item is None:
+        return None
+
+    started = time.perf_counter()
+    with TRACER.span("image.download") as span:
+        tg_file = await context.bot.get_file(item.file_id)
+        bio = BytesIO()
+        await tg_file.download_to_memory(out=bio)  # PTB 21.x требует keyword-аргумент out=
+        span.set("bytes", bio.tell())
+    IMAGE_DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
     bio.seek(0)
-    with Image.open(bio) as im:
-        im = im.convert("RGB")
-        out = BytesIO()
-        im.save(out, format="JPEG", quality=90, optimize=True)
-        out.seek(0)
-        return base64.b64encode(out.read()).decode("ascii")
+    return bio
+
+def save_referral_data(user_id, username, ref_program, broker, uid):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    row = [str(user_id), username, now, ref_program, broker, uid]
+    safe_append_row(row, f"uid:{user_id}:{uid}")
+
+# ✅ Дозапись в Sheets через локальную очередь (пачки append_rows, без дублей по idem_key)
+def safe_append_row(row, idem_key: str | None = None) -> bool:
+    if idem_key is None:
+        idem_key = hashlib.sha1(json.dumps([str(c) for c in row], ensure_ascii=False).encode()).hexdigest()
+    return SHEETS_WRITES.enqueue(row, idem_key)
+
+# =====================[ SHEETS MIRROR ]=====================
+# Материализованное представление листа в памяти. Обычный sync читает только хвост
+# (последняя известная строка + новые), полная перечитка — раз в SHEETS_FULL_RECONCILE_SEC
+# или когда «якорная» строка изменилась (правка/удаление руками в таблице).
+SHEETS_FULL_RECONCILE_SEC = int(os.getenv("SHEETS_FULL_RECONCILE_SEC", "3600"))
+SHEETS_LAST_COLUMN = "Z"
+
+
+class SheetMirror:
+    def __init__(self, worksheet, full_reconcile_sec: int = SHEETS_FULL_RECONCILE_SEC):
+        self._ws = worksheet
+        self._full_reconcile_sec = full_reconcile_sec
+        self._lock = threading.Lock()
+        self._header: List[str] = []
+        self._rows: List[List[str]] = []   # сырые строки данных (без заголовка)
+        self._records: List[dict] = []     # те же строки как dict по заголовку
+        self._user_ids: set[int] = set()
+        self._last_full = 0.0
+        self.last_sync = 0.0
+        self.full_syncs = 0
+        self.delta_syncs = 0
+        self.rows_fetched = 0
+
+    # --- чтение представления ---
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def records(self) -> List[dict]:
+        return list(self._records)
+
+    def last_record(self) -> dict:
+        return self._records[-1] if self._records else {}
+
+    def user_ids(self) -> set[int]:
+        return set(self._user_ids)
+
+    def tail(self, n: int) -> List[List[str]]:
+        return [list(r) for r in self._rows[-n:]] if n > 0 else []
+
+    # --- синхронизация (блокирующая, вызывать в треде) ---
+    def sync(self, force_full: bool = False) -> bool:
+        """Возвращает True, если была полная перечитка листа."""
+        with self._lock:
+            due = time.time() - self._last_full > self._full_reconcile_sec
+            if force_full or due or not self._header or not self._delta_locked():
+                self._full_locked()
+                return True
+            return False
+
+    def _full_locked(self) -> None:
+        started = time.perf_counter()
+        values = self._ws.get_values()
+        SHEETS_READ_SECONDS.observe(time.perf_counter() - started)
+        self.rows_fetched += len(values)
+        header = [str(h).strip() for h in (values[0] if values else [])]
+        self._header = header
+        self._rows, self._records, self._user_ids = [], [], set()
+        self._append_locked(values[1:])
+        self._last_full = self.last_sync = time.time()
+        self.full_syncs += 1
+        logging.info(f"🔄 Google Sheets: полная синхронизация, {len(self._rows)} строк")
+
+    def _delta_locked(self) -> bool:
+        """Читает диапазон с последней известной строки. False — нужна полная перечитка."""
+        n = len(self._rows)
+        anchor_row = n + 1  # строка 1 — заголовок, данные с 2-й; якорь = последняя известная строка
+        if n == 0:
+            anchor_row = 2
+        started = time.perf_counter()
+        values = self._ws.get_values(f"A{anchor_row}:{SHEETS_LAST_COLUMN}")
+        SHEETS_READ_SECONDS.observe(time.perf_counter() - started)
+        self.rows_fetched += len(values)
+        if n:
+            if not values or self._norm(values[0]) != self._norm(self._rows[-1]):
+                return False  # хвост сдвинулся: строки удалили/отредактировали
+            values = values[1:]
+        self._append_locked(values)
+        self.last_sync = time.time()
+        self.delta_syncs += 1
+        return True
+
+    @staticmethod
+    def _norm(row) -> Tuple[str, ...]:
+        cells = [str(c).strip() for c in row]
+        while cells and not cells[-1]:
+            cells.pop()
+        return tuple(cells)
+
+    def _append_locked(self, values) -> None:
+        for raw in values:
+            row = [str(c) for c in raw]
+            record = {key: (row[i] if i < len(row) else "") for i, key in enumerate(self._header) if key}
+            self._rows.append(row)
+            self._records.append(record)
+            uid = str(record.get("user_id", "")).strip()
+            if uid:
+                try:
+                    self._user_ids.add(int(uid))
+                except ValueError:
+                    logging.warning(f"⚠️ Не удалось преобразовать user_id: {uid}")
+
+    def stats_lines(self) -> List[str]:
+        age = f"{time.time() - self.last_sync:.0f}с назад" if self.last_sync else "ещё не было"
+        return [
+            f"• Sheets mirror: {len(self._records)} строк, sync {age} "
+            f"(full={self.full_syncs}, delta={self.delta_syncs}, прочитано строк={self.rows_fetched})"
+        ]
+
+
+SHEET_MIRROR = SheetMirror(sheet)
+
+
+MONTHLY_PRICE_USD = 25
+LIFETIME_PRICE_USD = 199
+PAY_CURRENCY = "USDT"
+PAY_NETWORK = "TRC20"
+
+# =====================[ ENTITLEMENTS ]=====================
+# Источник правды по доступам — локальная SQLite (WAL). Google Sheets — зеркало/экспорт:
+# оплаты и /grant пишутся туда асинхронно, а ручные строки из таблицы импортируются в фоне.
+DATA_DIR = Path(os.getenv("DATA_DIR", str(BASE_DIR / "data")))
+
 
-# Устойчивый экстрактор изображений из Update (photo / document / media group)
-async def _extract_image_bytes(update) -> bytes:
+def _check_data_dir_persistent() -> None:
     """
-    Возвращает bytes изображения из:
-    - message.photo (стандартные фото)
-    - effective_attachment (альбом: PhotoSize или Document-картинка)
-    - message.document (если это картинка или файл с img-расширением)
-    Бросает ValueError('image_not_found'), если ничего не нашли.
+    На Render файловая система контейнера стирается при каждом деплое — вместе с доступами,
+    журналом оплат, user_data и outbox. Там DATA_DIR обязан лежать на подключённом диске
+    (см. render.yaml); иначе не стартуем. DATA_DIR_EPHEMERAL_OK=1 — осознанно без диска.
     """
-    msg = update.effective_message
+    if not os.getenv("RENDER") or os.getenv("DATA_DIR_EPHEMERAL_OK", "").strip() == "1":
+        return
+    path = DATA_DIR.resolve()
+    for candidate in (path, *path.parents):
+        if candidate == Path(candidate.anchor):
+            break
+        if os.path.ismount(candidate):
+            return
+    raise RuntimeError(
+        f"DATA_DIR={DATA_DIR} не на постоянном диске: после деплоя пропадут доступы и журнал оплат. "
+        "Подключите disk в render.yaml и укажите DATA_DIR на его mountPath."
+    )
 
-    # 1) Обычное фото
-    if getattr(msg, "photo", None):
-        file = await msg.photo[-1].get_file()
-        return await file.download_as_bytearray()
 
-    # 2) Альбом/прочие вложения (effective_attachment)
-    att = getattr(msg, "effective_attachment", None)
-    if isinstance(att, list) and att:
-        # берём подходящее вложение (крупные обычно ближе к концу)
-        for a in reversed(att):
-            if isinstance(a, PhotoSize):
-                file = await a.get_file()
-                return await file.download_as_bytearray()
-            if isinstance(a, Document):
-                mt = (a.mime_type or "").lower()
-                fn = (a.file_name or "").lower()
-                if mt.startswith("image/") or any(fn.endswith(ext) for ext in IMAGE_EXTS):
-                    file = await a.get_file()
-                    return await file.download_as_bytearray()
-
-    # 3) Документ как картинка (или «файл», но по расширению — картинка)
-    doc = getattr(msg, "document", None)
-    if isinstance(doc, Document):
-        mt = (doc.mime_type or "").lower()
-        fn = (doc.file_name or "").lower()
-        if mt.startswith("image/") or any(fn.endswith(ext) for ext in IMAGE_EXTS):
-            file = await doc.get_file()
-            return await file.download_as_bytearray()
+_check_data_dir_persistent()
+ENTITLEMENTS_DB = os.getenv("ENTITLEMENTS_DB", str(DATA_DIR / "entitlements.db"))
+SHEETS_IMPORT_INTERVAL_SEC = 300  # как часто подтягивать ручные правки из таблицы
+MONTHLY_PERIOD_SEC = 30 * 24 * 3600
+EXPIRY_SWEEP_MAX_SLEEP_SEC = 300  # не спим дольше, чтобы подхватить новые сроки
+EXPIRY_SWEEP_BATCH = 100
+PAYMENT_GRANTS_KEEP_SEC = 180 * 24 * 3600  # сколько помнить, какие платежи уже дали доступ
 
-    raise ValueError("image_not_found")
 
-def save_referral_data(user_id, username, ref_program, broker, uid):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M")
-    row = [str(user_id), username, now, ref_program, broker, uid]
-    sheet.append_row(row)
+def _sqlite_connect(path: str | Path) -> sqlite3.Connection:
+    """Общее подключение к локальной SQLite: WAL, обычный fsync, доступ из пула потоков."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class EntitlementStore:
+    """
+    Доступы пользователей: user_id -> (plan, expires_at, active, source).
+    Проверка доступа — O(1) по in-memory set, который синхронизирован с таблицей.
+    """
+
+    def __init__(self, path: str | Path):
+        self._lock = threading.Lock()
+        self._db = _sqlite_connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entitlements ("
+            " user_id INTEGER PRIMARY KEY,"
+            " username TEXT NOT NULL DEFAULT '',"
+            " plan TEXT NOT NULL,"
+            " expires_at REAL,"
+            " active INTEGER NOT NULL DEFAULT 1,"
+            " source TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_entitlements_active ON entitlements(active, expires_at)")
+        # Какой платёж уже применён: пишется в одной транзакции с доступом — повтор после падения
+        # между grant и PAYMENT_LEDGER.complete не продлит monthly второй раз
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS payment_grants ("
+            " payment_key TEXT PRIMARY KEY,"
+            " user_id INTEGER NOT NULL,"
+            " plan TEXT NOT NULL,"
+            " expires_at REAL,"
+            " created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_payment_grants_created ON payment_grants(created)")
+        self._active: set[int] = set()
+        # Индекс сроков: heap (expires_at, user_id) + актуальный срок в dict.
+        # Продление кладёт новую пару в heap, старая отбрасывается при извлечении (lazy deletion).
+        self._expiry: Dict[int, float] = {}
+        self._heap: List[Tuple[float, int]] = []
+        for uid, expires_at in self._db.execute("SELECT user_id, expires_at FROM entitlements WHERE active = 1"):
+            self._active.add(uid)
+            if expires_at is not None:
+                self._expiry[uid] = expires_at
+                self._heap.append((expires_at, uid))
+        heapq.heapify(self._heap)
+
+    def active_ids(self) -> set[int]:
+        return self._active
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def get(self, user_id: int) -> dict | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT user_id, username, plan, expires_at, active, source, updated_at"
+                " FROM entitlements WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if not row:
+            return None
+        keys = ("user_id", "username", "plan", "expires_at", "active", "source", "updated_at")
+        return dict(zip(keys, row))
+
+    def grant(self, user_id: int, username: str = "", plan: str = "lifetime", source: str = "admin",
+              payment_key: str | None = None) -> dict:
+        """
+        Выдаёт/продлевает доступ. monthly — +30 дней от текущего срока (если ещё активен) или от сейчас;
+        lifetime — бессрочно. Возвращает актуальную запись.
+        payment_key — идемпотентность: повторный вызов с тем же ключом ничего не меняет
+        и возвращает результат первого.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = self._grant_locked(user_id, username, plan, source, payment_key, now)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            if not result.pop("replayed", False):
+                self._active.add(user_id)
+                self._set_expiry_locked(user_id, result["expires_at"])
+        return result
+
+    def _grant_locked(self, user_id: int, username: str, plan: str, source: str,
+                      payment_key: str | None, now: float) -> dict:
+        if payment_key:
+            done = self._db.execute(
+                "SELECT plan, expires_at FROM payment_grants WHERE payment_key = ?", (payment_key,)
+            ).fetchone()
+            if done:
+                return {"user_id": user_id, "plan": done[0], "expires_at": done[1], "source": source,
+                        "replayed": True}
+        row = self._db.execute(
+            "SELECT plan, expires_at, active FROM entitlements WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        expires_at = None
+        if plan == "monthly":
+            base = now
+            if row and row[2] and row[1] and row[1] > now:
+                base = row[1]
+            if row and row[2] and row[1] is None and row[0] == "lifetime":
+                plan = "lifetime"  # не понижаем бессрочный доступ до месячного
+            else:
+                expires_at = base + MONTHLY_PERIOD_SEC
+        self._db.execute(
+            "INSERT INTO entitlements (user_id, username, plan, expires_at, active, source, updated_at)"
+            " VALUES (?, ?, ?, ?, 1, ?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET"
+            "  username = CASE WHEN excluded.username != '' THEN excluded.username ELSE username END,"
+            "  plan = excluded.plan, expires_at = excluded.expires_at, active = 1,"
+            "  source = excluded.source, updated_at = excluded.updated_at",
+            (user_id, username or "", plan, expires_at, source, now),
+        )
+        if payment_key:
+            self._db.execute(
+                "INSERT INTO payment_grants (payment_key, user_id, plan, expires_at, created) VALUES (?, ?, ?, ?, ?)",
+                (payment_key, user_id, plan, expires_at, now),
+            )
+            self._db.execute("DELETE FROM payment_grants WHERE created < ?", (now - PAYMENT_GRANTS_KEEP_SEC,))
+        return {"user_id": user_id, "plan": plan, "expires_at": expires_at, "source": source}
+
+    def _set_expiry_locked(self, user_id: int, expires_at: float | None) -> None:
+        if expires_at is None:
+            self._expiry.pop(user_id, None)
+        else:
+            self._expiry[user_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, user_id))
+
+    def revoke(self, user_id: int) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE entitlements SET active = 0, updated_at = ? WHERE user_id = ? AND active = 1",
+                (time.time(), user_id),
+            )
+            self._active.discard(user_id)
+            self._expiry.pop(user_id, None)
+        return cur.rowcount > 0
+
+    def next_expiry(self) -> float | None:
+        """Ближайший срок окончания среди активных monthly-доступов."""
+        with self._lock:
+            while self._heap and self._expiry.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)  # устаревшая запись (продление/отзыв)
+            return self._heap[0][0] if self._heap else None
+
+    def expire_due(self, now: float | None = None, limit: int = EXPIRY_SWEEP_BATCH) -> List[int]:
+        """Отзывает до `limit` истёкших доступов одной транзакцией. Возвращает их user_id."""
+        now = time.time() if now is None else now
+        expired: List[int] = []
+        with self._lock:
+            while self._heap and len(expired) < limit and self._heap[0][0] <= now:
+                expires_at, uid = heapq.heappop(self._heap)
+                if self._expiry.get(uid) == expires_at:
+                    expired.append(uid)
+            if not expired:
+                return expired
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "UPDATE entitlements SET active = 0, updated_at = ? WHERE user_id = ? AND active = 1",
+                    [(now, uid) for uid in expired],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                for uid in expired:
+                    heapq.heappush(self._heap, (self._expiry[uid], uid))
+                raise
+            for uid in expired:
+                self._active.discard(uid)
+                self._expiry.pop(uid, None)
+        return expired
+
+    def import_from_sheet(self, entries: Dict[int, Tuple[str, float | None]]) -> int:
+        """
+        Строки из Google Sheets ({user_id: (plan, expires_at)}, см. sheet_entitlements):
+        добавляем только неизвестных пользователей. Истёкший monthly ложится неактивным —
+        чтобы потерянная база не превращала закончившиеся подписки в бессрочные.
+        """
+        now = time.time()
+        added = 0
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for uid, (plan, expires_at) in entries.items():
+                    active = expires_at is None or expires_at > now
+                    cur = self._db.execute(
+                        "INSERT OR IGNORE INTO entitlements (user_id, plan, expires_at, active, source, updated_at)"
+                        " VALUES (?, ?, ?, ?, 'sheet', ?)",
+                        (uid, plan, expires_at, int(active), now),
+                    )
+                    if cur.rowcount and active:
+                        self._active.add(uid)
+                        self._set_expiry_locked(uid, expires_at)
+                        added += 1
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return added
+
+    def revoke_missing_sheet_users(self, present: set[int]) -> int:
+        """Отзывает импортированные из таблицы доступы, строк которых в таблице больше нет."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT user_id FROM entitlements WHERE active = 1 AND source = 'sheet'"
+            ).fetchall()
+        missing = [uid for (uid,) in rows if uid not in present]
+        for uid in missing:
+            self.revoke(uid)
+        return len(missing)
+
+    def plan_counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT plan, COUNT(*) FROM entitlements WHERE active = 1 GROUP BY plan"
+            ).fetchall()
+        return {plan: n for plan, n in rows}
+
+
+ENTITLEMENTS = EntitlementStore(ENTITLEMENTS_DB)
+
+_SHEETS_IMPORT_TS = 0.0
+_SHEETS_IMPORT_RUNNING = False
+
+
+_SHEET_TS_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M")
+
+
+def _parse_sheet_ts(raw: str) -> float | None:
+    raw = (raw or "").strip()
+    for fmt in _SHEET_TS_FORMATS:
+        try:
+            return datetime.strptime(raw, fmt).timestamp()
+        except ValueError:
+            continue
+    try:
+        return float(raw)
+    except ValueError:
+        return None
+
+
+def sheet_entitlements(rows: List[List[str]]) -> Dict[int, Tuple[str, float | None]]:
+    """
+    Доступы по строкам листа: [user_id, username, время, plan, expires_at] (см. log_payment).
+    monthly/lifetime — из колонки plan; срок monthly — из expires_at, для старых строк без него —
+    продление на MONTHLY_PERIOD_SEC от времени оплаты. Строки без плана (ручные, рефералы) —
+    бессрочный 'sheet', как и раньше. monthly с нечитаемым временем не даёт доступа.
+    """
+    result: Dict[int, Tuple[str, float | None]] = {}
+    for row in rows:
+        cells = [str(c).strip() for c in row] + [""] * 5
+        try:
+            uid = int(cells[0])
+        except ValueError:
+            continue
+        plan = cells[3].lower()
+        current = result.get(uid)
+        if current and current[1] is None:
+            continue  # бессрочный доступ ничем не понижаем
+        if plan == "monthly":
+            expires_at = _parse_sheet_ts(cells[4])
+            if expires_at is None:
+                paid_at = _parse_sheet_ts(cells[2])
+                if paid_at is None:
+                    logging.warning(f"[entitlements] Sheets: monthly без даты у {uid}: {row}")
+                    continue
+                base = max(paid_at, current[1]) if current else paid_at
+                expires_at = base + MONTHLY_PERIOD_SEC
+            if current:
+                expires_at = max(expires_at, current[1])
+            result[uid] = ("monthly", expires_at)
+        else:
+            result[uid] = ("lifetime" if plan == "lifetime" else "sheet", None)
+    return result
+
+
+def sync_entitlements_from_sheet(force_full: bool = False) -> int:
+    """Блокирующий импорт строк из Google Sheets в ENTITLEMENTS (вызывать в треде)."""
+    global _SHEETS_IMPORT_TS
+    full = SHEET_MIRROR.sync(force_full=force_full)
+    users = SHEET_MIRROR.user_ids()
+    entries = sheet_entitlements(SHEET_MIRROR.tail(len(SHEET_MIRROR))) if users else {}
+    added = ENTITLEMENTS.import_from_sheet(entries) if entries else 0
+    # Удаления строк видны только после полной сверки
+    removed = ENTITLEMENTS.revoke_missing_sheet_users(users) if full and users else 0
+    _SHEETS_IMPORT_TS = time.time()
+    if added or removed:
+        logging.info(f"[entitlements] Sheets: +{added} / -{removed}")
+    return added
+
+
+def get_allowed_users():
+    """
+    Множество user_id с активным доступом (локальная SQLite, O(1) проверка `in`).
+    Раз в SHEETS_IMPORT_INTERVAL_SEC в фоне подтягивает ручные строки из Google Sheets —
+    проверка доступа при этом никогда не ждёт Sheets.
+    """
+    global _SHEETS_IMPORT_RUNNING
+
+    if time.time() - _SHEETS_IMPORT_TS > SHEETS_IMPORT_INTERVAL_SEC and not _SHEETS_IMPORT_RUNNING:
+        # Ставим флаг ДО старта потока, чтобы не запустить несколько раз подряд
+        _SHEETS_IMPORT_RUNNING = True
+
+        def _refresh():
+            global _SHEETS_IMPORT_RUNNING
+            try:
+                sync_entitlements_from_sheet()
+            except Exception:
+                logging.exception("[get_allowed_users] sheet import failed")
+            finally:
+                _SHEETS_IMPORT_RUNNING = False
+
+        threading.Thread(target=_refresh, daemon=True).start()
+
+    return ENTITLEMENTS.active_ids()
+
+
+async def expiry_sweeper(bot) -> None:
+    """Фоновая задача: спит до ближайшего срока, отзывает истёкшие monthly-доступы пачками и уведомляет."""
+    while True:
+        try:
+            next_at = ENTITLEMENTS.next_expiry()
+            delay = EXPIRY_SWEEP_MAX_SLEEP_SEC if next_at is None else next_at - time.time()
+            if delay > 0:
+                await asyncio.sleep(min(delay, EXPIRY_SWEEP_MAX_SLEEP_SEC))
+                continue
+            expired = await asyncio.to_thread(ENTITLEMENTS.expire_due)
+            if not expired:
+                continue
+            logging.info(f"⏳ Истёк доступ у {len(expired)} пользователей")
+            for uid in expired:
+                try:
+                    await bot.send_message(
+                        chat_id=uid,
+                        text=(
+                            "⏳ Срок твоей месячной подписки закончился, доступ к разборам приостановлен.\n\n"
+                            "Чтобы продлить — нажми «💰 Купить» в меню."
+                        ),
+                        reply_markup=REPLY_MARKUP,
+                    )
+                except RetryAfter as e:
+                    await asyncio.sleep(float(e.retry_after))
+                except Exception as e:
+                    logging.warning(f"[expiry_sweeper] не удалось уведомить {uid}: {e}")
+                await asyncio.sleep(0.05)  # не упираемся в лимит Telegram на рассылку
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("[expiry_sweeper] ошибка")
+            await asyncio.sleep(60)
+
+
+# =====================[ SHEETS WRITE QUEUE ]=====================
+# Все дозаписи в Google Sheets идут через локальный outbox (SQLite) и уходят пачками
+# append_rows: по размеру пачки или по окну времени. idem_key уникален — повторная
+# постановка той же записи (ретрай IPN, повтор апдейта) строку не дублирует.
+SHEETS_OUTBOX_DB = os.getenv("SHEETS_OUTBOX_DB", str(DATA_DIR / "sheets_outbox.db"))
+SHEETS_BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", "50"))
+SHEETS_FLUSH_WINDOW_SEC = float(os.getenv("SHEETS_FLUSH_WINDOW_SEC", "5"))
+SHEETS_RETRY_MAX_SEC = 120.0
+SHEETS_OUTBOX_KEEP_SEC = 7 * 24 * 3600  # сколько помнить отправленные ключи
+# Строку, которую Sheets отклоняет (4xx) столько раз подряд, убираем из очереди в dead-letter:
+# attempts >= лимита и sent_at IS NULL — она остаётся в базе для разбора, но FIFO не держит.
+SHEETS_MAX_ATTEMPTS = int(os.getenv("SHEETS_MAX_ATTEMPTS", "5"))
+
+
+def _is_permanent_sheets_error(e: Exception) -> bool:
+    """Ошибка в самих данных запроса (4xx, кроме 429) — повтор той же пачки не поможет."""
+    if not isinstance(e, gspread.exceptions.APIError):
+        return False
+    status = getattr(getattr(e, "response", None), "status_code", None) or 0
+    return 400 <= status < 500 and status != 429
+
+
+class SheetsWriteQueue:
+    def __init__(self, path: str | Path, worksheet, mirror: SheetMirror):
+        self._ws = worksheet
+        self._mirror = mirror
+        self._lock = threading.Lock()
+        self._db = _sqlite_connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sheets_outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " idem_key TEXT NOT NULL UNIQUE,"
+            " row TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " sent_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_sheets_outbox_pending ON sheets_outbox(sent_at, id)")
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        # метрики
+        self.enqueued = 0
+        self.duplicates = 0
+        self.flushed_rows = 0
+        self.batches = 0
+        self.failures = 0
+        self.recovered_rows = 0
+        self.dead_lettered = 0
+        self._latencies = deque(maxlen=100)
+
+    # --- постановка (из любого потока) ---
+    def enqueue(self, row: List[Any], idem_key: str) -> bool:
+        """Кладёт строку в outbox. False — такая запись уже была поставлена."""
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO sheets_outbox (idem_key, row, created) VALUES (?, ?, ?)",
+                (idem_key, json.dumps([str(c) for c in row], ensure_ascii=False), time.time()),
+            )
+        if not cur.rowcount:
+            self.duplicates += 1
+            return False
+        self.enqueued += 1
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM sheets_outbox WHERE sent_at IS NULL AND attempts < ?", (SHEETS_MAX_ATTEMPTS,)
+            ).fetchone()[0]
+
+    def dead_letters(self) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM sheets_outbox WHERE sent_at IS NULL AND attempts >= ?", (SHEETS_MAX_ATTEMPTS,)
+            ).fetchone()[0]
+
+    def _pending(self, limit: int) -> List[Tuple[int, List[str], float, int]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, row, created, attempts FROM sheets_outbox"
+                " WHERE sent_at IS NULL AND attempts < ? ORDER BY id LIMIT ?",
+                (SHEETS_MAX_ATTEMPTS, limit),
+            ).fetchall()
+        return [(rid, json.loads(raw), created, attempts) for rid, raw, created, attempts in rows]
+
+    def _mark_sent(self, ids: List[int]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.executemany("UPDATE sheets_outbox SET sent_at = ? WHERE id = ?", [(now, i) for i in ids])
+            self._db.execute("DELETE FROM sheets_outbox WHERE sent_at < ?", (now - SHEETS_OUTBOX_KEEP_SEC,))
+
+    def _mark_failed(self, ids: List[int]) -> None:
+        with self._lock:
+            self._db.executemany("UPDATE sheets_outbox SET attempts = attempts + 1 WHERE id = ?", [(i,) for i in ids])
+
+    # --- отправка (блокирующая, в треде) ---
+    def _already_landed(self, batch) -> List[int]:
+        """
+        После ошибки запрос мог всё-таки дойти до Sheets. Дочитываем хвост листа и
+        считаем отправленными строки, которые там уже есть.
+        """
+        self._mirror.sync()
+        tail = {SheetMirror._norm(r) for r in self._mirror.tail(len(batch) + SHEETS_BATCH_SIZE)}
+        return [rid for rid, row, _, _ in batch if SheetMirror._norm(row) in tail]
+
+    def flush_once(self) -> int:
+        batch = self._pending(SHEETS_BATCH_SIZE)
+        if not batch:
+            return 0
+        if batch[0][3]:
+            # голова уже отклонялась — шлём её одну, чтобы битая строка не тянула за собой пачку
+            batch = batch[:1]
+        ids = [rid for rid, _, _, _ in batch]
+        started = time.monotonic()
+        try:
+            # RAW: Sheets не переразбирает значения (лидирующие нули UID, даты и id остаются строками,
+            # а _already_landed сравнивает с тем, что реально легло в лист)
+            self._ws.append_rows([row for _, row, _, _ in batch], value_input_option="RAW")
+        except Exception as e:
+            SHEETS_APPEND_SECONDS.observe(time.monotonic() - started)
+            self.failures += 1
+            if _is_permanent_sheets_error(e):
+                self._mark_failed(ids)
+                if len(batch) == 1 and batch[0][3] + 1 >= SHEETS_MAX_ATTEMPTS:
+                    self.dead_lettered += 1
+                    logging.error(f"[SheetsWriteQueue] строка id={ids[0]} отклонена {SHEETS_MAX_ATTEMPTS} раз — "
+                                  f"в dead-letter: {batch[0][1]}")
+            try:
+                landed = self._already_landed(batch)
+            except Exception:
+                landed = []
+            if landed:
+                self._mark_sent(landed)
+                self.recovered_rows += len(landed)
+                if len(landed) == len(ids):
+                    return len(ids)
+            raise
+        self._latencies.append(time.monotonic() - started)
+        SHEETS_APPEND_SECONDS.observe(self._latencies[-1])
+        self._mark_sent(ids)
+        self.flushed_rows += len(ids)
+        self.batches += 1
+        return len(ids)
+
+    # --- фоновый цикл ---
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        retry_delay = 0.0
+        while True:
+            try:
+                pending = await asyncio.to_thread(self._pending, SHEETS_BATCH_SIZE)
+                if not pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                # Копим пачку: ждём либо полного размера, либо конца окна от самой старой записи
+                age = time.time() - pending[0][2]
+                if len(pending) < SHEETS_BATCH_SIZE and age < SHEETS_FLUSH_WINDOW_SEC:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), SHEETS_FLUSH_WINDOW_SEC - age)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                sent = await asyncio.to_thread(self.flush_once)
+                retry_delay = 0.0
+                logging.info(f"🧾 Google Sheets: дозаписано {sent} строк одной пачкой")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                retry_delay = min(SHEETS_RETRY_MAX_SEC, max(2.0, retry_delay * 2))
+                logging.warning(f"[SheetsWriteQueue] ошибка записи, повтор через {retry_delay:.0f}с: {e}")
+                await asyncio.sleep(retry_delay)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """Останавливает фоновый цикл и пытается дослать остаток (что не ушло — уйдёт после рестарта)."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            while await asyncio.to_thread(self.flush_once):
+                pass
+        except Exception as e:
+            logging.warning(f"[SheetsWriteQueue] не удалось дослать очередь при остановке: {e}")
+
+    def stats_lines(self) -> List[str]:
+        lat = sorted(self._latencies)
+        lat_txt = f"{lat[len(lat) // 2] * 1000:.0f}/{lat[-1] * 1000:.0f} мс (p50/max)" if lat else "—"
+        return [
+            f"• Sheets outbox: в очереди {self.depth()}, отправлено {self.flushed_rows} строк "
+            f"за {self.batches} пачек, flush {lat_txt}",
+            f"  дубликатов отсечено {self.duplicates}, ошибок {self.failures}, "
+            f"найдено уже записанными {self.recovered_rows}, в dead-letter {self.dead_letters()}",
+        ]
+
+
+SHEETS_WRITES = SheetsWriteQueue(SHEETS_OUTBOX_DB, sheet, SHEET_MIRROR)
+GaugeFunc("sheets_outbox_pending", "Rows waiting in the Sheets outbox", SHEETS_WRITES.depth)
+
+
+# =====================[ MEDIA REGISTRY ]=====================
+# Локальные медиафайлы загружаются в Telegram один раз, дальше отправляем по file_id.
+# Ключ — путь + mtime + размер: заменили файл на диске → загрузится заново.
+MEDIA_DB = os.getenv("MEDIA_DB", str(DATA_DIR / "media.db"))
+
+
+def _message_file_id(message, kind: str) -> str | None:
+    if message is None:
+        return None
+    if kind == "photo":
+        return message.photo[-1].file_id if message.photo else None
+    # Telegram может вернуть анимацию как document (и наоборот) — берём что есть
+    for attr in (kind, "animation", "video", "document"):
+        media = getattr(message, attr, None)
+        if media is not None:
+            return media.file_id
+    return None
+
+
+# Ответы Bot API о негодном file_id (удалён, чужой бот, протухшая ссылка); остальные BadRequest —
+# ошибки самого запроса (подпись, parse_mode), их повтор загрузкой не исправит
+_STALE_FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference expired",
+                         "invalid file id")
+
+
+class MediaRegistry:
+    def __init__(self, path: str | Path):
+        self._lock = threading.Lock()
+        self._db = _sqlite_connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS media_files ("
+            " key TEXT PRIMARY KEY, file_id TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._ids: Dict[str, str] = dict(self._db.execute("SELECT key, file_id FROM media_files"))
+        self._upload_locks: Dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.uploads = 0
+
+    @staticmethod
+    def key_for(path: Path, kind: str) -> str:
+        st = path.stat()
+        return f"{kind}:{path.resolve()}:{st.st_mtime_ns}:{st.st_size}"
+
+    def _store(self, key: str, file_id: str | None) -> None:
+        with self._lock:
+            if file_id:
+                self._ids[key] = file_id
+                self._db.execute(
+                    "INSERT OR REPLACE INTO media_files (key, file_id, updated) VALUES (?, ?, ?)",
+                    (key, file_id, time.time()),
+                )
+            else:
+                self._ids.pop(key, None)
+                self._db.execute("DELETE FROM media_files WHERE key = ?", (key,))
+
+    async def send(self, path: str | Path, kind: str, send_fn: Callable[[Any], Awaitable[Any]]):
+        """
+        Отправляет локальный файл через send_fn(media): по сохранённому file_id, а если его нет
+        или Telegram его не принял — загрузкой файла (и запоминает новый file_id).
+        """
+        path = Path(path)
+        key = self.key_for(path, kind)
+
+        file_id = self._ids.get(key)
+        if file_id is None:
+            # Одна загрузка на ключ: параллельные /start дождутся file_id первой
+            lock = self._upload_locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                file_id = self._ids.get(key)
+                if file_id is None:
+                    return await self._upload(path, key, kind, send_fn)
+
+        try:
+            message = await send_fn(file_id)
+            self.hits += 1
+            MEDIA_CACHE_HIT.inc()
+            return message
+        except BadRequest as e:
+            if not any(marker in str(e).lower() for marker in _STALE_FILE_ID_ERRORS):
+                raise
+            logging.warning(f"[media] file_id для {path.name} не принят ({e}), загружаю заново")
+            await asyncio.to_thread(self._store, key, None)
+            return await self._upload(path, key, kind, send_fn)
+
+    async def _upload(self, path: Path, key: str, kind: str, send_fn):
+        with path.open("rb") as fh:
+            message = await send_fn(fh)
+        self.uploads += 1
+        MEDIA_CACHE_MISS.inc()
+        file_id = _message_file_id(message, kind)
+        if file_id:
+            await asyncio.to_thread(self._store, key, file_id)
+        return message
+
+    def stats_lines(self) -> List[str]:
+        return [f"• Медиа file_id: {len(self._ids)} файлов, отправок по file_id {self.hits}, загрузок {self.uploads}"]
+
+
+MEDIA = MediaRegistry(MEDIA_DB)
+
+
+# =====================[ STATE PERSISTENCE ]=====================
+# user_data и состояния ConversationHandler'ов переживают рестарт: SQLite + бинарные блобы на диске.
+STATE_DB = os.getenv("STATE_DB", str(DATA_DIR / "state.db"))
+STATE_BLOB_DIR = Path(os.getenv("STATE_BLOB_DIR", str(DATA_DIR / "state_blobs")))
+STATE_BLOB_INLINE_MAX = int(os.getenv("STATE_BLOB_INLINE_MAX", "4096"))  # bytes больше — отдельным файлом
+STATE_UPDATE_INTERVAL_SEC = float(os.getenv("STATE_UPDATE_INTERVAL_SEC", "10"))
+
+
+# Память: пользователи без активности дольше STATE_IDLE_TTL_SEC выгружаются (состояние остаётся в SQLite),
+# крупные bytes всех резидентных пользователей в сумме не больше STATE_BLOB_BUDGET_BYTES — лишнее на диск.
+STATE_IDLE_TTL_SEC = int(os.getenv("STATE_IDLE_TTL_SEC", "1800"))
+STATE_BLOB_BUDGET_BYTES = int(os.getenv("STATE_BLOB_BUDGET_BYTES", str(16 * 1024 * 1024)))
+STATE_SWEEP_INTERVAL_SEC = int(os.getenv("STATE_SWEEP_INTERVAL_SEC", "60"))
+
+
+def _state_blob_name(user_id: int, value: bytes) -> str:
+    return f"{user_id}_{hashlib.sha256(value).hexdigest()[:24]}.bin"
+
+
+def _is_large_blob(value: Any) -> bool:
+    return isinstance(value, (bytes, bytearray)) and len(value) > STATE_BLOB_INLINE_MAX
+
+
+class SpilledBlob:
+    """bytes из user_data, вытесненные в STATE_BLOB_DIR; UserStateDict читает их обратно при обращении."""
+    __slots__ = ("name", "size")
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+    def read(self) -> bytes | None:
+        path = STATE_BLOB_DIR / self.name
+        return path.read_bytes() if path.exists() else None
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class UserStateDict(dict):
+    """
+    Тип context.user_data (через ContextTypes). Для хендлеров — обычный dict: вытесненные
+    на диск bytes прозрачно читаются в __getitem__/get/pop. Запись крупных bytes сообщает
+    USER_STATE, чтобы тот держал общий бюджет памяти.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_id: int | None = None
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if isinstance(value, SpilledBlob):
+            USER_STATE.restored += 1
+            return value.read()
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        return value.read() if isinstance(value, SpilledBlob) else value
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        if self.user_id is not None and _is_large_blob(value):
+            USER_STATE.on_blob(self.user_id, self)
+
+    def __deepcopy__(self, memo):
+        # PTB копирует user_data перед записью в persistence: отдаём обычный dict, SpilledBlob — как есть
+        return {key: copy.deepcopy(value, memo) for key, value in dict.items(self)}
+
+
+# У Application нет публичного «забыть user_data, не удаляя из persistence» (drop_user_data
+# ставит ещё и удаление строки), поэтому выгрузка идёт через приватные поля. Их раскладка
+# проверена на PTB 20–21; на другой версии выгрузка по простою выключается.
+_PTB_UNLOAD_VERSIONS = ((20, 0), (22, 0))
+
+
+def _ptb_can_unload_user_data(app: Application) -> bool:
+    low, high = _PTB_UNLOAD_VERSIONS
+    return (
+        low <= tuple(PTB_VERSION_INFO[:2]) < high
+        and isinstance(getattr(app, "_user_data", None), dict)
+        and isinstance(getattr(app, "_user_ids_to_be_updated_in_persistence", None), set)
+    )
+
+
+def _ptb_unload_user_data(app: Application, user_id: int) -> bool:
+    """
+    Убрать user_data пользователя из памяти Application. Не трогает тех, кто помечен на запись
+    в persistence: после выгрузки deepcopy(app.user_data[uid]) создал бы через defaultdict
+    пустой dict и затёр им строку в SQLite.
+    """
+    if user_id in app._user_ids_to_be_updated_in_persistence:
+        return False
+    app._user_data.pop(user_id, None)
+    return True
+
+
+class UserStateManager:
+    """
+    Держит резидентное состояние пользователей в рамках памяти:
+    - LRU по последней активности; простаивающие дольше idle_ttl выгружаются из Application
+      (после сброса в SQLite) и при следующем апдейте лениво читаются заново;
+    - сумма крупных bytes (скрины сетапа) ограничена budget: при превышении bytes
+      самых давно активных пользователей уходят файлами в STATE_BLOB_DIR.
+    """
+
+    def __init__(self, idle_ttl: int, budget: int):
+        self.idle_ttl = idle_ttl
+        self.budget = budget
+        self._app: Application | None = None
+        self._persistence: "SQLitePersistence | None" = None
+        self._last_seen: "OrderedDict[int, float]" = OrderedDict()
+        self._blob_bytes: Dict[int, int] = {}
+        self._enforcing = False
+        self._task: asyncio.Task | None = None
+        self._can_unload = False
+        # метрики
+        self.evicted = 0
+        self.spilled = 0
+        self.spilled_bytes = 0
+        self.restored = 0
+
+    def bind(self, app: Application, persistence: "SQLitePersistence") -> None:
+        self._app = app
+        self._persistence = persistence
+        self._can_unload = _ptb_can_unload_user_data(app)
+        if not self._can_unload:
+            logging.warning(f"[user-state] PTB {PTB_VERSION_INFO}: выгрузка простаивающих user_data отключена")
+
+    @staticmethod
+    def _resident_blob_bytes(user_data: dict) -> int:
+        return sum(len(v) for v in dict.values(user_data) if _is_large_blob(v))
+
+    def blob_total(self) -> int:
+        return sum(self._blob_bytes.values())
+
+    # --- учёт ---
+    def touch(self, user_id: int, user_data: dict) -> None:
+        """Вызывается persistence перед каждым апдейтом пользователя."""
+        if isinstance(user_data, UserStateDict):
+            user_data.user_id = user_id
+        self._last_seen[user_id] = time.monotonic()
+        self._last_seen.move_to_end(user_id)
+        self._blob_bytes[user_id] = self._resident_blob_bytes(user_data)
+
+    def on_blob(self, user_id: int, user_data: dict) -> None:
+        self._blob_bytes[user_id] = self._resident_blob_bytes(user_data)
+        if self.blob_total() > self.budget and not self._enforcing:
+            self._enforcing = True
+            asyncio.get_running_loop().create_task(self._enforce_budget())
+
+    # --- бюджет: вытеснение bytes на диск ---
+    async def _enforce_budget(self) -> None:
+        try:
+            for user_id in list(self._last_seen):  # от давно активных к недавним
+                if self.blob_total() <= self.budget:
+                    break
+                if self._blob_bytes.get(user_id):
+                    await self._spill(user_id)
+        except Exception:
+            logging.exception("[user-state] вытеснение на диск не удалось")
+        finally:
+            self._enforcing = False
+
+    async def _spill(self, user_id: int) -> None:
+        user_data = self._app.user_data.get(user_id) if self._app else None
+        if user_data is None:
+            self._blob_bytes.pop(user_id, None)
+            return
+        items = [(key, value) for key, value in dict.items(user_data) if _is_large_blob(value)]
+        names = await asyncio.to_thread(self._write_blobs, user_id, [bytes(v) for _, v in items])
+        for (key, value), name in zip(items, names):
+            if dict.get(user_data, key) is value:  # пока писали, значение могли заменить
+                dict.__setitem__(user_data, key, SpilledBlob(name, len(value)))
+                self._persistence.note_blob(user_id, name)
+                self.spilled += 1
+                self.spilled_bytes += len(value)
+        self._blob_bytes[user_id] = self._resident_blob_bytes(user_data)
+
+    @staticmethod
+    def _write_blobs(user_id: int, values: List[bytes]) -> List[str]:
+        names = []
+        for value in values:
+            name = _state_blob_name(user_id, value)
+            path = STATE_BLOB_DIR / name
+            if not path.exists():
+                tmp = path.with_suffix(".tmp")
+                tmp.write_bytes(value)
+                tmp.replace(path)
+            names.append(name)
+        return names
+
+    # --- простой: выгрузка из памяти ---
+    async def sweep(self) -> int:
+        if not self._app or not self._can_unload:
+            return 0
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = []
+        for user_id, seen in self._last_seen.items():
+            if seen > cutoff:
+                break
+            if not UPDATE_PROCESSOR.busy(user_id):
+                idle.append(user_id)
+        if not idle:
+            return 0
+        # всё несохранённое — в SQLite, иначе выгрузка потеряет изменения
+        await self._app.update_persistence()
+        await self._persistence.flush()
+        evicted = 0
+        for user_id in idle:
+            # пока шёл flush, пользователь мог прислать апдейт — его dict уже в работе у хендлера;
+            # busy() учитывает и хендлеры block=False, которые пишут в user_data после апдейта
+            seen = self._last_seen.get(user_id)
+            if seen is None or seen > cutoff or UPDATE_PROCESSOR.busy(user_id):
+                continue
+            if not _ptb_unload_user_data(self._app, user_id):
+                continue  # хендлер завершился во время flush — запись ещё впереди, выгрузим в следующий раз
+            self._persistence.forget(user_id)
+            self._last_seen.pop(user_id, None)
+            self._blob_bytes.pop(user_id, None)
+            evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL_SEC)
+            try:
+                evicted = await self.sweep()
+                if evicted:
+                    logging.info(f"[user-state] выгружено простаивающих: {evicted}")
+                # pop()/clear() в хендлерах не проходят через __setitem__ — пересчёт раз в цикл
+                for user_id in list(self._blob_bytes):
+                    user_data = self._app.user_data.get(user_id)
+                    self._blob_bytes[user_id] = self._resident_blob_bytes(user_data) if user_data else 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("[user-state] sweep failed")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def resident_bytes(self) -> int:
+        """Грубая оценка памяти под user_data: ключи, строки, bytes (без накладных расходов dict)."""
+        if not self._app:
+            return 0
+        total = 0
+        for user_data in self._app.user_data.values():
+            for key, value in dict.items(user_data):
+                total += sys.getsizeof(key)
+                total += len(value) if isinstance(value, (bytes, bytearray)) else sys.getsizeof(value)
+        return total
+
+    def resident_users(self) -> int:
+        return len(self._app.user_data) if self._app else 0
+
+    def stats_lines(self) -> List[str]:
+        return [
+            f"• user_data в памяти: {self.resident_users()} польз., ≈{self.resident_bytes() / 1024:.0f} КБ "
+            f"(bytes {self.blob_total() / 1024:.0f} КБ из {self.budget / 1024 / 1024:.0f} МБ)",
+            f"  выгружено по простою {self.evicted}, на диск вытеснено {self.spilled} "
+            f"({self.spilled_bytes / 1024:.0f} КБ), прочитано обратно {self.restored}",
+        ]
+
+
+USER_STATE = UserStateManager(STATE_IDLE_TTL_SEC, STATE_BLOB_BUDGET_BYTES)
+GaugeFunc("user_state_resident_users", "Users with user_data held in memory", USER_STATE.resident_users)
+GaugeFunc("user_state_blob_bytes", "Large bytes values resident in user_data", USER_STATE.blob_total)
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    PTB-персистентность только для user_data и conversations (bot_data/chat_data не используются).
+
+    - Ленивая загрузка: get_user_data() отдаёт пустой dict, а данные пользователя читаются из
+      SQLite при первом его апдейте (refresh_user_data). Старт не зависит от числа пользователей.
+    - Dirty tracking: PTB присылает всех «тронутых» пользователей; пишем только тех, у кого
+      сериализованное состояние реально изменилось (сравнение по хешу).
+    - Write-behind: изменения копятся в памяти и уходят одной транзакцией в фоновом потоке.
+    - bytes длиннее STATE_BLOB_INLINE_MAX (скрин сетапа) лежат файлами в STATE_BLOB_DIR,
+      в JSON — только ссылка; осиротевшие файлы удаляются после записи. При загрузке они
+      остаются на диске (SpilledBlob) до первого обращения.
+    """
+
+    _BLOB = "__blob__"
+    _B64 = "__b64__"
+
+    def __init__(self, path: str | Path, blob_dir: Path, update_interval: float = STATE_UPDATE_INTERVAL_SEC):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._lock = threading.Lock()
+        self._db = _sqlite_connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS user_state ("
+            " user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            " name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key))"
+        )
+        self._blob_dir = blob_dir
+        self._blob_dir.mkdir(parents=True, exist_ok=True)
+        self._loaded: set[int] = set()
+        self._digests: Dict[int, bytes] = {}     # user_id -> хеш последнего записанного состояния
+        self._blobs: Dict[int, set] = {}         # user_id -> имена файлов-блобов в записанном состоянии
+        # отложенные записи: user_id -> (json, {имя: bytes}) | None (удалить)
+        self._pending_users: Dict[int, Tuple[str, Dict[str, bytes]] | None] = {}
+        self._pending_convs: Dict[Tuple[str, str], Any] = {}
+        self._flush_task: asyncio.Task | None = None
+        # метрики
+        self.loads = 0
+        self.skipped_clean = 0
+        self.written_users = 0
+        self.batches = 0
+
+    # --- сериализация ---
+    def _encode(self, user_id: int, data: Dict[Any, Any]) -> Tuple[str, Dict[str, bytes | None]]:
+        blobs: Dict[str, bytes | None] = {}
+
+        def _default(value):
+            if isinstance(value, (bytes, bytearray)):
+                value = bytes(value)
+                if len(value) <= STATE_BLOB_INLINE_MAX:
+                    return {self._B64: base64.b64encode(value).decode("ascii")}
+                name = _state_blob_name(user_id, value)
+                blobs[name] = value
+                return {self._BLOB: name}
+            if isinstance(value, SpilledBlob):
+                blobs[value.name] = None  # файл уже на диске
+                return {self._BLOB: value.name}
+            if isinstance(value, (set, frozenset, tuple, deque)):
+                return list(value)
+            raise TypeError(f"user_data: {type(value).__name__} не сериализуется")
+
+        return json.dumps(data, default=_default, ensure_ascii=False, sort_keys=True), blobs
+
+    def _decode(self, raw: str) -> Dict[Any, Any]:
+        def _hook(obj):
+            if len(obj) == 1:
+                if self._B64 in obj:
+                    return base64.b64decode(obj[self._B64])
+                if self._BLOB in obj:
+                    path = self._blob_dir / obj[self._BLOB]
+                    return SpilledBlob(path.name, path.stat().st_size) if path.exists() else None
+            return obj
+
+        return json.loads(raw, object_hook=_hook)
+
+    @staticmethod
+    def _blob_names(raw: str) -> set:
+        return set(re.findall(r'"__blob__": "([^"]+)"', raw))
+
+    # --- чтение ---
+    def _load_user(self, user_id: int) -> Dict[Any, Any] | None:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+        if not row:
+            return None
+        self._digests[user_id] = hashlib.blake2b(row[0].encode(), digest_size=16).digest()
+        self._blobs[user_id] = self._blob_names(row[0])
+        return self._decode(row[0])
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}  # лениво — см. refresh_user_data
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        USER_STATE.touch(user_id, user_data)
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        pending = self._pending_users.get(user_id, False)
+        if pending is not False:
+            return  # данные уже в памяти и ещё не записаны
+        stored = await asyncio.to_thread(self._load_user, user_id)
+        if stored:
+            self.loads += 1
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+        with self._lock:
+            rows = self._db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    # --- запись (копим, пишем пачкой) ---
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        try:
+            raw, blobs = self._encode(user_id, data)
+        except (TypeError, ValueError):
+            logging.exception(f"[state] не удалось сериализовать user_data {user_id}")
+            return
+        digest = hashlib.blake2b(raw.encode(), digest_size=16).digest()
+        if self._digests.get(user_id) == digest:
+            self.skipped_clean += 1
+            return
+        self._digests[user_id] = digest
+        self._pending_users[user_id] = (raw, blobs)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._digests.pop(user_id, None)
+        self._loaded.discard(user_id)
+        self._pending_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: object | None) -> None:
+        self._pending_convs[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    def forget(self, user_id: int) -> None:
+        """user_data выгружен из памяти (USER_STATE) — при следующем апдейте прочитать заново."""
+        self._loaded.discard(user_id)
+
+    def note_blob(self, user_id: int, name: str) -> None:
+        """Файл-блоб создан вне записи состояния (вытеснение) — чтобы потом убрать его как сироту."""
+        self._blobs.setdefault(user_id, set()).add(name)
+
+    def _schedule_flush(self) -> None:
+        # update_persistence собирает всех пользователей одним gather — задача стартует после него
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self) -> None:
+        users, self._pending_users = self._pending_users, {}
+        convs, self._pending_convs = self._pending_convs, {}
+        if users or convs:
+            try:
+                await asyncio.to_thread(self._write, users, convs)
+            except Exception:
+                logging.exception("[state] запись состояния не удалась — повторю со следующей пачкой")
+                for user_id, item in users.items():
+                    self._pending_users.setdefault(user_id, item)
+                for key, state in convs.items():
+                    self._pending_convs.setdefault(key, state)
+
+    def _write(self, users: Dict[int, Tuple[str, Dict[str, bytes]] | None], convs: Dict[Tuple[str, str], Any]) -> None:
+        for item in users.values():
+            for name, value in (item[1] if item else {}).items():
+                path = self._blob_dir / name
+                if value is not None and not path.exists():
+                    tmp = path.with_suffix(".tmp")
+                    tmp.write_bytes(value)
+                    tmp.replace(path)
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for user_id, item in users.items():
+                    if item is None:
+                        self._db.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+                    else:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO user_state (user_id, data, updated) VALUES (?, ?, ?)",
+                            (user_id, item[0], now),
+                        )
+                for (name, key), state in convs.items():
+                    if state is None:
+                        self._db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                    else:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                            (name, key, json.dumps(state)),
+                        )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        self.batches += 1
+        self.written_users += len(users)
+        # старые блобы, на которые больше никто не ссылается
+        for user_id, item in users.items():
+            current = set(item[1]) if item else set()
+            for name in self._blobs.get(user_id, set()) - current:
+                (self._blob_dir / name).unlink(missing_ok=True)
+            self._blobs[user_id] = current
+
+    async def flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self._flush_pending()
+
+    # --- не используется (store_data выключен), но обязательно для BasePersistence ---
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    def stats_lines(self) -> List[str]:
+        return [
+            f"• Состояние пользователей: загружено лениво {self.loads} (из {len(self._loaded)} активных), "
+            f"записано {self.written_users} за {self.batches} пачек, без изменений пропущено {self.skipped_clean}"
+        ]
 
-# ✅ Rate-limit safe append для Sheets
-@retry(wait=wait_fixed(2), stop=stop_after_attempt(5))
-def safe_append_row(row):
-    sheet.append_row(row)
 
-def load_allowed_users():
-    try:
-        records = sheet.get_all_records()
-        logging.info(f"🔄 Загружено {len(records)} строк из Google Sheets.")
-        
-        users = set()
-        for row in records:
-            if "user_id" in row and row["user_id"]:
-                try:
-                    users.add(int(row["user_id"]))
-                except ValueError:
-                    logging.warning(f"⚠️ Не удалось преобразовать user_id: {row['user_id']}")
-        
-        logging.info(f"✅ Загружено {len(users)} пользователей с доступом.")
-        return users
+STATE = SQLitePersistence(STATE_DB, STATE_BLOB_DIR)
 
-    except Exception as e:
-        logging.error(f"❌ Ошибка при загрузке пользователей из Google Sheets: {e}")
-        return set()
 
-MONTHLY_PRICE_USD = 25
-LIFETIME_PRICE_USD = 199
-PAY_CURRENCY = "USDT"
-PAY_NETWORK = "TRC20"
+# =====================[ PAYMENT LEDGER ]=====================
+# Журнал обработанных IPN (анти-дубликаты): SQLite + in-memory индекс ключ -> время.
+# Старые ключи выбрасываются «колесом» часовых корзин — без полного прохода по индексу.
+PAYMENTS_DB = os.getenv("PAYMENTS_DB", str(DATA_DIR / "payments.db"))
+PAYMENT_LEDGER_RETENTION_SEC = int(os.getenv("PAYMENT_LEDGER_RETENTION_SEC", str(180 * 24 * 3600)))
+PAYMENT_LEDGER_BUCKET_SEC = 3600
 
-# 🚀 ALLOWED_USERS с TTL cache (фон)
-ALLOWED_USERS = set()
-ALLOWED_USERS_TIMESTAMP = 0
-_ALLOWED_REFRESHING = False
-_ALLOWED_LOCK = threading.Lock()
 
-def get_allowed_users():
-    """
-    Возвращает кеш авторизованных пользователей.
-    Если TTL (5 мин) истёк — триггерит фоновое обновление из Google Sheets
-    без блокировки async-хендлеров. При неуспехе сохраняет старый кеш.
-    """
-    global ALLOWED_USERS, ALLOWED_USERS_TIMESTAMP, _ALLOWED_REFRESHING
+class PaymentLedger:
+    def __init__(self, path: str | Path, retention_sec: int = PAYMENT_LEDGER_RETENTION_SEC):
+        self._retention = retention_sec
+        self._lock = threading.Lock()
+        self._db = _sqlite_connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS payments ("
+            " key TEXT PRIMARY KEY,"
+            " user_id INTEGER,"
+            " plan TEXT,"
+            " amount TEXT,"
+            " currency TEXT,"
+            " status TEXT NOT NULL,"  # processing | done
+            " created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_payments_created ON payments(created)")
+        self._index: Dict[str, float] = {}
+        self._wheel: Dict[int, List[str]] = {}
+        self._oldest_bucket = int((time.time() - retention_sec) // PAYMENT_LEDGER_BUCKET_SEC)
+        self._stale: set[str] = set()  # 'processing' от прошлого запуска — можно взять повторно
+        cutoff = time.time() - retention_sec
+        for key, created, status in self._db.execute(
+            "SELECT key, created, status FROM payments WHERE created >= ?", (cutoff,)
+        ):
+            self._index_add(key, created)
+            if status != "done":
+                self._stale.add(key)
+
+    def _index_add(self, key: str, created: float) -> None:
+        self._index[key] = created
+        self._wheel.setdefault(int(created // PAYMENT_LEDGER_BUCKET_SEC), []).append(key)
+
+    def _expire_locked(self, now: float) -> None:
+        """Снимает с колеса корзины, целиком вышедшие за retention (амортизированно O(1))."""
+        last_expired = int((now - self._retention) // PAYMENT_LEDGER_BUCKET_SEC) - 1
+        if last_expired < self._oldest_bucket:
+            return
+        for bucket in range(self._oldest_bucket, last_expired + 1):
+            for key in self._wheel.pop(bucket, ()):
+                if int(self._index.get(key, -1) // PAYMENT_LEDGER_BUCKET_SEC) == bucket:
+                    self._index.pop(key, None)
+                    self._stale.discard(key)
+        self._db.execute(
+            "DELETE FROM payments WHERE created < ?", ((last_expired + 1) * PAYMENT_LEDGER_BUCKET_SEC,)
+        )
+        self._oldest_bucket = last_expired + 1
 
-    now = time.time()
-    ttl_expired = (now - ALLOWED_USERS_TIMESTAMP) > 300
+    def __contains__(self, key: str) -> bool:
+        return key in self._index and key not in self._stale
 
-    if ttl_expired and not _ALLOWED_REFRESHING:
-        # Ставим флаг ДО старта потока, чтобы не запустить несколько раз подряд
-        _ALLOWED_REFRESHING = True
+    def claim(self, key: str, user_id: int | None = None, plan: str = "", amount: Any = "", currency: str = "") -> bool:
+        """
+        Атомарно «занимает» платёж. False — ключ уже обработан/обрабатывается (дубликат IPN).
+        Незавершённая (processing) запись от прошлого запуска считается не обработанной.
+        """
+        now = time.time()
+        with self._lock:
+            self._expire_locked(now)
+            if key in self._index and key not in self._stale:
+                return False
+            self._db.execute(
+                "INSERT OR REPLACE INTO payments (key, user_id, plan, amount, currency, status, created)"
+                " VALUES (?, ?, ?, ?, ?, 'processing', ?)",
+                (key, user_id, plan, str(amount), currency, now),
+            )
+            self._stale.discard(key)
+            self._index_add(key, now)
+        return True
 
-        def _refresh():
-            global ALLOWED_USERS, ALLOWED_USERS_TIMESTAMP, _ALLOWED_REFRESHING
-            try:
-                updated = load_allowed_users()
-                # Обновляем кеш и TTL только при успешной загрузке
-                if updated:
-                    with _ALLOWED_LOCK:
-                        ALLOWED_USERS = updated
-                        ALLOWED_USERS_TIMESTAMP = time.time()
-            except Exception:
-                logging.exception("[get_allowed_users] refresh failed")
-            finally:
-                _ALLOWED_REFRESHING = False
+    def complete(self, key: str) -> None:
+        with self._lock:
+            self._db.execute("UPDATE payments SET status = 'done' WHERE key = ?", (key,))
 
-        threading.Thread(target=_refresh, daemon=True).start()
+    def release(self, key: str) -> None:
+        """Снимает захват, если обработка не удалась — повторная доставка IPN пройдёт заново."""
+        with self._lock:
+            self._db.execute("DELETE FROM payments WHERE key = ?", (key,))
+            self._index.pop(key, None)
+            self._stale.discard(key)
 
-    return ALLOWED_USERS
+
+PAYMENT_LEDGER = PaymentLedger(PAYMENTS_DB)
 
 
 TON_WALLET = "UQC4nBKWF5sO2UIP9sKl3JZqmmRlsGC5B7xM7ArruA61nTGR"
@@ -517,14 +2251,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     try:
-        with open(VIDEO_PATH, "rb") as anim:
-            await context.bot.send_animation(
+        # Видео загружается в Telegram один раз, дальше уходит по file_id
+        await MEDIA.send(
+            VIDEO_PATH, "animation",
+            lambda anim: context.bot.send_animation(
                 chat_id=chat_id,
                 animation=anim,
                 caption=caption,
                 parse_mode="Markdown",
                 reply_markup=REPLY_MARKUP
-            )
+            ),
+        )
     except Exception as e:
         logging.warning(f"[start] send_animation failed, fallback to text. err={e}")
         await update.message.reply_text(
@@ -535,12 +2272,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return ConversationHandler.END
 
+@traced_update("update.callback")
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
     data = query.data
     msg = query.message
+    TRACER.annotate(callback=data)
 
     logging.info(f"[button_handler] Пользователь {user_id} нажал кнопку: {data}")
 
@@ -785,15 +2524,11 @@ async def grant(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_username = raw_username.lstrip("@").strip()
 
     try:
-        # Добавляем доступ локально
-        ALLOWED_USERS.add(target_user_id)
+        # Выдаём доступ в локальном хранилище (источник правды)
+        await asyncio.to_thread(ENTITLEMENTS.grant, target_user_id, target_username, "lifetime", "admin")
 
-        # Обновляем метку TTL, чтобы кеш не перезатёрся до фонового обновления
-        global ALLOWED_USERS_TIMESTAMP
-        ALLOWED_USERS_TIMESTAMP = time.time()
-
-        # Запись в Google Sheets — уводим в тред‑пул (не блокируем event loop)
-        await asyncio.to_thread(log_payment, target_user_id, target_username)
+        # Зеркало в Google Sheets — через очередь записи (повтор того же апдейта не задублирует строку)
+        await asyncio.to_thread(log_payment, target_user_id, target_username, f"grant:{update.update_id}")
 
         # Уведомляем пользователя о выдаче доступа
         await notify_user_payment(target_user_id)
@@ -816,16 +2551,11 @@ async def reload_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        updated = await asyncio.to_thread(load_allowed_users)
-        if not updated:
-            await update.message.reply_text("⚠️ Sheets вернул пусто. Кеш ALLOWED_USERS оставлен без изменений.")
-            return
-
-        global ALLOWED_USERS, ALLOWED_USERS_TIMESTAMP
-        with _ALLOWED_LOCK:
-            ALLOWED_USERS = updated
-            ALLOWED_USERS_TIMESTAMP = time.time()
-        await update.message.reply_text(f"✅ ALLOWED_USERS обновлён: {len(ALLOWED_USERS)} пользователей.")
+        before = len(ENTITLEMENTS)
+        added = await asyncio.to_thread(sync_entitlements_from_sheet, True)
+        await update.message.reply_text(
+            f"✅ Импорт из Sheets: +{added} новых. Активных доступов: {len(ENTITLEMENTS)} (было {before})."
+        )
     except Exception as e:
         logging.error(f"[reload_users] Ошибка: {e}")
         await update.message.reply_text(f"❌ Ошибка при обновлении пользователей.")
@@ -838,59 +2568,46 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id if update and update.effective_user else None
     msg = update.effective_message
 
-    # 1) Достаём file_id из фото или документа-изображения
-    file_id = None
-    if getattr(msg, "photo", None):
-        file_id = msg.photo[-1].file_id
-    elif getattr(msg, "document", None):
-        doc = msg.document
-        if (doc.mime_type or "").startswith("image/"):
-            file_id = doc.file_id
-        else:
-            await msg.reply_text("⚠️ Пришли график как фото или как документ-картинку (PNG/JPG). PDF не поддерживается.")
-            return
-    else:
-        await msg.reply_text("⚠️ Не вижу изображения. Пришли как фото или документ-картинку (PNG/JPG).")
+    # 1) Сначала рынок — без него скачивать и готовить картинку бессмысленно
+    selected_market = context.user_data.get("selected_market")
+    if not selected_market:
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("💎 Crypto", callback_data="market_crypto")],
+            [InlineKeyboardButton("💱 Forex", callback_data="market_forex")],
+        ])
+        await msg.reply_text(
+            "📝 Сначала выбери рынок — нажми одну из кнопок ниже, чтобы я знал, какой анализ тебе нужен:",
+            reply_markup=keyboard
+        )
+        return
+
+    doc = getattr(msg, "document", None)
+    if doc and not _is_image_document(doc):
+        await msg.reply_text("⚠️ Пришли график как фото или как документ-картинку (PNG/JPG). PDF не поддерживается.")
         return
 
     # 2) Скачиваем изображение безопасно
     try:
-        tg_file = await context.bot.get_file(file_id)
-        bio = BytesIO()
-        await tg_file.download_to_memory(bio)
+        bio = await _extract_image_bytes(update, context)
     except Exception:
         logging.exception("[handle_photo] download error")
         await msg.reply_text("⚠️ Не удалось скачать изображение. Пришли поменьше или повтори ещё раз.")
         return
+    if bio is None:
+        await msg.reply_text("⚠️ Не вижу изображения. Пришли как фото или документ-картинку (PNG/JPG).")
+        return
 
-    # 3) Готовим JPEG и base64 для Vision
+    # 3) Готовим JPEG и base64 для Vision (в пуле потоков)
     try:
-        image = Image.open(BytesIO(bio.getvalue())).convert("RGB")
+        prepared = await prepare_image(bio)
     except Exception:
         await msg.reply_text("⚠️ Не удалось прочитать изображение. Пришли скрин в формате PNG/JPG.")
         return
 
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG", quality=80)
-    image_base64 = base64.b64encode(buffer.getvalue()).decode()
-
-    # 4) Проверяем выбранный рынок
-    selected_market = context.user_data.get("selected_market")
-    if not selected_market:
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💎 Crypto", callback_data="market_crypto")],
-            [InlineKeyboardButton("💱 Forex", callback_data="market_forex")],
-        ])
-        await msg.reply_text(
-            "📝 Сначала выбери рынок — нажми одну из кнопок ниже, чтобы я знал, какой анализ тебе нужен:",
-            reply_markup=keyboard
-        )
-        return
-
     # флаг pro (оставляем как есть; может использоваться в других ветках)
     use_pro = context.user_data.get("is_pro_user") is True and user_id == 407721399  # noqa: F841
 
-    # 5) Промпт без изменений
+    # 4) Промпт без изменений
     prompt_text = (
         f"You are a professional SMC (Smart Money Concepts) trader with 20+ years experience in "
         f"{'crypto' if selected_market == 'crypto' else 'forex'} markets. "
@@ -906,39 +2623,66 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "3️⃣ Risk Note\n4️⃣ Bias: BUY or SELL\n"
         "✅ End with 2-line Russian summary with emojis (e.g. «Покупка от дисконта 💸📈»)\n\n"
         "📌 Важно: если вход идёт ПРОТИВ текущего тренда (например, SELL в восходящем канале), обязательно объясни, почему он оправдан.\n\n"
-        "🚫 Rules:\n- Answer in Russian only\n- No markdown\n- No refusal\n- No apologies"
+        "🚫 Rules:\n- Answer in Russian only\n- No markdown\n- No refusal\n- No apologies\n\n"
+        "🧾 Output: JSON per the provided schema. Put the whole formatted Russian answer above into "
+        "\"analysis\"; copy the plan levels as plain numbers into \"entry\", \"stop\", \"take_profits\", "
+        "the bias into \"bias\" and the chart's trading pair (e.g. BTCUSDT) into \"symbol\" — null if the "
+        "pair is not visible on the chart."
     )
 
-    # 6) Запрос к Vision (с повтором при «извиняюсь/не могу»)
-    analysis = ""
-    for attempt in range(2):
+    # 5) Запрос к Vision (structured output; повтор только при отказе); повторный скрин — из кеша
+    notify = _queue_notifier(msg)
+    cache_key = VISION_CACHE.make_key("smc", prepared.digest, selected_market, SMC_PROMPT_VERSION)
+    raw = await VISION_CACHE.aget(cache_key, "smc", prepared.phash) or ""
+    from_cache = bool(raw)
+    if from_cache:
+        logging.info(f"[handle_photo] vision cache hit user={user_id}")
+    with TRACER.span("parse"):
+        structured = plan_from_json(raw)
+    for attempt in range(0 if from_cache else 2):
         try:
             enhanced_prompt = prompt_text
             if attempt == 1:
+                STRUCTURED_STATS.retry("smc")
+                VISION_RETRIES.inc()
                 enhanced_prompt += (
                     "\n\n🚨 STRICT ORDER: Даже если график тёмный, малоконтрастный, с шумом или без чёткой структуры — "
                     "ты обязан выдать Entry, StopLoss и TakeProfit. Не отказывайся. "
                     "Если мало данных — оцени по свечам, структуре и зонам. Торговый план ОБЯЗАТЕЛЕН."
                 )
 
-            analysis = await ask_gpt_vision(enhanced_prompt, image_base64)
-            logging.info(f"[handle_photo attempt {attempt}] Raw GPT analysis:\n{analysis}")
+            raw = await ask_gpt_vision(
+                enhanced_prompt, prepared.b64, mime=prepared.mime, user_id=user_id, notify=notify,
+                response_format=SMC_RESPONSE_FORMAT,
+            )
+            logging.info(f"[handle_photo attempt {attempt}] Raw GPT analysis:\n{raw}")
+            with TRACER.span("parse"):
+                structured = plan_from_json(raw)
 
-            if not analysis:
-                await asyncio.sleep(0.5)
-                continue
+            if not raw:
+                # сетевые ошибки/429 уже переповторены в openai_chat с бэкоффом — второй круг не нужен
+                break
 
-            low = analysis.lower()
+            low = (structured.analysis if structured else raw).lower()
             if "sorry" in low or "can't assist" in low or "cannot" in low or "unable" in low:
                 continue
             break
         except Exception as e:
             logging.error(f"[handle_photo retry {attempt}] GPT Vision error: {e}")
+            break
+
+    analysis = structured.analysis if structured else raw
+    if structured:
+        STRUCTURED_STATS.ok("smc")
+    elif raw and not _is_refusal(raw):
+        STRUCTURED_STATS.fallback("smc")
+    if raw and not from_cache and not _is_refusal(analysis):
+        await VISION_CACHE.aput(cache_key, raw, prepared.phash)
 
     if not analysis:
         analysis = _fallback_strategy()
 
-    # 7) Лёгкий пост-процессинг ответа (без изменения смысла промпта)
+    # 6) Лёгкий пост-процессинг ответа (без изменения смысла промпта)
     lines = [ln for ln in (analysis or "").splitlines() if ln.strip()]
     lines = [ln for ln in lines if "Краткий план не сформирован" not in ln]
     lines = [ln for ln in lines if not ln.startswith("📈 Направление сделки")]
@@ -949,32 +2693,16 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- Не отправляем analysis отдельным сообщением, чтобы не было дублей ---
 
-    def parse_price(raw_text: str | None):
-        if not raw_text:
-            return None
-        try:
-            cleaned = (
-                raw_text.replace(" ", "")
-                        .replace("\u00A0", "")
-                        .replace(",", "")
-                        .replace("$", "")
-                        .replace("—", "-")
-            )
-            return float(cleaned)
-        except Exception:
-            return None
-
-    entry_match = re.search(r'(Entry|Вход)[:\s]*\$?\s*([\d\s,.]+)', analysis, flags=re.IGNORECASE) \
-        or re.search(r'🎯[:\s]*\$?\s*([\d\s,.]+)', analysis)
-    stop_match = re.search(r'(StopLoss|Стоп)[:\s]*\$?\s*([\d\s,.]+)', analysis, flags=re.IGNORECASE) \
-        or re.search(r'🚨[:\s]*\$?\s*([\d\s,.]+)', analysis)
-    tp_match = re.search(r'(TakeProfit|Тейк)[:\s]*\$?\s*([\d\s,.]+)', analysis, flags=re.IGNORECASE) \
-        or re.search(r'💰[:\s]*\$?\s*([\d\s,.]+)', analysis)
-    bias_match = re.search(r'\b(BUY|SELL|ПОКУПКА|ПРОДАЖА)\b', analysis, flags=re.IGNORECASE)
-
-    entry = parse_price(entry_match.group(2) if entry_match and entry_match.lastindex == 2 else (entry_match.group(1) if entry_match else None))
-    stop = parse_price(stop_match.group(2) if stop_match and stop_match.lastindex == 2 else (stop_match.group(1) if stop_match else None))
-    tp = parse_price(tp_match.group(2) if tp_match and tp_match.lastindex == 2 else (tp_match.group(1) if tp_match else None))
+    # Уровни — из полей схемы; если JSON не разобрался или в нём нет входа/стопа
+    # (модель оставила null, а уровни написала в analysis) — разбор текста
+    if structured and structured.entry is not None and structured.stop is not None:
+        plan = structured
+    else:
+        with TRACER.span("parse", fallback=True):
+            plan = extract_trade_plan(analysis)
+        if structured and not plan.bias:
+            plan.bias = structured.bias
+    entry, stop, tp = plan.entry, plan.stop, plan.tp
 
     if entry and stop:
         if entry != 0:
@@ -996,7 +2724,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
 
-    bias_line = f"📈 Направление сделки: {bias_match.group(1).upper()}" if bias_match else ""
+    bias_line = f"📈 Направление сделки: {plan.bias}" if plan.bias else ""
 
     if entry and stop and tp:
         tldr = f"✅ TL;DR: Вход {entry}, стоп {stop}, тейк {tp}."
@@ -1016,6 +2744,18 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         full_message += f"\n{bias_line}"
     full_message += f"\n\n{tldr}"
 
+    # 🔔 Для крипты ставим алерты на уровни плана — только по паре из поля symbol. Из текста не угадываем:
+    # «доминация BTC» в разборе ETH повесила бы уровни ETH на BTCUSDT.
+    symbol = structured.symbol if structured else None
+    pair = symbol_pair(symbol) if selected_market == "crypto" and entry and user_id else None
+    if pair:
+        try:
+            levels = {"entry": [entry], "stop": [stop] if stop else [], "tp": [tp] if tp else []}
+            if ALERTS.add_plan(msg.chat_id, pair, levels):
+                full_message += f"\n🔔 Сообщу, когда {pair} коснётся входа, стопа или тейка."
+        except Exception:
+            logging.exception("[handle_photo] alert registration failed")
+
     # Используем msg.reply_text (а не update.message) — это устойчиво для фото и документов
     await msg.reply_text(full_message, reply_markup=keyboard)
 
@@ -1080,50 +2820,1150 @@ async def setup_set_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"⚡️ Твоя Точка Входа"
     )
 
-    # 🔗 В канале используем дип-линк в ЛС вместо callback
-    try:
-        bot_me = await context.bot.get_me()
-    except Exception:
-        bot_me = None
-    bot_username = (os.getenv("BOT_USERNAME") or (bot_me.username if bot_me else "") or "").lstrip("@")
+    # 🔗 В канале используем дип-линк в ЛС вместо callback
+    try:
+        bot_me = await context.bot.get_me()
+    except Exception:
+        bot_me = None
+    bot_username = (os.getenv("BOT_USERNAME") or (bot_me.username if bot_me else "") or "").lstrip("@")
+
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📏 Калькулятор", url=f"https://t.me/{bot_username}?start=calc")]
+    ])
+
+    # Достаём сохранённое изображение и публикуем
+    try:
+        image_stream = BytesIO(context.user_data["setup_image_bytes"])
+        await context.bot.send_photo(
+            chat_id=VIP_CHANNEL_ID,
+            photo=image_stream,
+            caption=caption,
+            parse_mode="HTML",
+            reply_markup=keyboard
+        )
+        await update.message.reply_text("✅ Сетап опубликован в приватный канал.")
+
+        # 🔔 Алерты получателям сетапа (VIP) и автору на касание входа/стопа/целей (только для криптопар)
+        pair = guess_crypto_pair(instrument)
+        if pair:
+            try:
+                levels = {"entry": parse_levels(entry)[:1], "stop": parse_levels(stoploss)[:1], "tp": parse_levels(targets)}
+                recipients = sorted(get_allowed_users() | {update.effective_chat.id})
+                if await ALERTS.add_setup(recipients, pair, levels):
+                    await update.message.reply_text(
+                        f"🔔 Алерты по уровням {pair} включены для {len(recipients)} получателей."
+                    )
+            except Exception:
+                logging.exception("[setup_set_entry] alert registration failed")
+    except Exception as e:
+        logging.error(f"[setup_set_entry] Ошибка публикации: {e}")
+        await update.message.reply_text("⚠️ Не удалось опубликовать сетап.")
+    finally:
+        context.user_data.clear()
+
+    return ConversationHandler.END
+
+# =====================[ PRICE SERVICE ]=====================
+# Цены Binance: общий keep-alive пул httpx, TTL-кэш по символу, один запрос «в полёте»
+# на символ и пакетная дозагрузка через ?symbols=[...]. Для локальной проверки можно
+# направить сервис на заглушку tools/binance_stub.py через BINANCE_API_URL.
+BINANCE_API_URL = os.getenv("BINANCE_API_URL", "https://api.binance.com").rstrip("/")
+PRICE_TTL_SEC = float(os.getenv("PRICE_TTL_SEC", "5"))
+PRICE_QUOTES = ("USDT", "USDC", "FDUSD", "BUSD", "BTC", "ETH")
+
+
+class PriceService:
+    def __init__(self, base_url: str = BINANCE_API_URL, ttl: float = PRICE_TTL_SEC):
+        self._base_url = base_url
+        self._ttl = ttl
+        self._client: httpx.AsyncClient | None = None
+        self._cache: Dict[str, Tuple[float, float]] = {}  # pair -> (price, ts)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.feed: "PriceFeed | None" = None
+        self.hits = 0
+        self.coalesced = 0
+        self.requests = 0
+        self.errors = 0
+
+    @staticmethod
+    def pair(symbol: str) -> str:
+        """'btc' / 'BTC/USDT' / 'btc-usdt' → 'BTCUSDT'."""
+        s = re.sub(r"[^A-Z0-9]", "", (symbol or "").upper())
+        return s if s.endswith(PRICE_QUOTES) and len(s) > 4 else s + "USDT"
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self._base_url,
+                timeout=httpx.Timeout(5.0, connect=3.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+            )
+        return self._client
+
+    def cached(self, symbol: str) -> float | None:
+        hit = self._cache.get(self.pair(symbol))
+        if hit and time.monotonic() - hit[1] < self._ttl:
+            return hit[0]
+        return None
+
+    async def get(self, symbol: str) -> float | None:
+        return (await self.get_many([symbol])).get(symbol)
+
+    async def get_many(self, symbols: List[str]) -> Dict[str, float | None]:
+        """Цены для нескольких символов: кэш → чужие запросы «в полёте» → один пакетный запрос."""
+        now = time.monotonic()
+        pairs = {sym: self.pair(sym) for sym in symbols}
+        waiting: Dict[str, asyncio.Future] = {}
+        to_fetch: List[str] = []
+        for pair in dict.fromkeys(pairs.values()):
+            live = self.feed.last_price(pair, self._ttl) if self.feed is not None else None
+            if live is not None:
+                self._cache[pair] = (live, now)
+            hit = self._cache.get(pair)
+            if hit and now - hit[1] < self._ttl:
+                self.hits += 1
+                PRICE_CACHE_HIT.inc()
+                continue
+            PRICE_CACHE_MISS.inc()
+            if pair in self._inflight:
+                self.coalesced += 1
+                waiting[pair] = self._inflight[pair]
+            else:
+                fut = asyncio.get_running_loop().create_future()
+                self._inflight[pair] = waiting[pair] = fut
+                to_fetch.append(pair)
+
+        if to_fetch:
+            fetched: Dict[str, float] = {}
+            try:
+                fetched = await self._fetch(to_fetch)
+            except Exception as e:
+                self.errors += 1
+                logging.warning(f"[PRICE] Ошибка получения цен {to_fetch}: {e}")
+            finally:
+                # и при отмене вызывающего: иначе чужие get() навсегда повиснут на этих future
+                ts = time.monotonic()
+                for pair in to_fetch:
+                    price = fetched.get(pair)
+                    if price is not None:
+                        self._cache[pair] = (price, ts)
+                    fut = self._inflight.pop(pair, None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(price)
+
+        prices: Dict[str, float | None] = {}
+        for sym, pair in pairs.items():
+            if pair in waiting:
+                prices[sym] = await asyncio.shield(waiting[pair])
+            else:
+                prices[sym] = self._cache[pair][0]
+        return prices
+
+    async def _fetch(self, pairs: List[str]) -> Dict[str, float]:
+        self.requests += 1
+        if len(pairs) == 1:
+            resp = await self._http().get("/api/v3/ticker/price", params={"symbol": pairs[0]})
+        else:
+            resp = await self._http().get(
+                "/api/v3/ticker/price", params={"symbols": json.dumps(pairs, separators=(",", ":"))}
+            )
+        if resp.status_code == 400 and len(pairs) > 1:
+            # Один неизвестный символ валит весь пакет — добираем по одному
+            parts = await asyncio.gather(*(self._fetch([p]) for p in pairs), return_exceptions=True)
+            return {k: v for part in parts if isinstance(part, dict) for k, v in part.items()}
+        if resp.status_code == 400:
+            return {}
+        resp.raise_for_status()
+        data = resp.json()
+        rows = data if isinstance(data, list) else [data]
+        return {row["symbol"]: float(row["price"]) for row in rows}
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats_lines(self) -> List[str]:
+        return [
+            f"• Цены: в кэше {len(self._cache)}, hit {self.hits}, склеено {self.coalesced}, "
+            f"запросов {self.requests}, ошибок {self.errors}"
+        ]
+
+
+PRICES = PriceService()
+
+
+# =====================[ PRICE FEED ]=====================
+# Необязательный фоновый поток тиков (PRICE_FEED_ENABLED=1): по подписанным символам держим
+# стрим и складываем тики в кольцевые буферы array('d'). Хендлеры читают последнюю цену и
+# диапазон за окно без сетевых запросов. Транспорт подменяемый: Binance WebSocket
+# (PRICE_FEED_WS_URL — можно направить на локальный replay-сервер) или replay из JSONL.
+PRICE_FEED_ENABLED = os.getenv("PRICE_FEED_ENABLED", "0") == "1"
+PRICE_FEED_WS_URL = os.getenv("PRICE_FEED_WS_URL", "wss://stream.binance.com:9443/stream")
+PRICE_FEED_REPLAY_FILE = os.getenv("PRICE_FEED_REPLAY_FILE", "").strip()
+PRICE_FEED_SYMBOLS = [x for x in os.getenv("PRICE_FEED_SYMBOLS", "BTC,ETH").split(",") if x.strip()]
+PRICE_FEED_RING_SIZE = int(os.getenv("PRICE_FEED_RING_SIZE", "4096"))
+PRICE_FEED_MAX_SYMBOLS = 200
+
+
+class TickRing:
+    """Кольцевой буфер тиков одного символа: два array('d') (время, цена) фиксированного размера."""
+
+    __slots__ = ("_ts", "_px", "_size", "_head", "count")
+
+    def __init__(self, size: int = PRICE_FEED_RING_SIZE):
+        self._size = size
+        self._ts = array("d", bytes(8 * size))
+        self._px = array("d", bytes(8 * size))
+        self._head = 0  # куда писать следующий тик
+        self.count = 0
+
+    def append(self, ts: float, price: float) -> None:
+        self._ts[self._head] = ts
+        self._px[self._head] = price
+        self._head = (self._head + 1) % self._size
+        if self.count < self._size:
+            self.count += 1
+
+    def last(self) -> Tuple[float, float] | None:
+        if not self.count:
+            return None
+        i = (self._head - 1) % self._size
+        return self._ts[i], self._px[i]
+
+    def range(self, window_sec: float, now: float | None = None) -> Tuple[float, float] | None:
+        """(min, max) цены за последние window_sec секунд; идём от свежих тиков назад."""
+        if not self.count:
+            return None
+        since = (time.time() if now is None else now) - window_sec
+        lo, hi = float("inf"), float("-inf")
+        i = self._head
+        for _ in range(self.count):
+            i = (i - 1) % self._size
+            if self._ts[i] < since:
+                break
+            px = self._px[i]
+            lo = px if px < lo else lo
+            hi = px if px > hi else hi
+        return (lo, hi) if hi >= lo else None
+
+
+class BinanceStreamTransport:
+    """Combined-stream Binance (aggTrade); новые символы добавляются через SUBSCRIBE без переподключения."""
+
+    def __init__(self, url: str = PRICE_FEED_WS_URL):
+        self.url = url
+        self._ws = None
+        self._req_id = 0
+
+    async def subscribe(self, pairs: List[str]) -> None:
+        if self._ws is not None and not self._ws.closed and pairs:
+            self._req_id += 1
+            await self._ws.send_json(
+                {"method": "SUBSCRIBE", "params": [f"{p.lower()}@aggTrade" for p in pairs], "id": self._req_id}
+            )
+
+    async def run(self, feed: "PriceFeed") -> None:
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.url, heartbeat=30) as ws:
+                self._ws = ws
+                try:
+                    await self.subscribe(sorted(feed.pairs))
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            if msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                                break
+                            continue
+                        data = json.loads(msg.data)
+                        tick = data.get("data", data)
+                        if "s" in tick and "p" in tick:
+                            feed.on_tick(tick["s"], float(tick["p"]), tick.get("T", time.time() * 1000) / 1000)
+                finally:
+                    self._ws = None
+
+
+class ReplayTransport:
+    """Проигрывает тики из JSONL ({"s": "BTCUSDT", "p": "65000.1", "T": ms}) — для локальных прогонов."""
+
+    def __init__(self, path: str | Path, speed: float = 0.0):
+        self.path = Path(path)
+        self.speed = speed  # 0 — максимально быстро, 1 — в реальном времени
+
+    async def subscribe(self, pairs: List[str]) -> None:
+        pass
+
+    async def run(self, feed: "PriceFeed") -> None:
+        prev_t = None
+        with self.path.open("r", encoding="utf-8") as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                tick = json.loads(line)
+                t = tick.get("T", time.time() * 1000) / 1000
+                if self.speed and prev_t is not None and t > prev_t:
+                    await asyncio.sleep((t - prev_t) / self.speed)
+                prev_t = t
+                if tick["s"] in feed.pairs:
+                    feed.on_tick(tick["s"], float(tick["p"]), t)
+                else:
+                    await asyncio.sleep(0)
+        feed.replay_done = True
+
+
+class PriceFeed:
+    def __init__(self, transport, ring_size: int = PRICE_FEED_RING_SIZE):
+        self.transport = transport
+        self._ring_size = ring_size
+        self.rings: Dict[str, TickRing] = {}
+        self.pairs: set[str] = set()
+        self._task: asyncio.Task | None = None
+        self.ticks = 0
+        self.reconnects = 0
+        self.replay_done = False
+        self._listeners: List[Callable[[str, float, float], None]] = []
+
+    def add_listener(self, fn: Callable[[str, float, float], None]) -> None:
+        """fn(pair, price, ts) вызывается синхронно на каждый тик (должна быть быстрой)."""
+        self._listeners.append(fn)
+
+    def subscribe(self, symbol: str) -> str:
+        pair = PriceService.pair(symbol)
+        if pair not in self.pairs and len(self.pairs) < PRICE_FEED_MAX_SYMBOLS:
+            self.pairs.add(pair)
+            self.rings[pair] = TickRing(self._ring_size)
+            if self._task is not None:
+                asyncio.get_running_loop().create_task(self.transport.subscribe([pair]))
+        return pair
+
+    def on_tick(self, pair: str, price: float, ts: float) -> None:
+        ring = self.rings.get(pair)
+        if ring is None:
+            return
+        ring.append(ts, price)
+        self.ticks += 1
+        for fn in self._listeners:
+            try:
+                fn(pair, price, ts)
+            except Exception:
+                logging.exception("[PriceFeed] listener failed")
+
+    def last_price(self, symbol: str, max_age: float | None = None) -> float | None:
+        ring = self.rings.get(PriceService.pair(symbol))
+        last = ring.last() if ring else None
+        if last is None or (max_age is not None and time.time() - last[0] > max_age):
+            return None
+        return last[1]
+
+    def price_range(self, symbol: str, window_sec: float) -> Tuple[float, float] | None:
+        ring = self.rings.get(PriceService.pair(symbol))
+        return ring.range(window_sec) if ring else None
+
+    async def _run(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                await self.transport.run(self)
+                if isinstance(self.transport, ReplayTransport):
+                    return
+                delay = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"[PriceFeed] стрим оборвался: {e}; переподключение через {delay:.0f}с")
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(60.0, delay * 2)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats_lines(self) -> List[str]:
+        if not self._task:
+            return []
+        return [f"• Стрим цен: символов {len(self.pairs)}, тиков {self.ticks}, переподключений {self.reconnects}"]
+
+
+PRICE_FEED = PriceFeed(
+    ReplayTransport(PRICE_FEED_REPLAY_FILE) if PRICE_FEED_REPLAY_FILE else BinanceStreamTransport()
+)
+for _sym in PRICE_FEED_SYMBOLS:
+    PRICE_FEED.subscribe(_sym)
+# Свежий тик из стрима отвечает на запрос цены без REST
+PRICES.feed = PRICE_FEED
+
+
+# =====================[ PRICE ALERTS ]=====================
+# Уровни из планов (вход/стоп/тейк) хранятся в SQLite и в памяти — по отсортированному массиву
+# цен на символ. Тик (prev → cur) находит задетые уровни двумя bisect: O(log n + hits).
+# Цены берутся из PRICE_FEED; если стрим выключен — опрос PRICES раз в ALERT_POLL_SEC.
+ALERTS_DB = os.getenv("ALERTS_DB", str(DATA_DIR / "alerts.db"))
+ALERT_TTL_SEC = int(os.getenv("ALERT_TTL_SEC", str(7 * 24 * 3600)))
+ALERT_POLL_SEC = float(os.getenv("ALERT_POLL_SEC", "15"))
+ALERT_LABELS = {"entry": "🎯 вход", "stop": "🚨 стоп", "tp": "💰 тейк"}
+
+# Только «символ»: в базе есть буква, котировка — слитно или через / или - ('BTCUSDT', 'ETH / USDT',
+# '1INCHUSDT'). Сумма «65000 USDT» или слово «IN USDT» парой не считаются.
+_PAIR_RE = re.compile(r"\b((?=[A-Z0-9]*[A-Z])[A-Z0-9]{2,10})(?:\s*[/\-]\s*)?(USDT|USDC|BUSD)\b")
+_COIN_RE = re.compile(
+    r"\b(BTC|ETH|SOL|BNB|XRP|ADA|DOGE|TON|AVAX|LINK|DOT|LTC|TRX|SUI|PEPE|NEAR|APT|ARB|OP|ATOM)\b"
+)
+_NUMBER_RE = re.compile(r"(?<![A-Za-z\d.,])\d+(?:[ \u00A0]\d{3}(?!\d))*(?:[.,]\d+)?")
+
+
+def guess_crypto_pair(text: str) -> str | None:
+    """Пытается найти торговую пару в тексте ('BTC/USDT', 'ETHUSDT', 'SOL') → 'BTCUSDT'."""
+    up = (text or "").upper()
+    m = _PAIR_RE.search(up) or _COIN_RE.search(up)
+    return PriceService.pair(m.group(1)) if m else None
+
+
+def symbol_pair(symbol: str | None) -> str | None:
+    """
+    Явная пара из поля symbol ('ETH/USDT', 'BINANCE:ETHUSDT', 'ETHUSDT.P') → 'ETHUSDT';
+    голый тикер или форекс → None.
+    """
+    ticker = (symbol or "").upper().rsplit(":", 1)[-1].split(".", 1)[0]  # без биржи и суффикса .P
+    compact = re.sub(r"[^A-Z0-9]", "", ticker)
+    m = _PAIR_RE.fullmatch(compact)
+    return PriceService.pair(m.group(1)) if m else None
+
+
+def parse_levels(text: str) -> List[float]:
+    """Все положительные числа из строки уровня ('3500, 3620' → [3500.0, 3620.0])."""
+    out = []
+    for raw in _NUMBER_RE.findall(text or ""):
+        try:
+            v = float(raw.replace(" ", "").replace("\u00A0", "").replace(",", "."))
+        except ValueError:
+            continue
+        if v > 0:
+            out.append(v)
+    return out
+
+
+@dataclass
+class PriceAlert:
+    id: int
+    plan_id: str
+    chat_id: int
+    pair: str
+    kind: str  # entry | stop | tp
+    price: float
+    expires: float
+
+
+class _LevelIndex:
+    """Отсортированные уровни одного символа: параллельные списки цен и id."""
+
+    __slots__ = ("prices", "ids")
+
+    def __init__(self):
+        self.prices: List[float] = []
+        self.ids: List[int] = []
+
+    def add(self, price: float, alert_id: int) -> None:
+        i = bisect.bisect_right(self.prices, price)
+        self.prices.insert(i, price)
+        self.ids.insert(i, alert_id)
+
+    def remove(self, price: float, alert_id: int) -> None:
+        i = bisect.bisect_left(self.prices, price)
+        while i < len(self.prices) and self.prices[i] == price:
+            if self.ids[i] == alert_id:
+                del self.prices[i]
+                del self.ids[i]
+                return
+            i += 1
+
+    def between(self, lo: float, hi: float) -> List[int]:
+        return self.ids[bisect.bisect_left(self.prices, lo):bisect.bisect_right(self.prices, hi)]
+
+
+class AlertEngine:
+    def __init__(self, path: str | Path):
+        self._lock = threading.Lock()
+        self._db = _sqlite_connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS price_alerts ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " plan_id TEXT NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " pair TEXT NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " price REAL NOT NULL,"
+            " created REAL NOT NULL,"
+            " expires REAL NOT NULL,"
+            " fired_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_price_alerts_active ON price_alerts(fired_at, expires)")
+        self._alerts: Dict[int, PriceAlert] = {}
+        self._by_pair: Dict[str, _LevelIndex] = {}
+        self._by_plan: Dict[str, set[int]] = {}
+        self._last: Dict[str, float] = {}
+        self._outbox: asyncio.Queue | None = None
+        self._tasks: List[asyncio.Task] = []
+        self.fired = 0
+        self._marks: List[Tuple[float, int]] = []  # (fired_at, id) — ещё не записаны
+        self._marks_ready: asyncio.Event | None = None
+        now = time.time()
+        for row in self._db.execute(
+            "SELECT id, plan_id, chat_id, pair, kind, price, expires FROM price_alerts"
+            " WHERE fired_at IS NULL AND expires > ?", (now,)
+        ):
+            self._index(PriceAlert(*row))
+
+    def _index(self, alert: PriceAlert) -> None:
+        self._alerts[alert.id] = alert
+        self._by_pair.setdefault(alert.pair, _LevelIndex()).add(alert.price, alert.id)
+        self._by_plan.setdefault(alert.plan_id, set()).add(alert.id)
+
+    def _unindex(self, alert_id: int) -> PriceAlert | None:
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return None
+        idx = self._by_pair.get(alert.pair)
+        if idx:
+            idx.remove(alert.price, alert_id)
+            if not idx.prices:
+                del self._by_pair[alert.pair]
+        plan = self._by_plan.get(alert.plan_id)
+        if plan is not None:
+            plan.discard(alert_id)
+            if not plan:
+                del self._by_plan[alert.plan_id]
+        return alert
+
+    def pairs(self) -> set[str]:
+        return set(self._by_pair)
+
+    def __len__(self) -> int:
+        return len(self._alerts)
+
+    @staticmethod
+    def _level_rows(levels: Dict[str, List[float]]) -> List[Tuple[str, float]]:
+        return [(kind, price) for kind, prices in levels.items() for price in prices if price and price > 0]
+
+    def add_plan(self, chat_id: int, pair: str, levels: Dict[str, List[float]]) -> int:
+        """Регистрирует уровни плана ({'entry': [...], 'stop': [...], 'tp': [...]}). Возвращает их число."""
+        rows = self._level_rows(levels)
+        if not rows:
+            return 0
+        self._register(pair, self._insert(f"{chat_id}:{pair}:{int(time.time() * 1000)}", [chat_id], pair, rows))
+        return len(rows)
+
+    async def add_setup(self, chat_ids: List[int], pair: str, levels: Dict[str, List[float]]) -> int:
+        """
+        Один план на несколько получателей (VIP-сетап): у каждого свои строки уровней, plan_id общий —
+        стоп/тейк закрывает план сразу для всех. Запись в SQLite — в потоке (получателей могут быть
+        тысячи). Возвращает число уровней плана (не строк).
+        """
+        rows = self._level_rows(levels)
+        chat_ids = list(dict.fromkeys(chat_ids))
+        if not rows or not chat_ids:
+            return 0
+        plan_id = f"setup:{pair}:{int(time.time() * 1000)}"
+        self._register(pair, await asyncio.to_thread(self._insert, plan_id, chat_ids, pair, rows))
+        return len(rows)
+
+    def _insert(self, plan_id: str, chat_ids: List[int], pair: str, rows: List[Tuple[str, float]]) -> List[PriceAlert]:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                added: List[PriceAlert] = []
+                for chat_id in chat_ids:
+                    for kind, price in rows:
+                        cur = self._db.execute(
+                            "INSERT INTO price_alerts (plan_id, chat_id, pair, kind, price, created, expires)"
+                            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (plan_id, chat_id, pair, kind, price, now, now + ALERT_TTL_SEC),
+                        )
+                        added.append(PriceAlert(cur.lastrowid, plan_id, chat_id, pair, kind, price, now + ALERT_TTL_SEC))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return added
+
+    def _register(self, pair: str, added: List[PriceAlert]) -> None:
+        """Индекс и подписка на стрим — в потоке event loop (on_tick читает индекс без блокировки)."""
+        for alert in added:
+            self._index(alert)
+        if PRICE_FEED_ENABLED:
+            PRICE_FEED.subscribe(pair)
+
+    def on_tick(self, pair: str, price: float, ts: float) -> None:
+        """Синхронный обработчик тика: уровни между предыдущей и текущей ценой считаются задетыми."""
+        prev = self._last.get(pair, price)
+        self._last[pair] = price
+        idx = self._by_pair.get(pair)
+        if idx is None:
+            return
+        hit_ids = idx.between(min(prev, price), max(prev, price))
+        if not hit_ids:
+            return
+        fired: List[PriceAlert] = []
+        closed: List[int] = []
+        for alert_id in hit_ids:
+            alert = self._unindex(alert_id)
+            if alert is None:
+                continue
+            if alert.expires < ts:
+                closed.append(alert.id)
+                continue
+            fired.append(alert)
+        # План закрывают стоп или последний тейк (TP2/TP3 ещё должны сработать). Закрываем после
+        # разбора всех задетых: у VIP-сетапа тот же уровень есть у каждого получателя.
+        for plan_id in {a.plan_id for a in fired if a.kind in ("stop", "tp")}:
+            rest = self._by_plan.get(plan_id, ())
+            stopped = any(a.plan_id == plan_id and a.kind == "stop" for a in fired)
+            if stopped or not any(self._alerts[i].kind == "tp" for i in rest):
+                for other in list(rest):
+                    self._unindex(other)
+                    closed.append(other)
+        # fired_at — в SQLite пачкой из потока (_mark_flusher), не в обработчике тика
+        self._marks.extend([(ts, a.id) for a in fired] + [(ts, i) for i in closed])
+        if self._marks_ready is not None:
+            self._marks_ready.set()
+        self.fired += len(fired)
+        if self._outbox is not None:
+            for alert in fired:
+                self._outbox.put_nowait((alert, price))
+
+    def _write_marks(self, batch: List[Tuple[float, int]]) -> None:
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("UPDATE price_alerts SET fired_at = ? WHERE id = ?", batch)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    async def _mark_flusher(self) -> None:
+        while True:
+            await self._marks_ready.wait()
+            self._marks_ready.clear()
+            batch, self._marks = self._marks, []
+            try:
+                await asyncio.to_thread(self._write_marks, batch)
+            except Exception:
+                logging.exception("[alerts] не удалось сохранить сработавшие уровни")
+                self._marks[:0] = batch
+                await asyncio.sleep(ALERT_POLL_SEC)
+                self._marks_ready.set()
+
+    def expire(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        with self._lock:
+            stale = [a.id for a in self._alerts.values() if a.expires <= now]
+            for alert_id in stale:
+                self._unindex(alert_id)
+            if stale:
+                self._db.execute("DELETE FROM price_alerts WHERE fired_at IS NULL AND expires <= ?", (now,))
+        return len(stale)
+
+    async def _notifier(self, bot) -> None:
+        while True:
+            alert, price = await self._outbox.get()
+            text = (
+                f"🔔 {alert.pair}: цена {price:g} — задет уровень {ALERT_LABELS.get(alert.kind, alert.kind)} "
+                f"{alert.price:g}"
+            )
+            try:
+                await bot.send_message(chat_id=alert.chat_id, text=text)
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after))
+            except Exception as e:
+                logging.warning(f"[alerts] не удалось уведомить {alert.chat_id}: {e}")
+            await asyncio.sleep(0.05)
+
+    async def _poller(self) -> None:
+        """
+        Чистит просроченные уровни; без стрима ещё и раз в ALERT_POLL_SEC берёт цены пачкой
+        через PRICES и прогоняет их как тики.
+        """
+        while True:
+            await asyncio.sleep(ALERT_POLL_SEC)
+            try:
+                self.expire()
+                if PRICE_FEED_ENABLED:
+                    continue
+                pairs = sorted(self.pairs())
+                if not pairs:
+                    continue
+                now = time.time()
+                for pair, price in (await PRICES.get_many(pairs)).items():
+                    if price is not None:
+                        self.on_tick(pair, price, now)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("[alerts] poll failed")
+
+    def start(self, bot) -> None:
+        self._outbox = asyncio.Queue()
+        self._marks_ready = asyncio.Event()
+        self._tasks.append(asyncio.create_task(self._notifier(bot)))
+        self._tasks.append(asyncio.create_task(self._mark_flusher()))
+        if PRICE_FEED_ENABLED:
+            for pair in self.pairs():
+                PRICE_FEED.subscribe(pair)
+            PRICE_FEED.add_listener(self.on_tick)
+        self._tasks.append(asyncio.create_task(self._poller()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        # остаток отметок — синхронно: иначе после рестарта сработавшие уровни поднимутся снова
+        batch, self._marks = self._marks, []
+        if batch:
+            try:
+                self._write_marks(batch)
+            except Exception:
+                logging.exception("[alerts] не удалось сохранить сработавшие уровни")
+
+    def stats_lines(self) -> List[str]:
+        return [f"• Алерты: активных уровней {len(self._alerts)} по {len(self._by_pair)} символам, сработало {self.fired}"]
+
+
+ALERTS = AlertEngine(ALERTS_DB)
+
+
+async def fetch_price_from_binance(symbol: str) -> float | None:
+    """
+    Последняя цена с Binance (через PRICES: кэш + пул соединений).
+    Пример: await fetch_price_from_binance("BTC") вернёт цену BTCUSDT.
+    """
+    return await PRICES.get(symbol)
+
+# =====================[ OPENAI SCHEDULER ]=====================
+# Все вызовы chat.completions идут через один планировщик (openai_scheduler.py):
+#   • глобальный лимит одновременных запросов;
+#   • бюджет токенов в минуту (скользящее окно 60 с);
+#   • честная очередь: round-robin по пользователям, платные — вперёд.
+# Для локальной проверки — заглушка tools/fake_openai.py и OPENAI_BASE_URL=http://127.0.0.1:<порт>/v1.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_TPM_BUDGET = int(os.getenv("OPENAI_TPM_BUDGET", "120000"))  # 0 — без ограничения
+
+# Оценка «стоимости» картинки для gpt-4o detail=high после prepare_image (≈6 тайлов по 170 + 85)
+_IMAGE_TOKENS_ESTIMATE = 1105
+
+OPENAI_SCHEDULER = OpenAIScheduler(OPENAI_MAX_CONCURRENCY, OPENAI_TPM_BUDGET, tracer=TRACER)
+
+
+# ---- Адаптивный лимитер (AIMD) по заголовкам OpenAI ----
+OPENAI_START_RPS = float(os.getenv("OPENAI_START_RPS", "4"))
+OPENAI_MAX_RPS = float(os.getenv("OPENAI_MAX_RPS", "20"))
+OPENAI_MIN_RPS = 0.2
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "4"))
+OPENAI_BACKOFF_BASE_SEC = 0.5
+OPENAI_BACKOFF_CAP_SEC = 20.0
+
+_DURATION_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def _parse_reset_duration(raw: str | None) -> float | None:
+    """'6m0s' / '1.5s' / '20ms' / '2' -> секунды (формат x-ratelimit-reset-* и Retry-After)."""
+    if not raw:
+        return None
+    raw = raw.strip().lower()
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    total, matched = 0.0, False
+    for num, unit in _DURATION_PART_RE.findall(raw):
+        matched = True
+        total += float(num) * {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}[unit]
+    return total if matched else None
+
+
+def _header_int(headers, name: str) -> int | None:
+    try:
+        v = headers.get(name)
+        return int(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Глобальный темп отправки запросов в OpenAI (запросов/сек), AIMD:
+      • успех и запас по x-ratelimit-remaining-* → +additive;
+      • остаток < 10% лимита или 429 → ×decrease и пауза до reset / Retry-After.
+    """
+
+    def __init__(self, start_rps: float = 4.0, min_rps: float = 0.2, max_rps: float = 20.0,
+                 additive: float = 0.25, decrease: float = 0.5):
+        self.rate = start_rps
+        self.min_rps = min_rps
+        self.max_rps = max_rps
+        self.additive = additive
+        self.decrease = decrease
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self.rate_limited = 0
+        self.retries = 0
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        slot = max(now, self._next_slot, self._paused_until)
+        self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _slow_down(self, pause: float | None) -> None:
+        self.rate = max(self.min_rps, self.rate * self.decrease)
+        if pause:
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def on_response(self, headers) -> None:
+        low = False
+        pause = None
+        for kind in ("requests", "tokens"):
+            remaining = _header_int(headers, f"x-ratelimit-remaining-{kind}")
+            limit = _header_int(headers, f"x-ratelimit-limit-{kind}")
+            if remaining is None or not limit:
+                continue
+            if remaining <= limit * 0.1:
+                low = True
+                reset = _parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if remaining <= 0 and reset:
+                    pause = max(pause or 0.0, reset)
+        if low:
+            self._slow_down(pause)
+        else:
+            self.rate = min(self.max_rps, self.rate + self.additive)
+
+    def on_rate_limited(self, retry_after: float | None) -> None:
+        self.rate_limited += 1
+        self._slow_down(retry_after)
+
+    @staticmethod
+    def backoff(attempt: int, retry_after: float | None = None) -> float:
+        """Экспоненциальный бэкофф с full jitter; Retry-After — нижняя граница."""
+        delay = random.uniform(0, min(OPENAI_BACKOFF_CAP_SEC, OPENAI_BACKOFF_BASE_SEC * (2 ** attempt)))
+        if retry_after:
+            delay = retry_after + random.uniform(0, 0.25 * retry_after + 0.1)
+        return delay
+
+    def stats_lines(self) -> List[str]:
+        return [f"• OpenAI темп: {self.rate:.2f} rps, 429: {self.rate_limited}, ретраев: {self.retries}"]
+
+
+OPENAI_LIMITER = AdaptiveRateLimiter(OPENAI_START_RPS, OPENAI_MIN_RPS, OPENAI_MAX_RPS)
+
+
+async def _openai_call_with_retries(
+    kwargs: dict,
+    *,
+    user_key: Any = None,
+    priority: int = PRIORITY_FREE,
+    tokens: int = 1000,
+    on_queued: Callable[[int], Awaitable[Any]] | None = None,
+    consume: Callable[[Any], Awaitable[Any]] | None = None,
+):
+    """
+    Один логический вызов chat.completions: пейсинг, чтение заголовков, ретраи с бэкоффом.
+    Каждая попытка — отдельный заход в OPENAI_SCHEDULER: слот держат только пейсинг и сам
+    запрос, а пауза перед повтором (бэкофф / Retry-After) идёт без слота.
+    consume(response) выполняется в слоте удачной попытки (чтение стрима) и не переповторяется.
+    """
+    last_exc: Exception | None = None
+    for attempt in range(max(1, OPENAI_MAX_ATTEMPTS)):
+
+        async def _attempt():
+            await OPENAI_LIMITER.acquire()
+            try:
+                with TRACER.span("openai.request", model=kwargs.get("model"), attempt=attempt):
+                    raw = await client.chat.completions.with_raw_response.create(**kwargs)
+            except RateLimitError as e:
+                if getattr(e, "code", None) == "insufficient_quota":
+                    raise  # квота кончилась — ретраи не помогут
+                return e  # повтор — решается снаружи, после освобождения слота
+            except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+                return e
+            OPENAI_LIMITER.on_response(raw.headers)
+            response = raw.parse()
+            return response if consume is None else await consume(response)
+
+        result = await OPENAI_SCHEDULER.run(
+            _attempt, user_key=user_key, priority=priority, tokens=tokens, on_queued=on_queued,
+        )
+        if not isinstance(result, Exception):
+            return result
+        last_exc = result
+        if isinstance(result, RateLimitError):
+            headers = getattr(getattr(result, "response", None), "headers", None) or {}
+            retry_after = None
+            if headers.get("retry-after-ms"):
+                try:
+                    retry_after = float(headers["retry-after-ms"]) / 1000.0
+                except ValueError:
+                    pass
+            if retry_after is None:
+                retry_after = _parse_reset_duration(headers.get("retry-after"))
+            OPENAI_LIMITER.on_rate_limited(retry_after)
+            delay = OPENAI_LIMITER.backoff(attempt, retry_after)
+        else:
+            delay = OPENAI_LIMITER.backoff(attempt)
+        if attempt + 1 >= OPENAI_MAX_ATTEMPTS:
+            break
+        OPENAI_LIMITER.retries += 1
+        OPENAI_RETRIES.inc()
+        logging.warning(f"[openai] retry {attempt + 1} in {delay:.2f}s: {type(last_exc).__name__}")
+        await asyncio.sleep(delay)
+    raise last_exc
+
+
+def _estimate_tokens(messages: list | None, max_tokens: int | None) -> int:
+    """Грубая оценка токенов запроса: ~4 символа на токен + картинки + лимит ответа."""
+    total = 0
+    for m in messages or []:
+        content = m.get("content") if isinstance(m, dict) else None
+        if isinstance(content, str):
+            total += len(content) // 4
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total += len(part.get("text") or "") // 4
+                elif part.get("type") == "image_url":
+                    total += _IMAGE_TOKENS_ESTIMATE
+    return total + (max_tokens or 1000)
+
+
+def _queue_notifier(msg) -> Callable[[int], Awaitable[Any]] | None:
+    """Колбэк для планировщика: один раз сообщает пользователю позицию в очереди."""
+    if msg is None:
+        return None
+    sent = False
+
+    async def _notify(position: int):
+        nonlocal sent
+        if sent:
+            return
+        sent = True
+        await msg.reply_text(
+            f"⏳ Сейчас много запросов — ты в очереди (впереди ≈{position}). Ответ придёт автоматически."
+        )
+
+    return _notify
+
+
+async def openai_chat(*, user_id: int | None = None, notify=None, **kwargs):
+    """
+    Единая точка вызова client.chat.completions.create через OPENAI_SCHEDULER.
+    Платные пользователи (get_allowed_users) получают приоритет в очереди.
+    Ретраи (429 / сеть / 5xx) и общий темп — внутри, через OPENAI_LIMITER; каждая попытка
+    занимает слот заново, ожидание между попытками слот не держит.
+    """
+    priority = PRIORITY_PAID if (user_id is not None and user_id in get_allowed_users()) else PRIORITY_FREE
+    tokens = _estimate_tokens(kwargs.get("messages"), kwargs.get("max_tokens"))
+    return await _openai_call_with_retries(
+        kwargs,
+        user_key=user_id,
+        priority=priority,
+        tokens=tokens,
+        on_queued=notify,
+    )
+
+
+async def openai_chat_stream(
+    on_delta: Callable[[str], Awaitable[Any]],
+    *,
+    user_id: int | None = None,
+    notify=None,
+    **kwargs,
+) -> str:
+    """
+    Как openai_chat, но с stream=True: каждый кусок текста отдаётся в on_delta.
+    Слот планировщика держится до конца стрима. Возвращает полный текст.
+    """
+    priority = PRIORITY_PAID if (user_id is not None and user_id in get_allowed_users()) else PRIORITY_FREE
+    tokens = _estimate_tokens(kwargs.get("messages"), kwargs.get("max_tokens"))
+
+    async def _consume(stream) -> str:
+        parts: List[str] = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                parts.append(delta)
+                await on_delta(delta)
+        return "".join(parts)
+
+    return await _openai_call_with_retries(
+        {**kwargs, "stream": True},
+        user_key=user_id,
+        priority=priority,
+        tokens=tokens,
+        on_queued=notify,
+        consume=_consume,
+    )
+
 
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📏 Калькулятор", url=f"https://t.me/{bot_username}?start=calc")]
-    ])
+# =====================[ STREAMING REPLIES ]=====================
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1").strip() not in ("0", "false", "no")
+STREAM_EDIT_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_INTERVAL_SEC", "1.5"))  # Telegram: ~1 правка/сек на чат
+TELEGRAM_CHUNK_LIMIT = 3800  # запас до лимита 4096 символов
+
+
+def _split_for_telegram(text: str, limit: int = TELEGRAM_CHUNK_LIMIT) -> List[str]:
+    """Режет текст на части ≤ limit по строкам (слишком длинные строки — жёстко)."""
+    parts: List[str] = []
+    chunk: List[str] = []
+    size = 0
+    for line in text.splitlines(True):
+        while line:
+            room = limit - size
+            if len(line) <= room:
+                chunk.append(line)
+                size += len(line)
+                break
+            if chunk and len(line) <= limit:
+                # строка целиком влезет в следующую часть — не рвём её
+                parts.append("".join(chunk))
+                chunk, size = [], 0
+                continue
+            chunk.append(line[:room])
+            parts.append("".join(chunk))
+            chunk, size = [], 0
+            line = line[room:]
+    if chunk:
+        parts.append("".join(chunk))
+    return parts or [""]
 
-    # Достаём сохранённое изображение и публикуем
-    try:
-        image_stream = BytesIO(context.user_data["setup_image_bytes"])
-        await context.bot.send_photo(
-            chat_id=VIP_CHANNEL_ID,
-            photo=image_stream,
-            caption=caption,
-            parse_mode="HTML",
-            reply_markup=keyboard
-        )
-        await update.message.reply_text("✅ Сетап опубликован в приватный канал.")
-    except Exception as e:
-        logging.error(f"[setup_set_entry] Ошибка публикации: {e}")
-        await update.message.reply_text("⚠️ Не удалось опубликовать сетап.")
-    finally:
-        context.user_data.clear()
 
-    return ConversationHandler.END
+class TelegramStreamWriter:
+    """
+    Прогрессивный ответ: плейсхолдер → правки по мере прихода токенов (не чаще
+    STREAM_EDIT_INTERVAL_SEC) → финальный текст. Длинный ответ продолжается
+    новыми сообщениями. При STREAM_REPLIES=0 просто копит текст и шлёт его в finish().
+    """
+
+    def __init__(self, msg, header: str = "", reply_markup=None,
+                 placeholder: str = "⏳ Думаю…", enabled: bool | None = None):
+        self.msg = msg
+        self.header = header
+        self.reply_markup = reply_markup
+        self.placeholder = placeholder
+        self.enabled = STREAM_REPLIES if enabled is None else enabled
+        self.text = ""
+        self._messages: list = []
+        self._sent: List[str] = []
+        self._next_edit_at = 0.0
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        first = self.header + self.placeholder
+        self._messages.append(await self.msg.reply_text(first, reply_markup=self.reply_markup))
+        self._sent.append(first)
+        self._next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL_SEC
+
+    async def feed(self, delta: str) -> None:
+        self.text += delta
+        if self.enabled and time.monotonic() >= self._next_edit_at:
+            await self._flush(cursor=" ▌")
+
+    async def reset(self, note: str = "") -> None:
+        """Сбросить накопленный текст (например, перед перегенерацией)."""
+        self.text = ""
+        if self.enabled and note:
+            self.text = note
+            await self._flush()
+            self.text = ""
+
+    async def finish(self, final_text: str | None = None) -> None:
+        if final_text is not None:
+            self.text = final_text
+        await self._flush(final=True)
+
+    def _parts(self, body: str) -> List[str]:
+        parts = _split_for_telegram(self.header + body)
+        return [p if i == 0 else f"(часть {i + 1})\n{p}" for i, p in enumerate(parts)]
+
+    async def _flush(self, cursor: str = "", final: bool = False) -> None:
+        parts = self._parts(self.text.strip() + cursor if self.text.strip() else self.placeholder)
+        for i, part in enumerate(parts):
+            try:
+                if i < len(self._messages):
+                    if self._sent[i] != part:
+                        await self._messages[i].edit_text(part)
+                        self._sent[i] = part
+                else:
+                    self._messages.append(await self.msg.reply_text(part, reply_markup=self.reply_markup))
+                    self._sent.append(part)
+            except RetryAfter as e:
+                wait = float(getattr(e, "retry_after", 1) or 1)
+                if not final:
+                    self._next_edit_at = time.monotonic() + wait
+                    return
+                await asyncio.sleep(wait)
+                return await self._flush(cursor, final)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    logging.warning(f"[stream] edit failed: {e}")
+        # текст стал короче (перегенерация) — лишние хвостовые сообщения убираем
+        while len(self._messages) > len(parts):
+            extra = self._messages.pop()
+            self._sent.pop()
+            try:
+                await extra.delete()
+            except Exception:
+                logging.warning("[stream] delete extra part failed", exc_info=True)
+        self._next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL_SEC
 
-def fetch_price_from_binance(symbol: str) -> float | None:
+# -------------------- Structured output: счётчики --------------------
+class StructuredOutputStats:
     """
-    Получает последнюю цену с Binance через публичный REST API.
-    Пример: fetch_price_from_binance("BTC") вернёт цену BTCUSDT.
+    Сколько ответов в режиме JSON-схемы разобралось сразу (ok), сколько ушло в разбор
+    свободного текста (fallback) и сколько раз пришлось спрашивать модель повторно (retry).
     """
-    try:
-        pair = symbol.upper() + "USDT"
-        url = f"https://api.binance.com/api/v3/ticker/price?symbol={pair}"
-        response = requests.get(url, timeout=10)
-        data = response.json()
-        return float(data["price"])
-    except Exception as e:
-        logging.warning(f"[BINANCE] Ошибка получения цены для {symbol}: {e}")
-        return None
+
+    def __init__(self):
+        self._counters: Dict[str, Dict[str, int]] = {}
+
+    def _bump(self, kind: str, key: str) -> None:
+        c = self._counters.setdefault(kind, {"ok": 0, "fallback": 0, "retry": 0})
+        c[key] += 1
+
+    def ok(self, kind: str) -> None:
+        self._bump(kind, "ok")
+
+    def fallback(self, kind: str) -> None:
+        self._bump(kind, "fallback")
+
+    def retry(self, kind: str) -> None:
+        self._bump(kind, "retry")
+
+    def stats_lines(self) -> List[str]:
+        lines = []
+        for kind, c in sorted(self._counters.items()):
+            total = c["ok"] + c["fallback"]
+            rate = (c["fallback"] / total * 100) if total else 0.0
+            lines.append(
+                f"• Structured output [{kind}]: ok {c['ok']} / разбор текста {c['fallback']} ({rate:.1f}%), "
+                f"повторов {c['retry']}"
+            )
+        return lines
+
+
+STRUCTURED_STATS = StructuredOutputStats()
 
 # -------------------- GPT-Vision вызов --------------------
 async def ask_gpt_vision(
@@ -1132,6 +3972,10 @@ async def ask_gpt_vision(
     system_prompt: str | None = None,
     mime: str | None = "image/jpeg",
     force_ru: bool = True,
+    user_id: int | None = None,
+    notify=None,
+    on_delta: Callable[[str], Awaitable[Any]] | None = None,
+    response_format: dict | None = None,
 ) -> str:
     """
     Вызов GPT-Vision (chat.completions) с изображением.
@@ -1140,6 +3984,10 @@ async def ask_gpt_vision(
     - system_prompt: опциональный кастомный SYSTEM (EN). Если None — безопасный дефолт.
     - mime: MIME изображения ('image/jpeg' | 'image/png' | ...).
     - force_ru: добавлять ли хинт про «Strictly Russian». Отключаем для JSON-ONLY.
+    - user_id / notify: для очереди OPENAI_SCHEDULER (приоритет и сообщение о позиции).
+    - on_delta: если задан — ответ стримится (stream=True), куски уходят в колбэк.
+    - response_format: JSON-схема structured output (см. trade_plan); ответ — JSON-строка.
+      Отказ модели в этом режиме приходит в message.refusal вместо content — возвращаем его текст.
     """
     if not image_base64:
         return ""
@@ -1154,33 +4002,58 @@ async def ask_gpt_vision(
     _mime = (mime or "image/jpeg").strip().lower()
     data_url = f"data:{_mime};base64,{image_base64}"
 
-    try:
-        resp = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": f"{prompt_text}"
-                                    + ("\n\nRespond strictly in Russian (Cyrillic). No markdown." if force_ru else "")
-                        },
-                        {"type": "image_url", "image_url": {"url": data_url}},
-                    ],
-                },
-            ],
-            max_tokens=1100,
-            temperature=0.2,
-            top_p=0.9,
-            presence_penalty=0.0,
-            frequency_penalty=0.05,
-        )
-        return (resp.choices[0].message.content or "").strip()
-    except Exception as e:
-        logging.error(f"[ask_gpt_vision] Error: {e}", exc_info=True)
-        return ""
+    request = dict(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": f"{prompt_text}"
+                                + ("\n\nRespond strictly in Russian (Cyrillic). No markdown." if force_ru else "")
+                    },
+                    {"type": "image_url", "image_url": {"url": data_url}},
+                ],
+            },
+        ],
+        max_tokens=1100,
+        temperature=0.2,
+        top_p=0.9,
+        presence_penalty=0.0,
+        frequency_penalty=0.05,
+    )
+    if response_format is not None:
+        request["response_format"] = response_format
+
+    started = time.perf_counter()
+    span = TRACER.span("openai.vision", stream=on_delta is not None, structured=response_format is not None)
+    with span:
+        try:
+            if on_delta is not None:
+                text = await openai_chat_stream(on_delta, user_id=user_id, notify=notify, **request)
+                VISION_OK.observe(time.perf_counter() - started)
+                text = (text or "").strip()
+            else:
+                resp = await openai_chat(user_id=user_id, notify=notify, **request)
+                VISION_OK.observe(time.perf_counter() - started)
+                message = resp.choices[0].message
+                if not message.content and getattr(message, "refusal", None):
+                    logging.warning(f"[ask_gpt_vision] refusal: {message.refusal}")
+                    REFUSALS.inc()
+                    span.set("refusal", True)
+                    return message.refusal.strip()
+                text = (message.content or "").strip()
+            if _is_refusal(text):
+                REFUSALS.inc()
+                span.set("refusal", True)
+            return text
+        except Exception as e:
+            VISION_ERROR.observe(time.perf_counter() - started)
+            span.set("error", type(e).__name__)
+            logging.error(f"[ask_gpt_vision] Error: {e}", exc_info=True)
+            return ""
 
 # -------------------- Утилиты: анти-отказ / парсинг чисел --------------------
 refusal_markers = [
@@ -1194,10 +4067,10 @@ refusal_markers = [
 async def handle_strategy_photo(update, context, image_bytes: BytesIO):
     """
     СПОТ, LONG-only, DCA.
-    Первая строка ответа модели — валидный JSON одной строкой по схеме:
-      {"direction":"LONG","entry":number|null,"avg_entry":number|null,"stop":number|null,
-       "tp":[numbers],"dca":[{"price":number,"alloc_pct":number}],"notes":["text"]}
-    Затем — понятный ответ на русском (без markdown).
+    Модель отвечает JSON по схеме STRATEGY_RESPONSE_FORMAT (structured output):
+      {"entry":number|null,"avg_entry":number|null,"take_profits":[numbers],
+       "dca":[{"price":number,"alloc_pct":number}],"notes":["текст на русском"]}
+    Если ответ всё же не JSON — уровни достаются из текста (extract_trade_plan).
     На СПОТе не используем «стоп-ордера»: показываем 5-ступенчатый DCA, среднюю цену и цели.
     В итоговом JSON поле "stop" принудительно = null (совместимость со схемой).
     """
@@ -1312,15 +4185,10 @@ async def handle_strategy_photo(update, context, image_bytes: BytesIO):
                 await msg.reply_text("Не вижу изображения. Пришлите скрин как фото или документ-картинку (PNG/JPG/WEBP).")
                 return
 
-        # 2) JPEG → base64
+        # 2) JPEG → base64 (единый пайплайн, в пуле потоков)
         try:
-            image_bytes.seek(0)
-            im = Image.open(image_bytes).convert("RGB")
-            buf = BytesIO()
-            im.save(buf, format="JPEG", quality=90, optimize=True)
-            buf.seek(0)
-            import base64 as _b64
-            img_b64 = _b64.b64encode(buf.read()).decode("ascii")
+            prepared = await prepare_image(image_bytes)
+            img_b64 = prepared.b64
         except Exception:
             await msg.reply_text("Не удалось прочитать изображение. Пришлите скрин в формате PNG/JPG.")
             return
@@ -1328,17 +4196,15 @@ async def handle_strategy_photo(update, context, image_bytes: BytesIO):
         # 3) Промпты (EN)
         system_prompt = (
             "You are an institutional investor creating a SPOT DCA plan (LONG only). "
-            "Always respond with a VALID ONE-LINE JSON as the FIRST line using the schema: "
-            "{\"direction\":\"LONG\",\"entry\":number|null,\"avg_entry\":number|null,\"stop\":number|null,"
-            "\"tp\":[numbers],\"dca\":[{\"price\":number,\"alloc_pct\":number}],\"notes\":[\"text\"]}. "
+            "Respond with JSON per the provided schema. "
             "Prefer providing 4–5 DCA steps with decreasing prices. "
-            "Then provide a Russian explanation for a beginner. Never refuse; provide best-effort values."
+            "Put short explanations for a beginner into \"notes\" in Russian. Never refuse; provide best-effort values."
         )
         user_prompt = (
             "TASK:\n"
             "1) Read the chart image and propose a SPOT DCA plan (LONG-only).\n"
-            "2) FIRST LINE: exactly ONE line JSON (no code fences) per schema.\n"
-            "3) Then explain in Russian for a beginner (plain text, no markdown).\n"
+            "2) Fill entry, avg_entry and take_profits (ascending) with plain numbers.\n"
+            "3) notes: 2-5 short comments in Russian for a beginner (plain text, no markdown).\n"
             "4) DCA list must have 4-5 steps with valid prices and alloc_pct (sum ≈100%).\n"
             "5) If unsure, still provide best estimates. Do NOT refuse.\n"
         )
@@ -1350,18 +4216,21 @@ async def handle_strategy_photo(update, context, image_bytes: BytesIO):
             return any(s in low for s in ("i can't", "cannot", "i won’t", "sorry", "as an ai"))
 
         # 4) Вызов модели (2 попытки)
-        client_obj = globals().get("client")
-        if client_obj is None:
-            from openai import AsyncOpenAI
-            import os
-            client_obj = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-        content_text = None
-        for _ in range(2):
+        user_id = update.effective_user.id if update and update.effective_user else None
+        notify = _queue_notifier(msg)
+        cache_key = VISION_CACHE.make_key("strategy", prepared.digest, STRATEGY_PROMPT_VERSION)
+        content_text = await VISION_CACHE.aget(cache_key, "strategy", prepared.phash)
+        for attempt in range(0 if content_text else 2):
+            if attempt:
+                STRUCTURED_STATS.retry("strategy")
+                VISION_RETRIES.inc()
             try:
-                resp = await client_obj.chat.completions.create(
+                resp = await openai_chat(
+                    user_id=user_id,
+                    notify=notify,
                     model="gpt-4o",
                     temperature=0.1,
+                    response_format=STRATEGY_RESPONSE_FORMAT,
                     messages=[
                         {"role": "system", "content": system_prompt},
                         {"role": "user", "content": [
@@ -1370,47 +4239,39 @@ async def handle_strategy_photo(update, context, image_bytes: BytesIO):
                         ]}
                     ]
                 )
-                content_text = (resp.choices[0].message.content or "").strip()
+                message = resp.choices[0].message
+                content_text = (message.content or getattr(message, "refusal", None) or "").strip()
+                if content_text and (getattr(message, "refusal", None) or _needs_retry(content_text)):
+                    REFUSALS.inc()
                 if not _needs_retry(content_text):
+                    await VISION_CACHE.aput(cache_key, content_text, prepared.phash)
                     break
                 system_prompt += " You must comply. Provide your best estimate. Do not refuse."
             except Exception:
+                # транспортные ретраи уже сделаны в openai_chat — не долбим API повторно
                 logging.exception("Vision call failed (strategy)")
-
-        # 5) Парсинг 1-й строки как JSON (фолбэк — регексы)
-        if not content_text:
-            data = {"direction": "LONG", "entry": None, "avg_entry": None, "stop": None, "tp": [], "dca": [], "notes": [
-                "Нет уверенных уровней на скрине. Используйте плавный DCA и контролируйте долю позиции в портфеле."
-            ]}
-        else:
-            lines = content_text.splitlines()
-            first = (lines[0] if lines else "").strip()
-            try:
-                data = json.loads(first)
-                if not isinstance(data, dict):
-                    raise ValueError("not object")
-            except Exception:
-                txt = content_text
-                dca = []
-                for m in re.finditer(r'(?:Купить|Buy)\s*([0-9]+(?:\.[0-9]+)?)\s*%\D+\$?\s*([0-9]+(?:\.[0-9]+)?)', txt, re.I):
-                    alloc = _sfloat(m.group(1)); price = _sfloat(m.group(2))
-                    if price is not None and alloc is not None:
-                        dca.append({"price": price, "alloc_pct": alloc})
-                for m in re.finditer(r'price\s*[:=]\s*\$?\s*([0-9]+(?:\.[0-9]+)?)\D+alloc(?:_pct)?\s*[:=]\s*([0-9]+(?:\.[0-9]+)?)\s*%', txt, re.I):
-                    price = _sfloat(m.group(1)); alloc = _sfloat(m.group(2))
-                    if price is not None and alloc is not None:
-                        dca.append({"price": price, "alloc_pct": alloc})
-                entry = None
-                m = re.search(r'(?:Entry|Вход)\s*[:=]\s*\$?\s*([0-9]+(?:\.[0-9]+)?)', txt, re.I)
-                if m: entry = _sfloat(m.group(1))
-                tps = []
-                for label in ("TP1","TP2","TP3","Цель1","Цель2","Цель3"):
-                    m = re.search(rf'(?:{label})\s*[:=]\s*\$?\s*([0-9]+(?:\.[0-9]+)?)', txt, re.I)
-                    if m:
-                        v = _sfloat(m.group(1))
-                        if v is not None:
-                            tps.append(v)
-                data = {"direction": "LONG", "entry": entry, "avg_entry": None, "stop": None, "tp": tps, "dca": dca, "notes": ["Эвристический парсинг текста."]}
+                break
+
+        # 5) Разбор ответа по схеме (фолбэк — разбор текста)
+        with TRACER.span("parse") as span:
+            plan = plan_from_json(content_text)
+            if plan is not None:
+                STRUCTURED_STATS.ok("strategy")
+                notes = plan.notes
+            elif content_text and not _needs_retry(content_text):
+                STRUCTURED_STATS.fallback("strategy")
+                span.set("fallback", True)
+                plan = extract_trade_plan(content_text)
+                notes = ["Эвристический парсинг текста."]
+            else:
+                plan = TradePlan()
+                notes = ["Нет уверенных уровней на скрине. Используйте плавный DCA и контролируйте долю позиции в портфеле."]
+        data = {
+            "entry": plan.entry,
+            "tp": plan.take_profits,
+            "dca": [asdict(step) for step in plan.dca],
+            "notes": notes,
+        }
 
         # 6) Нормализация и построение 5 ступеней
         data["direction"] = "LONG"
@@ -1509,7 +4370,7 @@ async def handle_uid_submission(update: Update, context: ContextTypes.DEFAULT_TY
     raw = (getattr(msg, "text", "") or "").strip()
 
     # 1) Нормализация UID: вытаскиваем только цифры (сохраняем лидирующие нули)
-    digits_only = _re.sub(r"\D", "", raw)
+    digits_only = re.sub(r"\D", "", raw)
     if len(digits_only) < 5:
         await msg.reply_text(
             "❗️ Пришли UID цифрами. Пример: 24676081.",
@@ -1528,8 +4389,7 @@ async def handle_uid_submission(update: Update, context: ContextTypes.DEFAULT_TY
     broker = context.user_data.get("broker", "unknown")
 
     # 3) Подготовка строки для записи
-    now = datetime.now(tz=_TZ) if _TZ else datetime.now()
-    when_str = now.strftime("%Y-%m-%d %H:%M")
+    when_str = datetime.now().strftime("%Y-%m-%d %H:%M")
 
     row = [
         str(user_id or ""),
@@ -1540,9 +4400,9 @@ async def handle_uid_submission(update: Update, context: ContextTypes.DEFAULT_TY
         uid
     ]
 
-    # 4) Пишем в таблицу безопасно (в отдельном потоке)
+    # 4) Ставим строку в очередь записи в таблицу (повторный UID от того же юзера не дублируется)
     try:
-        await asyncio.to_thread(safe_append_row, row)
+        await asyncio.to_thread(safe_append_row, row, f"uid:{user_id}:{uid}")
         logging.info(f"[REF_UID] ok user_id={user_id} username={username} broker={broker} uid={uid}")
         await msg.reply_text(
             "✅ UID принят. Проверка займёт до 10 минут. Напишу в этот чат, когда доступ будет активирован.",
@@ -1566,7 +4426,7 @@ async def handle_calendar_photo(update: Update, context: ContextTypes.DEFAULT_TY
     """
     Обрабатывает скрин экономического календаря:
     1) Берёт BytesIO (из аргумента или вытаскивает сам из сообщения),
-    2) Конвертирует в JPEG base64,
+    2) Готовит PreparedImage (prepare_image: даунскейл + JPEG base64),
     3) Вызывает generate_news_from_image(...) — промпт жёстко связывает интерпретацию с грядущим заседанием ФРС,
     4) Отправляет результат пользователю (строго RU, без инвестсоветов).
     """
@@ -1594,13 +4454,29 @@ async def handle_calendar_photo(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
 
-    # 2) Сообщение-прогресс с акцентом на ФРС
-    await msg.reply_text("🔎 Читаю скрин и оцениваю, как это сдвигает расклад перед ближайшим заседанием ФРС…")
+    # 2) Сообщение-прогресс с акцентом на ФРС (при стриминге оно же — плейсхолдер ответа)
+    exit_kb = ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
+    progress_text = "🔎 Читаю скрин и оцениваю, как это сдвигает расклад перед ближайшим заседанием ФРС…"
+    writer = TelegramStreamWriter(
+        msg,
+        header="🧠 Интерпретация события в контексте заседания ФРС:\n\n",
+        reply_markup=exit_kb,
+        placeholder=progress_text,
+    )
+    if writer.enabled:
+        await writer.start()
+    else:
+        await msg.reply_text(progress_text)
 
-    # 3) JPEG→b64 и генерация интерпретации
+    # 3) JPEG→b64 и генерация интерпретации (стримим в writer; длинный ответ он сам разобьёт на части)
     try:
-        jpeg_b64 = _to_jpeg_base64(image_bytes)
-        analysis_ru = await generate_news_from_image(jpeg_b64)
+        prepared = await prepare_image(image_bytes)
+        analysis_ru = await generate_news_from_image(
+            prepared,
+            user_id=update.effective_user.id if update.effective_user else None,
+            notify=_queue_notifier(msg),
+            writer=writer,
+        )
 
         # Страховка от пустых/коротких ответов
         if not analysis_ru or not analysis_ru.strip():
@@ -1613,43 +4489,20 @@ async def handle_calendar_photo(update: Update, context: ContextTypes.DEFAULT_TY
                 "6) Сценарии: мягкие данные → риск-он; жёсткие → риск-офф. Следите за пересмотрами и близкими релизами."
             )
 
-        # Телеграм ограничение ~4096 символов — аккуратно разобьём при необходимости
-        text = "🧠 Интерпретация события в контексте заседания ФРС:\n\n" + analysis_ru.strip()
-        if len(text) <= 4000:
-            await msg.reply_text(
-                text,
-                reply_markup=ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
-            )
-        else:
-            # Разбить на части по абзацам
-            parts = []
-            chunk = []
-            size = 0
-            for line in text.splitlines(True):
-                if size + len(line) > 3800:
-                    parts.append("".join(chunk))
-                    chunk, size = [line], len(line)
-                else:
-                    chunk.append(line)
-                    size += len(line)
-            if chunk:
-                parts.append("".join(chunk))
-            # Отправим по порядку
-            for i, p in enumerate(parts, 1):
-                header = "" if i == 1 else f"(часть {i}/{len(parts)})\n"
-                await msg.reply_text(
-                    header + p,
-                    reply_markup=ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
-                )
+        await writer.finish(analysis_ru.strip())
 
     except Exception as e:
         logging.exception("[calendar] analysis error")
-        await msg.reply_text(
+        error_text = (
             "⚠️ Не удалось распознать скрин.\n"
             "Совет: кадрируйте область с названием релиза и числами «Факт / Прогноз / Пред.», "
-            "уберите лишнее и пришлите снова.",
-            reply_markup=ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
+            "уберите лишнее и пришлите снова."
         )
+        if writer.enabled:
+            writer.header = ""
+            await writer.finish(error_text)
+        else:
+            await msg.reply_text(error_text, reply_markup=exit_kb)
 
 NEWS_PROMPT_EN = """
 You are a macro analyst. Interpret an economic calendar screenshot (e.g., CPI, PPI, NFP, ISM, Retail Sales, Jobless Claims, PMI, GDP, Core/PCE, etc.).
@@ -1687,10 +4540,24 @@ Return format (RUSSIAN, no markdown):
 7) Риски и что дальше смотреть: <релизы/комментарии, которые способны изменить картину до заседания ФРС>
 """
 
-async def generate_news_from_image(jpeg_b64: str) -> str:
+async def generate_news_from_image(
+    image: PreparedImage,
+    user_id: int | None = None,
+    notify=None,
+    writer: TelegramStreamWriter | None = None,
+) -> str:
     """Интерпретация календаря по скрину с фокусом на грядущее заседание ФРС. 2 попытки + читаемый RU-fallback."""
+    cache_key = VISION_CACHE.make_key("news", image.digest, NEWS_PROMPT_VERSION)
+    cached = await VISION_CACHE.aget(cache_key, "news", image.phash)
+    if cached:
+        return cached
+
     base_prompt = NEWS_PROMPT_EN + "\n\nОтвет строго на русском. Без англоязычных терминов. Без инвестиционных рекомендаций."
-    out = await ask_gpt_vision(prompt_text=base_prompt, image_base64=jpeg_b64)
+    on_delta = writer.feed if writer is not None else None
+    out = await ask_gpt_vision(
+        prompt_text=base_prompt, image_base64=image.b64, mime=image.mime,
+        user_id=user_id, notify=notify, on_delta=on_delta,
+    )
 
     # Перегенерация, если пришёл отказ / пусто / заметно англ.
     def _looks_english(s: str) -> bool:
@@ -1704,7 +4571,15 @@ async def generate_news_from_image(jpeg_b64: str) -> str:
               "Только образовательная макро-интерпретация, никаких торговых рекомендаций. "
               "Если ответ начат на английском или содержит отказ — перегенерируй и выдай корректный русский разбор."
         )
-        out = await ask_gpt_vision(prompt_text=stronger, image_base64=jpeg_b64)
+        if writer is not None:
+            await writer.reset("♻️ Уточняю разбор…")
+        out = await ask_gpt_vision(
+            prompt_text=stronger, image_base64=image.b64, mime=image.mime,
+            user_id=user_id, notify=notify, on_delta=on_delta,
+        )
+
+    if out and not _is_refusal(out) and not _looks_english(out):
+        await VISION_CACHE.aput(cache_key, out, image.phash)
 
     # План Б — аккуратный шаблон, чтобы пользователь всё равно получил пользу
     if _is_refusal(out) or not out:
@@ -1745,33 +4620,31 @@ async def handle_definition_term(update: Update, context: ContextTypes.DEFAULT_T
         "Answer strictly in Russian."
     )
 
+    reply_markup = ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
+    writer = TelegramStreamWriter(update.message, header="📘 Определение:\n\n", reply_markup=reply_markup)
+
     try:
-        response = await client.chat.completions.create(
+        await writer.start()
+        text = await openai_chat_stream(
+            writer.feed,
+            user_id=update.effective_user.id if update.effective_user else None,
+            notify=_queue_notifier(update.message),
             model="gpt-4o",
             messages=[{"role": "user", "content": prompt}]
         )
 
-        reply_markup = ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
-
-        text = response.choices[0].message.content.strip()
+        text = (text or "").strip()
         if not text:
-            await update.message.reply_text(
-                "⚠️ GPT не дал ответа. Попробуй задать термин ещё раз.",
-                reply_markup=reply_markup
-            )
+            writer.header = ""
+            await writer.finish("⚠️ GPT не дал ответа. Попробуй задать термин ещё раз.")
             return
 
-        await update.message.reply_text(
-            f"📘 Определение:\n\n{text}",
-            reply_markup=reply_markup
-        )
+        await writer.finish(text)
 
     except Exception as e:
         logging.error(f"[DEFINITION] GPT error: {e}")
-        await update.message.reply_text(
-            "⚠️ GPT временно недоступен. Попробуй позже.",
-            reply_markup=ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
-        )
+        writer.header = ""
+        await writer.finish("⚠️ GPT временно недоступен. Попробуй позже.")
 
 async def handle_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
@@ -1978,25 +4851,32 @@ async def gpt_psychologist_response(update: Update, context: ContextTypes.DEFAUL
         "Answer everything strictly in Russian."
     )
 
+    reply_markup = ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
+    writer = TelegramStreamWriter(update.message, header="🧘 GPT-психолог:\n", reply_markup=reply_markup)
+
     try:
-        response = await client.chat.completions.create(
+        await writer.start()
+        text = await openai_chat_stream(
+            writer.feed,
+            user_id=update.effective_user.id if update.effective_user else None,
+            notify=_queue_notifier(update.message),
             model="gpt-4o",
             messages=[{"role": "user", "content": prompt}]
         )
+        text = (text or "").strip()
+        if not text:
+            # пустой стрим — иначе в чате так и останется «⏳ Думаю…»
+            logging.warning("[GPT_PSYCHOLOGIST] Пустой ответ модели")
+            writer.header = ""
+            await writer.finish("⚠️ Произошла ошибка. Попробуй ещё раз позже.")
+            return
 
-        reply_markup = ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
-
-        await update.message.reply_text(
-            f"🧘 GPT-психолог:\n{response.choices[0].message.content.strip()}",
-            reply_markup=reply_markup
-        )
+        await writer.finish(text)
 
     except Exception as e:
         logging.error(f"[GPT_PSYCHOLOGIST] Ошибка при ответе: {e}")
-        await update.message.reply_text(
-            "⚠️ Произошла ошибка. Попробуй ещё раз позже.",
-            reply_markup=ReplyKeyboardMarkup([["↩️ Выйти в меню"]], resize_keyboard=True)
-        )
+        writer.header = ""
+        await writer.finish("⚠️ Произошла ошибка. Попробуй ещё раз позже.")
 
 def extract_tx_id(d: dict) -> str:
     """Пытаемся достать идентификатор транзакции из разных возможных ключей IPN."""
@@ -2123,22 +5003,26 @@ def validate_payment_fields(data: dict, plan: str) -> tuple[bool, str, Decimal,
     return True, "ok", amount, currency, network_norm
 
 
-# ✅ Webhook от CryptoCloud
-@app_flask.route("/cryptocloud_webhook", methods=["POST"])
-def cryptocloud_webhook():
-    body = request.get_data()  # bytes
+# ✅ Webhook от CryptoCloud (aiohttp, тот же event loop, что и у бота — без тредов)
+async def cryptocloud_webhook(request: web.Request) -> web.Response:
+    body = await request.read()  # bytes
     signature_hdr = (request.headers.get("X-Signature-SHA256") or "").strip().lower()
     calc_sig = hmac.new(API_SECRET.encode(), body, hashlib.sha256).hexdigest().lower()
 
     # Безопасное сравнение подписи
     if not hmac.compare_digest(signature_hdr, calc_sig):
         logging.warning("⚠ Неверная подпись IPN")
-        return jsonify({"status": "invalid signature"}), 400
+        IPN_OUTCOMES["invalid_signature"].inc()
+        return web.json_response({"status": "invalid signature"}, status=400)
 
-    data = request.json or {}
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = None
     if not isinstance(data, dict):
         logging.warning("⚠ Некорректное тело IPN (не dict)")
-        return jsonify({"status": "bad payload"}), 400
+        IPN_OUTCOMES["bad_payload"].inc()
+        return web.json_response({"status": "bad payload"}, status=400)
 
     status = str(data.get("status") or "").lower()
     raw_order_id = (data.get("order_id") or "").strip()
@@ -2157,61 +5041,58 @@ def cryptocloud_webhook():
 
     # Принимаем только успешные платежи
     if status != "paid":
-        return jsonify({"status": "ignored (not paid)"}), 200
+        IPN_OUTCOMES["ignored"].inc()
+        return web.json_response({"status": "ignored (not paid)"})
 
     if not raw_order_id:
-        return jsonify({"status": "missing order_id"}), 400
+        IPN_OUTCOMES["bad_order_id"].inc()
+        return web.json_response({"status": "missing order_id"}, status=400)
 
     # Парсим order_id → (user_id, username, plan)
     try:
         user_id, username, plan = parse_order_id(raw_order_id)
     except Exception as e:
         logging.error("❌ Ошибка парсинга order_id='%s': %s", raw_order_id, e)
-        return jsonify({"status": "bad order_id"}), 400
+        IPN_OUTCOMES["bad_order_id"].inc()
+        return web.json_response({"status": "bad order_id"}, status=400)
 
-    # Идемпотентность с TTL: не обрабатываем повторно одну и ту же транзакцию/платёж
+    # Идемпотентность: журнал платежей в SQLite переживает рестарты и поздние повторы IPN
     unique_key = tx_id or f"{raw_order_id}:{data.get('amount')}:{data.get('currency')}"
-    now = time.time()
-    # Очистка старых ключей
-    for k, ts in list(PROCESSED_PAYMENTS.items()):
-        if now - ts > PROCESSED_TTL_SEC:
-            PROCESSED_PAYMENTS.pop(k, None)
-    if unique_key in PROCESSED_PAYMENTS:
+    if unique_key in PAYMENT_LEDGER:
+        # быстрый путь без записи; окончательное решение — в claim() ниже
         logging.info("♻️ Повторная доставка IPN, пропускаем. key='%s'", unique_key)
-        return jsonify({"status": "duplicate ignored"}), 200
-    PROCESSED_PAYMENTS[unique_key] = now
+        IPN_OUTCOMES["duplicate"].inc()
+        return web.json_response({"status": "duplicate ignored"})
 
     # Жёсткая валидация суммы/валюты/сети (с нормализацией сетей внутри)
     ok, reason, amount, currency, network = validate_payment_fields(data, plan)
     if not ok:
         logging.error("⛔ Валидация не пройдена: %s. plan=%s, tx_id='%s'", reason, plan, tx_id)
-        return jsonify({"status": "validation failed", "reason": reason}), 400
+        IPN_OUTCOMES["validation_failed"].inc()
+        return web.json_response({"status": "validation failed", "reason": reason}, status=400)
+
+    if not PAYMENT_LEDGER.claim(unique_key, user_id, plan, amount, currency):
+        logging.info("♻️ Повторная доставка IPN, пропускаем. key='%s'", unique_key)
+        IPN_OUTCOMES["duplicate"].inc()
+        return web.json_response({"status": "duplicate ignored"})
 
-    # Активируем доступ локально + асинхронно логируем в Google Sheets
+    # Активируем доступ в локальном хранилище (источник правды). Если запись не удалась —
+    # отвечаем 500, чтобы CryptoCloud повторил доставку IPN.
     try:
-        ALLOWED_USERS.add(user_id)
-        # продлеваем TTL кеша, чтобы не перезатёрся до фонового обновления
-        global ALLOWED_USERS_TIMESTAMP
-        ALLOWED_USERS_TIMESTAMP = time.time()
+        # payment_key: если прошлый запуск упал между grant и complete, повтор не продлит срок ещё раз
+        granted = ENTITLEMENTS.grant(user_id, username, plan, "payment", payment_key=unique_key)
+        PAYMENT_LEDGER.complete(unique_key)
+    except Exception:
+        logging.exception("❌ Не удалось выдать доступ user_id=%s", user_id)
+        PAYMENT_LEDGER.release(unique_key)
+        IPN_OUTCOMES["storage_error"].inc()
+        return web.json_response({"status": "storage error"}, status=500)
 
-        # Планируем запись в Sheets на основном loop (через тред-пул)
-        loop = getattr(app_flask, "loop", None) or asyncio.get_event_loop()
-        asyncio.run_coroutine_threadsafe(
-            asyncio.to_thread(log_payment, user_id, username),
-            loop
-        )
-    except Exception as e:
-        logging.error("❌ Ошибка постановки записи в Google Sheets: %s", e)
+    # Зеркалируем оплату в Google Sheets через очередь (ключ платежа — без дублей при повторном IPN)
+    log_payment(user_id, username, f"payment:{unique_key}", granted["plan"], granted["expires_at"])
 
-    # Уведомление пользователю — асинхронно в loop бота
-    try:
-        loop = getattr(app_flask, "loop", None) or asyncio.get_event_loop()
-        asyncio.run_coroutine_threadsafe(
-            notify_user_payment(user_id),
-            loop
-        )
-    except Exception as e:
-        logging.error("❌ Не удалось запланировать уведомление %s: %s", user_id, e)
+    # Уведомление пользователю — фоновой задачей, ответ CryptoCloud не ждёт Telegram
+    request.app["ptb"].create_task(notify_user_payment(user_id))
 
     logging.info(
         "🎉 Оплата подтверждена: user_id=%s, plan=%s, amount=%s %s%s, tx_id='%s'",
@@ -2223,7 +5104,8 @@ def cryptocloud_webhook():
         tx_id
     )
 
-    return jsonify({"ok": True}), 200
+    IPN_OUTCOMES["paid"].inc()
+    return web.json_response({"ok": True})
 
 def sanitize_username(u: str | None) -> str:
     if not u:
@@ -2260,12 +5142,211 @@ async def send_payment_link(update, context):
     ])
     await update.message.reply_text("💵 Выбери вариант доступа к GPT‑Трейдеру:", reply_markup=keyboard)
 
-# 🚀 Запуск Flask в отдельном потоке с loop
-def run_flask(loop):
-    app_flask.loop = loop
+# =====================[ UPDATE DISPATCH ]=====================
+# Апдейты разных пользователей обрабатываются параллельно (до UPDATE_WORKERS одновременно),
+# апдейты одного пользователя — строго по очереди: ConversationHandler и user_data не гоняются.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_MAX_PENDING = 4096  # верхняя граница апдейтов «в полёте» (включая ждущих своей очереди)
+
+
+def _update_order_key(update: object):
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, workers: int = UPDATE_WORKERS):
+        # Семафор базового класса — только предохранитель; реальный лимит — self._workers,
+        # который берётся ПОСЛЕ очереди пользователя, чтобы ждущие апдейты не занимали воркеры.
+        super().__init__(max_concurrent_updates=UPDATE_MAX_PENDING)
+        self.workers = max(1, workers)
+        self._workers = asyncio.Semaphore(self.workers)
+        self._user_locks: Dict[Any, Tuple[asyncio.Lock, int]] = {}
+        self._background: Dict[Any, int] = {}  # хендлеры block=False, ещё работающие после апдейта
+        self._waits = deque(maxlen=1000)
+        self.processed = 0
+        self.active = 0
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        started = time.monotonic()
+        key = _update_order_key(update)
+        if key is None:
+            async with self._workers:
+                await self._run(started, coroutine)
+            return
+
+        lock, refs = self._user_locks.get(key) or (asyncio.Lock(), 0)
+        self._user_locks[key] = (lock, refs + 1)
+        try:
+            async with lock:
+                async with self._workers:
+                    await self._run(started, coroutine)
+        finally:
+            lock, refs = self._user_locks[key]
+            if refs <= 1:
+                del self._user_locks[key]
+            else:
+                self._user_locks[key] = (lock, refs - 1)
+
+    async def _run(self, started: float, coroutine: "Awaitable[Any]") -> None:
+        self._waits.append(time.monotonic() - started)
+        self.active += 1
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+
+    def track(self, update: object, task: asyncio.Task) -> None:
+        """Задача хендлера block=False: апдейт уже отпустил очередь, а хендлер ещё пишет в user_data."""
+        key = _update_order_key(update)
+        if key is None:
+            return
+        self._background[key] = self._background.get(key, 0) + 1
+        task.add_done_callback(lambda _task: self._untrack(key))
+
+    def _untrack(self, key: Any) -> None:
+        left = self._background.get(key, 0) - 1
+        if left > 0:
+            self._background[key] = left
+        else:
+            self._background.pop(key, None)
+
+    def busy(self, key: Any) -> bool:
+        """У пользователя есть апдейт в обработке или в очереди либо не завершён хендлер block=False."""
+        return key in self._user_locks or key in self._background
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats_lines(self) -> List[str]:
+        waits = sorted(self._waits)
+        if waits:
+            p50, p95 = waits[len(waits) // 2], waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+            wait_txt = f"ожидание p50={p50 * 1000:.0f}мс p95={p95 * 1000:.0f}мс max={waits[-1] * 1000:.0f}мс"
+        else:
+            wait_txt = "ожидание —"
+        return [
+            f"• Апдейты: воркеров {self.active}/{self.workers}, пользователей в очереди {len(self._user_locks)}, "
+            f"фоновых хендлеров у {len(self._background)}, обработано {self.processed}, {wait_txt}"
+        ]
+
+
+UPDATE_PROCESSOR = PerUserUpdateProcessor()
+
+
+class BotApplication(Application):
+    """Application, который сообщает UPDATE_PROCESSOR о задачах хендлеров block=False."""
+
+    def create_task(self, coroutine, update: object = None, *, name: str | None = None) -> asyncio.Task:
+        task = super().create_task(coroutine, update, name=name)
+        if update is not None:
+            UPDATE_PROCESSOR.track(update, task)
+        return task
+
+
+# =====================[ TELEGRAM WEBHOOK MODE ]=====================
+# TELEGRAM_MODE=webhook — апдейты приходят POST'ом на тот же aiohttp-сервер, что и IPN.
+# Публичный адрес: WEBHOOK_BASE_URL (на Render подставится RENDER_EXTERNAL_URL).
+TELEGRAM_MODE = (os.getenv("TELEGRAM_MODE", "polling") or "polling").strip().lower()
+WEBHOOK_BASE_URL = (os.getenv("WEBHOOK_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL") or "").strip().rstrip("/")
+WEBHOOK_PATH = "/telegram_webhook"
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ и -; до 256 символов)
+WEBHOOK_SECRET = (
+    os.getenv("TELEGRAM_WEBHOOK_SECRET")
+    or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()
+)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Адрес Bot API: свой telegram-bot-api сервер или заглушка tools/replay_updates.py --fake-api
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot").strip()
+TELEGRAM_API_FILE_URL = os.getenv("TELEGRAM_API_FILE_URL", "https://api.telegram.org/file/bot").strip()
+
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    """Принимает апдейт от Telegram и кладёт его в очередь приложения (обработка — асинхронно)."""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        logging.warning("⚠ Telegram webhook: неверный secret token")
+        return web.Response(status=403)
+
+    ptb_app: Application = request.app["ptb"]
+    try:
+        update = Update.de_json(await request.json(), ptb_app.bot)
+    except Exception as e:
+        logging.warning(f"⚠ Telegram webhook: некорректный апдейт: {e}")
+        return web.Response(status=400)
+
+    await ptb_app.update_queue.put(update)
+    return web.Response()
+
+
+async def set_telegram_webhook(bot) -> None:
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("TELEGRAM_MODE=webhook требует WEBHOOK_BASE_URL (или RENDER_EXTERNAL_URL)")
+    await bot.set_webhook(
+        url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    logging.info(f"🔌 Webhook установлен: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+
+
+def run_webhook(app: Application) -> None:
+    """
+    Аналог run_polling для webhook-режима: апдейты приходят на наш aiohttp-сервер,
+    поэтому встроенный run_webhook (свой tornado-сервер) не используем.
+    """
+    async def _serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:  # Windows
+                pass
+
+        await app.initialize()
+        try:
+            if app.post_init:
+                await app.post_init(app)
+            await app.start()
+            await stop.wait()
+        finally:
+            if app.running:
+                await app.stop()
+            if app.post_shutdown:
+                await app.post_shutdown(app)
+            await app.shutdown()
+
+    asyncio.run(_serve())
+
+
+# 🌐 HTTP-сервер (aiohttp) на event loop бота: стартует в post_init, гасится в post_shutdown
+def build_web_app(ptb_app: Application) -> web.Application:
+    web_app = web.Application()
+    web_app["ptb"] = ptb_app
+    web_app.router.add_post("/cryptocloud_webhook", cryptocloud_webhook)
+    web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    web_app.router.add_get("/", render_health_ok)  # GET + HEAD
+    web_app.router.add_get("/metrics", render_metrics)
+    return web_app
+
+
+async def start_web_server(ptb_app: Application) -> web.AppRunner:
     port = int(os.environ.get("PORT", 5000))
-    print(f"[render-port] Server bound to PORT={port}")
-    app_flask.run(host="0.0.0.0", port=port)
+    runner = web.AppRunner(build_web_app(ptb_app), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=port).start()
+    logging.info(f"[render-port] Server bound to PORT={port}")
+    return runner
 
 # 👇 ВСТАВЬ ЗДЕСЬ:
 ADMIN_IDS = {407721399}  # замени на свой user_id
@@ -2274,9 +5355,17 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PHOTO_PATH = os.path.join(BASE_DIR, "GPT-Трейдер помощник.png")
 
 # Health-check для Render
-@app_flask.route("/", methods=["GET", "HEAD"])
-def render_health_ok():
-    return "OK", 200
+async def render_health_ok(request: web.Request) -> web.Response:
+    return web.Response(text="OK")
+
+# Метрики в формате Prometheus (при METRICS_TOKEN — только с токеном)
+async def render_metrics(request: web.Request) -> web.Response:
+    if METRICS_TOKEN:
+        token = request.query.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        # байты: compare_digest на str с не-ASCII бросает TypeError (был бы 500 вместо 401)
+        if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+            return web.Response(status=401, text="unauthorized")
+    return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": METRICS_CONTENT_TYPE})
 
 # === Save post video (file_id) ===============================================
 async def save_post_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2409,18 +5498,20 @@ async def publish_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 last_err = e
                 logging.error(f"[publish_post] send_video by file_id ERROR: {e}")
 
-        # фолбэк — локальный файл
+        # фолбэк — локальный файл (через реестр: повторные публикации идут по file_id)
         if message is None and video_path.exists():
             try:
-                with video_path.open("rb") as v:
-                    message = await context.bot.send_video(
+                message = await MEDIA.send(
+                    video_path, "video",
+                    lambda v: context.bot.send_video(
                         chat_id=chat_id,
                         video=v,
                         caption=caption,
                         parse_mode="HTML",
                         supports_streaming=True,
                         reply_markup=keyboard_inline,
-                    )
+                    ),
+                )
                 logging.info("[publish_post] send_video by file path OK")
             except Exception as e_video:
                 last_err = e_video
@@ -2449,14 +5540,16 @@ async def publish_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"Нет источника видео (file_id/файл/URL) и нет фото ({photo_path}). "
                     f"Последняя ошибка по видео: {last_err}"
                 )
-            with photo_path.open("rb") as ph:
-                message = await context.bot.send_photo(
+            message = await MEDIA.send(
+                photo_path, "photo",
+                lambda ph: context.bot.send_photo(
                     chat_id=chat_id,
                     photo=ph,
                     caption=caption,
                     parse_mode="HTML",
                     reply_markup=keyboard_inline,
-                )
+                ),
+            )
             logging.info("[publish_post] send_photo OK")
 
         # закреп
@@ -2476,6 +5569,303 @@ async def publish_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.exception("[publish_post] FAILED")
         await update.message.reply_text(f"⚠️ Не удалось опубликовать/закрепить пост.\nПричина: {e}")
 
+# =====================[ BROADCAST ENGINE ]=====================
+# Рассылка — фоновая задача с курсором по получателям в SQLite: после рестарта
+# продолжается с того же места. Лимиты Telegram: ~30 сообщений/с глобально и 1/с на чат.
+BROADCAST_DB = os.getenv("BROADCAST_DB", str(DATA_DIR / "broadcasts.db"))
+BROADCAST_RATE_PER_SEC = float(os.getenv("BROADCAST_RATE_PER_SEC", "25"))  # с запасом к 30/с
+BROADCAST_PER_CHAT_INTERVAL_SEC = 1.0
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_PROGRESS_EVERY_SEC = 5.0
+# Отметки «доставлено» копятся в памяти и пишутся пачкой в потоке: не чаще раза в 50 отправок
+# или в BROADCAST_PROGRESS_EVERY_SEC. При падении повторно уйдут только неотмеченные.
+BROADCAST_MARK_BATCH = 50
+
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, burst до capacity."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def drain(self) -> None:
+        """Обнуляет запас (после RetryAfter начинаем разгон с нуля)."""
+        self._tokens = 0.0
+        self._last = time.monotonic()
+
+
+class BroadcastEngine:
+    def __init__(self, path: str | Path):
+        self._lock = threading.Lock()
+        self._db = _sqlite_connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " text TEXT NOT NULL,"
+            " admin_chat_id INTEGER NOT NULL,"
+            " progress_message_id INTEGER,"
+            " status TEXT NOT NULL DEFAULT 'running',"
+            " created REAL NOT NULL,"
+            " finished REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_recipients ("
+            " broadcast_id INTEGER NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'pending',"  # pending | sent | failed | blocked
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " PRIMARY KEY (broadcast_id, chat_id))"
+        )
+        self._bucket = TokenBucket(BROADCAST_RATE_PER_SEC)
+        self._chat_next: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._marks: List[Tuple[str, str | None, int, int]] = []  # (status, error, job_id, chat_id)
+
+    # --- SQLite ---
+    def _create(self, text: str, admin_chat_id: int, recipients: List[int]) -> int:
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                cur = self._db.execute(
+                    "INSERT INTO broadcasts (text, admin_chat_id, created) VALUES (?, ?, ?)",
+                    (text, admin_chat_id, time.time()),
+                )
+                job_id = cur.lastrowid
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, chat_id) VALUES (?, ?)",
+                    [(job_id, cid) for cid in recipients],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def _job(self, job_id: int) -> Tuple[str, int, int | None]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT text, admin_chat_id, progress_message_id FROM broadcasts WHERE id = ?", (job_id,)
+            ).fetchone()
+
+    def _set_progress_message(self, job_id: int, message_id: int) -> None:
+        with self._lock:
+            self._db.execute("UPDATE broadcasts SET progress_message_id = ? WHERE id = ?", (message_id, job_id))
+
+    def _pending(self, job_id: int) -> List[int]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chat_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending'", (job_id,)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def _write_marks(self, batch: List[Tuple[str, str | None, int, int]]) -> None:
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "UPDATE broadcast_recipients SET status = ?, attempts = attempts + 1, error = ?"
+                    " WHERE broadcast_id = ? AND chat_id = ?",
+                    batch,
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _counts(self, job_id: int) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status", (job_id,)
+            ).fetchall()
+        return {status: n for status, n in rows}
+
+    def _finish(self, job_id: int) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE broadcasts SET status = 'done', finished = ? WHERE id = ?", (time.time(), job_id)
+            )
+
+    def _running_jobs(self) -> List[int]:
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT id FROM broadcasts WHERE status = 'running'")]
+
+    async def _mark(self, job_id: int, chat_id: int, status: str, error: str | None = None) -> None:
+        self._marks.append((status, error, job_id, chat_id))
+        if len(self._marks) >= BROADCAST_MARK_BATCH:
+            await self._flush_marks()
+
+    async def _flush_marks(self) -> None:
+        if not self._marks:
+            return
+        batch, self._marks = self._marks, []
+        try:
+            await asyncio.to_thread(self._write_marks, batch)
+        except Exception:
+            logging.exception("[broadcast] не удалось сохранить отметки доставки")
+            self._marks[:0] = batch
+
+    def _flush_marks_now(self) -> None:
+        """Синхронная запись остатка — при отмене задачи (остановка бота), когда await уже нельзя."""
+        batch, self._marks = self._marks, []
+        if batch:
+            try:
+                self._write_marks(batch)
+            except Exception:
+                logging.exception("[broadcast] не удалось сохранить отметки доставки")
+
+    # --- запуск/возобновление ---
+    async def start_job(self, bot, text: str, admin_chat_id: int, recipients: List[int]) -> int:
+        job_id = await asyncio.to_thread(self._create, text, admin_chat_id, recipients)
+        progress = await bot.send_message(
+            chat_id=admin_chat_id, text=f"📤 Рассылка #{job_id}: 0/{len(recipients)}…"
+        )
+        await asyncio.to_thread(self._set_progress_message, job_id, progress.message_id)
+        self._spawn(bot, job_id)
+        return job_id
+
+    async def resume(self, bot) -> None:
+        for job_id in await asyncio.to_thread(self._running_jobs):
+            logging.info(f"[broadcast] возобновляю рассылку #{job_id}")
+            self._spawn(bot, job_id)
+
+    def _spawn(self, bot, job_id: int) -> None:
+        task = asyncio.create_task(self._run(bot, job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _t: self._tasks.pop(job_id, None))
+
+    async def stop(self) -> None:
+        """Останавливает задачи; незавершённые рассылки продолжатся после рестарта."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # --- отправка ---
+    async def _wait_turn(self, chat_id: int) -> None:
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        chat_wait = self._chat_next.get(chat_id, 0.0) - time.monotonic()
+        if chat_wait > 0:
+            await asyncio.sleep(chat_wait)
+        await self._bucket.acquire()
+        self._chat_next[chat_id] = time.monotonic() + BROADCAST_PER_CHAT_INTERVAL_SEC
+
+    async def _deliver(self, bot, job_id: int, chat_id: int, text: str) -> None:
+        attempt = 0
+        while True:
+            await self._wait_turn(chat_id)
+            try:
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=f"🚀 *VIP-обновление от трейдера:*\n\n{text}",
+                    parse_mode="Markdown",
+                )
+                await self._mark(job_id, chat_id, "sent")
+                return
+            except RetryAfter as e:
+                # Флуд-контроль глобальный: ставим на паузу всех воркеров
+                delay = float(e.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._bucket.drain()
+                logging.warning(f"[broadcast] RetryAfter {delay:.0f}с")
+            except Forbidden as e:
+                await self._mark(job_id, chat_id, "blocked", str(e))
+                return
+            except BadRequest as e:
+                await self._mark(job_id, chat_id, "failed", str(e))
+                return
+            except Exception as e:
+                attempt += 1
+                logging.warning(f"[broadcast] #{job_id} {chat_id}: попытка {attempt} не удалась: {e}")
+                if attempt >= BROADCAST_MAX_ATTEMPTS:
+                    await self._mark(job_id, chat_id, "failed", str(e))
+                    return
+                await asyncio.sleep(2 ** attempt)
+
+    @staticmethod
+    def _progress_text(job_id: int, counts: Dict[str, int], done: bool = False) -> str:
+        total = sum(counts.values())
+        sent, failed, blocked = counts.get("sent", 0), counts.get("failed", 0), counts.get("blocked", 0)
+        head = f"✅ Рассылка #{job_id} завершена." if done else f"📤 Рассылка #{job_id}: {total - counts.get('pending', 0)}/{total}…"
+        return (
+            f"{head}\n"
+            f"📬 Доставлено: {sent}\n"
+            f"🚫 Заблокировали бота: {blocked}\n"
+            f"⚠️ Ошибки: {failed}"
+        )
+
+    async def _report(self, bot, job_id: int, admin_chat_id: int, message_id: int | None, done: bool) -> None:
+        text = self._progress_text(job_id, await asyncio.to_thread(self._counts, job_id), done)
+        try:
+            if message_id and not done:
+                await bot.edit_message_text(chat_id=admin_chat_id, message_id=message_id, text=text)
+            else:
+                await bot.send_message(chat_id=admin_chat_id, text=text)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logging.warning(f"[broadcast] не удалось обновить прогресс: {e}")
+        except Exception as e:
+            logging.warning(f"[broadcast] не удалось обновить прогресс: {e}")
+
+    async def _run(self, bot, job_id: int) -> None:
+        text, admin_chat_id, message_id = await asyncio.to_thread(self._job, job_id)
+        queue: asyncio.Queue[int] = asyncio.Queue()
+        for chat_id in await asyncio.to_thread(self._pending, job_id):
+            queue.put_nowait(chat_id)
+
+        async def worker():
+            while True:
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await self._deliver(bot, job_id, chat_id, text)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logging.exception(f"[broadcast] #{job_id} {chat_id}")
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(BROADCAST_WORKERS, queue.qsize()))]
+        try:
+            while not all(w.done() for w in workers):
+                await asyncio.wait(workers, timeout=BROADCAST_PROGRESS_EVERY_SEC)
+                await self._flush_marks()
+                if not all(w.done() for w in workers):
+                    await self._report(bot, job_id, admin_chat_id, message_id, done=False)
+        except asyncio.CancelledError:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._flush_marks_now()
+            raise
+        await self._flush_marks()
+        await asyncio.to_thread(self._finish, job_id)
+        await self._report(bot, job_id, admin_chat_id, message_id, done=True)
+
+
+BROADCASTS = BroadcastEngine(BROADCAST_DB)
+
+
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in ADMIN_IDS:
@@ -2488,26 +5878,13 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     message_text = " ".join(args)
-    success_count = 0
-    failed_users = []
-
-    for vip_id in ALLOWED_USERS:
-        try:
-            await context.bot.send_message(
-                chat_id=vip_id,
-                text=f"🚀 *VIP-обновление от трейдера:*\n\n{message_text}",
-                parse_mode="Markdown"
-            )
-            success_count += 1
-        except Exception as e:
-            logging.error(f"[BROADCAST] Не удалось отправить VIP {vip_id}: {e}")
-            failed_users.append(vip_id)
+    recipients = sorted(get_allowed_users())
+    if not recipients:
+        await update.message.reply_text("ℹ️ Нет активных подписчиков для рассылки.")
+        return
 
-    await update.message.reply_text(
-        f"✅ Рассылка завершена.\n"
-        f"📬 Отправлено {success_count} пользователям.\n"
-        f"{'⚠️ Ошибки у некоторых пользователей.' if failed_users else ''}"
-    )
+    # Рассылка идёт в фоне; прогресс и итог придут отдельными сообщениями
+    await BROADCASTS.start_job(context.bot, message_text, update.effective_chat.id, recipients)
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Безопасно получаем message
@@ -2521,12 +5898,13 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        # Чтение всех записей из Google Sheets без блокировки event loop
-        records = await asyncio.to_thread(sheet.get_all_records)
-        total_records = len(records)
-        allowed_count = len(ALLOWED_USERS)
+        # Данные из зеркала Google Sheets (дочитываем только новые строки)
+        await asyncio.to_thread(SHEET_MIRROR.sync)
+        total_records = len(SHEET_MIRROR)
+        allowed_count = len(ENTITLEMENTS)
+        plans = await asyncio.to_thread(ENTITLEMENTS.plan_counts)
 
-        last_entry = records[-1] if records else {}
+        last_entry = SHEET_MIRROR.last_record()
         # Ограничим размер последней записи (на случай очень длинных значений)
         try:
             last_entry_str = json.dumps(last_entry, ensure_ascii=False, indent=2)
@@ -2537,8 +5915,12 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         text = (
             "📊 Статистика:\n\n"
-            f"• Подписчиков в ALLOWED_USERS: {allowed_count}\n"
-            f"• Всего записей в Google Sheets: {total_records}\n\n"
+            f"• Активных доступов: {allowed_count}"
+            + (" (" + ", ".join(f"{k}: {v}" for k, v in sorted(plans.items())) + ")" if plans else "")
+            + "\n"
+            f"• Всего записей в Google Sheets: {total_records}\n"
+            + "\n".join(SHEET_MIRROR.stats_lines() + SHEETS_WRITES.stats_lines() + MEDIA.stats_lines() + STATE.stats_lines() + USER_STATE.stats_lines() + UPDATE_PROCESSOR.stats_lines() + PRICES.stats_lines() + PRICE_FEED.stats_lines() + ALERTS.stats_lines() + VISION_CACHE.stats_lines() + STRUCTURED_STATS.stats_lines() + OPENAI_SCHEDULER.stats_lines() + OPENAI_LIMITER.stats_lines() + TRACER.stats_lines())
+            + "\n\n"
             "📝 Последняя запись:\n"
             f"{last_entry_str}"
         )
@@ -2564,8 +5946,9 @@ async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        # Чтение записей из Google Sheets без блокировки event loop
-        records = await asyncio.to_thread(sheet.get_all_records)
+        # Записи из зеркала Google Sheets (дочитываем только новые строки)
+        await asyncio.to_thread(SHEET_MIRROR.sync)
+        records = SHEET_MIRROR.records()
 
         # Готовим CSV в памяти
         import csv
@@ -2599,36 +5982,6 @@ async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await msg.reply_text("⚠️ Не удалось выгрузить пользователей.")
 
 
-# Универсальный загрузчик изображения (photo или document-картинка)
-async def _extract_image_bytes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> BytesIO | None:
-    msg = update.effective_message
-    file_id = None
-
-    if getattr(msg, "photo", None):
-        file_id = msg.photo[-1].file_id
-    elif getattr(msg, "document", None):
-        doc = msg.document
-        if (doc.mime_type or "").lower().startswith("image/"):
-            file_id = doc.file_id
-
-    if not file_id:
-        return None
-
-    tg_file = await context.bot.get_file(file_id)
-    bio = BytesIO()
-    await tg_file.download_to_memory(out=bio)  # PTB 21.x требует keyword-аргумент out=
-    bio.seek(0)
-    return bio
-
-def _to_jpeg_base64(bio: BytesIO) -> str:
-    bio.seek(0)
-    im = Image.open(bio).convert("RGB")
-    out = BytesIO()
-    im.save(out, format="JPEG", quality=90, optimize=True)
-    out.seek(0)
-    return base64.b64encode(out.read()).decode("ascii")
-
-
 # Безопасный вызов необязательных хендлеров (если их нет — не падаем)
 async def _call_if_exists(fn_name: str, update: Update, context: ContextTypes.DEFAULT_TYPE, fallback_text: str | None = None):
     fn = globals().get(fn_name)
@@ -2644,6 +5997,7 @@ async def _call_if_exists(fn_name: str, update: Update, context: ContextTypes.DE
 def _fallback_strategy() -> str:
     return "Краткий план не сформирован — пришли более чистый скрин (LuxAlgo SMC + уровни S/R)."
 
+@traced_update("update.message")
 async def unified_text_handler(update, context):
     """
     Единый роутер сообщений (PTB 21.x, async).
@@ -2664,26 +6018,7 @@ async def unified_text_handler(update, context):
         text = (getattr(msg, "text", "") or "").strip()
 
         # --- детекция присутствия изображения (photo / document / media group)
-        doc = getattr(msg, "document", None)
-        fn = (doc.file_name or "").lower() if doc else ""
-        mt = (doc.mime_type or "").lower() if doc else ""
-        is_image_doc = bool(doc and (mt.startswith("image/") or any(fn.endswith(ext) for ext in IMAGE_EXTS)))
-
-        att = getattr(msg, "effective_attachment", None)
-        att_has_image = False
-        if isinstance(att, list) and att:
-            for a in att:
-                if isinstance(a, PhotoSize):
-                    att_has_image = True
-                    break
-                if isinstance(a, Document):
-                    a_mt = (a.mime_type or "").lower()
-                    a_fn = (a.file_name or "").lower()
-                    if a_mt.startswith("image/") or any(a_fn.endswith(ext) for ext in IMAGE_EXTS):
-                        att_has_image = True
-                        break
-
-        has_photo = bool(getattr(msg, "photo", None)) or is_image_doc or att_has_image
+        has_photo = _pick_image_attachment(msg) is not None
 
         # ↩️ Выход в меню — сбрасываем все «ожидалки», показываем меню и выходим (без вызова handle_main)
         if text in ("↩️ Выйти в меню", "↩️ Вернуться в меню"):
@@ -2698,11 +6033,13 @@ async def unified_text_handler(update, context):
             ):
                 context.user_data.pop(k, None)
 
+            TRACER.annotate(route="menu_exit")
             await msg.reply_text("🔙 Вернулись в главное меню.", reply_markup=REPLY_MARKUP)
             return
 
         # 1) Экономкалендарь (фото/док-картинка)
         if context.user_data.get("awaiting_calendar_photo"):
+            TRACER.annotate(route="calendar")
             try:
                 bio = await _extract_image_bytes(update, context)
             except Exception:
@@ -2716,6 +6053,7 @@ async def unified_text_handler(update, context):
 
         # 2) Инвест-стратегия по фото
         if context.user_data.get("awaiting_strategy") == "photo":
+            TRACER.annotate(route="strategy")
             try:
                 bio = await _extract_image_bytes(update, context)
             except Exception:
@@ -2729,10 +6067,12 @@ async def unified_text_handler(update, context):
 
         # 3) Обычное фото/док-картинка/альбом -> трейдерский разбор
         if has_photo:
+            TRACER.annotate(route="photo")
             await handle_photo(update, context)
             return  # важно: не дублировать меню после ответа
 
         # 4) Иначе — главное меню
+        TRACER.annotate(route="main")
         await _call_if_exists(
             "handle_main",
             update, context,
@@ -2740,8 +6080,9 @@ async def unified_text_handler(update, context):
         )
         return
 
-    except Exception:
+    except Exception as e:
         logging.exception("unified_text_handler failed")
+        TRACER.annotate(error=type(e).__name__)
         try:
             await update.effective_message.reply_text("⚠️ Ошибка обработки сообщения. Попробуйте ещё раз.")
         except Exception:
@@ -2752,7 +6093,64 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔄 Бот перезапущен. Выбери действие:", reply_markup=REPLY_MARKUP)
     return ConversationHandler.END
 
+class TelegramMetricsRequest(HTTPXRequest):
+    """HTTPXRequest с гистограммой задержек Bot API по методу и счётчиком ответов 429."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+        name = url.rsplit("/", 1)[-1]
+        child = TELEGRAM_METHODS.get(name) or TELEGRAM_METHODS["other"]
+        if "/file/bot" in url:
+            name = "file"  # в URL файла — токен бота и путь, в имя спана их не пишем
+        started = time.perf_counter()
+        with TRACER.span(f"tg.{name}") as span:
+            try:
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+            span.set("status", code)
+        if code == 429:
+            TELEGRAM_FLOOD_WAITS.inc()
+        return code, payload
+
+
+# Фоновые задачи, запущенные в post_init (гасим в post_shutdown)
+_BG_TASKS: Dict[str, asyncio.Task] = {}
+_WEB: Dict[str, web.AppRunner] = {}
+
+
 async def post_init(app: Application) -> None:
+    if TELEGRAM_MODE == "webhook":
+        await set_telegram_webhook(app.bot)
+    else:
+        await _drop_webhook_for_polling(app)
+
+    # Фоновая отправка очереди записей в Google Sheets
+    SHEETS_WRITES.start()
+
+    # Выгрузка простаивающих user_data и бюджет памяти под bytes
+    USER_STATE.bind(app, STATE)
+    USER_STATE.start()
+
+    # Снятие доступа по истечении месячной подписки
+    _BG_TASKS["expiry_sweeper"] = asyncio.create_task(expiry_sweeper(app.bot))
+
+    # Незавершённые рассылки продолжаем с сохранённого курсора
+    await BROADCASTS.resume(app.bot)
+
+    # Стрим цен (необязательный) и алерты по уровням планов
+    ALERTS.start(app.bot)
+    if PRICE_FEED_ENABLED:
+        PRICE_FEED.start()
+
+    # 🌐 HTTP (CryptoCloud webhook + health-check) на том же loop; в webhook-режиме — обязательно
+    svc_type = (os.getenv("RENDER_SERVICE_TYPE", "web") or "web").lower()
+    if TELEGRAM_MODE == "webhook" or svc_type in ("web", "web_service", "webservice"):
+        _WEB["runner"] = await start_web_server(app)
+    else:
+        logging.info("[render-port] Worker mode detected — HTTP server is not started.")
+
+
+async def _drop_webhook_for_polling(app: Application) -> None:
     try:
         info = await app.bot.get_webhook_info()
         if info and info.url:
@@ -2764,24 +6162,56 @@ async def post_init(app: Application) -> None:
         # даже если не удалось получить/снять webhook — не валим запуск
         logging.error(f"⚠️ Не удалось проверить/снять webhook: {e}")
 
+
+async def post_shutdown(app: Application) -> None:
+    for task in _BG_TASKS.values():
+        task.cancel()
+    _BG_TASKS.clear()
+    await BROADCASTS.stop()
+    runner = _WEB.pop("runner", None)
+    if runner:
+        await runner.cleanup()
+    await SHEETS_WRITES.stop()
+    await USER_STATE.stop()
+    await ALERTS.stop()
+    await PRICE_FEED.stop()
+    await PRICES.aclose()
+    await asyncio.to_thread(TRACER.close)  # дописать очередь трейсов
+
 def main():
-    global global_bot, ALLOWED_USERS, ALLOWED_USERS_TIMESTAMP
+    global global_bot
 
     # 🔄 Кеш допуска при старте (не блокирует хендлеры)
-    ALLOWED_USERS = load_allowed_users()
-    ALLOWED_USERS_TIMESTAMP = time.time()
-    logging.info(f"📥 ALLOWED_USERS загружен при старте: {len(ALLOWED_USERS)} пользователей")
+    # Доступы читаются из локальной SQLite; Sheets при пустой базе — разовый bootstrap
+    if len(ENTITLEMENTS) == 0:
+        try:
+            sync_entitlements_from_sheet()
+        except Exception:
+            logging.exception("[entitlements] bootstrap из Sheets не удался")
+    logging.info(f"📥 Доступы загружены при старте: {len(ENTITLEMENTS)} пользователей")
 
-    # ✅ Telegram-приложение: увеличенные таймауты для Render + снятие webhook в post_init
+    # ✅ Telegram-приложение: увеличенные таймауты для Render + webhook/polling в post_init
     app = (
         ApplicationBuilder()
+        .application_class(BotApplication)  # учёт хендлеров block=False (см. USER_STATE.sweep)
         .token(TELEGRAM_TOKEN)
-        .connect_timeout(15)           # медленный коннект → даём запас
-        .read_timeout(30)              # чтение ответов (в т.ч. get_me)
-        .write_timeout(30)             # отправка больших payload'ов
-        .pool_timeout(5)               # ожидание свободного коннекта
-        .get_updates_read_timeout(60)  # long-poll таймаут для polling
+        .base_url(TELEGRAM_API_BASE_URL)
+        .base_file_url(TELEGRAM_API_FILE_URL)
+        .concurrent_updates(UPDATE_PROCESSOR)  # параллельно между пользователями, по порядку внутри
+        .persistence(STATE)            # user_data и шаги диалогов переживают рестарт
+        .context_types(ContextTypes(user_data=UserStateDict))  # user_data с вытеснением bytes на диск
+        .request(TelegramMetricsRequest(  # Bot API с метриками; таймауты — здесь, а не в билдере
+            connection_pool_size=256,  # как у билдера по умолчанию
+            connect_timeout=15,        # медленный коннект → даём запас
+            read_timeout=30,           # чтение ответов (в т.ч. get_me)
+            write_timeout=30,          # отправка больших payload'ов
+            pool_timeout=5,            # ожидание свободного коннекта
+        ))
+        # long-poll для polling: отдельный клиент без метрик (getUpdates висит до 60 с и исказил бы гистограмму);
+        # при заданном .request(...) билдер не принимает get_updates_read_timeout
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, read_timeout=60))
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
     logging.info("🚀 GPT-Трейдер стартовал!")
@@ -2789,16 +6219,6 @@ def main():
     # ✅ Глобальный bot для уведомлений из вебхуков
     global_bot = app.bot
 
-    # 🚀 Общий asyncio-loop (его передаём во Flask-поток для run_coroutine_threadsafe)
-    loop = asyncio.get_event_loop()
-
-    # 🌐 Flask (CryptoCloud webhook) в отдельном демонизированном потоке
-    svc_type = (os.getenv("RENDER_SERVICE_TYPE", "web") or "web").lower()
-    if svc_type in ("web", "web_service", "webservice"):
-        threading.Thread(target=run_flask, args=(loop,), daemon=True).start()
-    else:
-        logging.info("[render-port] Worker mode detected — Flask server is not started.")
-
     # ✅ Глобальный error handler
     async def error_handler(update, context):
         logging.exception("❌ Unhandled exception in handler")
@@ -2823,6 +6243,8 @@ def main():
             CommandHandler("restart", restart, block=False),
             MessageHandler(filters.Regex("^🔄 Перезапустить бота$"), restart),
         ],
+        name="therapy",
+        persistent=True,
     )
 
     # 📏 Калькулятор риска (вход и по кнопке, и по inline-колбэку)
@@ -2841,6 +6263,8 @@ def main():
             CommandHandler("restart", restart, block=False),
             MessageHandler(filters.Regex("^🔄 Перезапустить бота$"), restart),
         ],
+        name="risk_calc",
+        persistent=True,
     )
 
     # 📌 Сетап (многошаговый ввод) — добавлено состояние SETUP_WAIT_ENTRY
@@ -2859,6 +6283,8 @@ def main():
             CommandHandler("restart", restart, block=False),
             MessageHandler(filters.Regex("^🔄 Перезапустить бота$"), restart),
         ],
+        name="setup",
+        persistent=True,
     )
 
     # ✅ Команды
@@ -2888,14 +6314,22 @@ def main():
         )
     )
 
-    # 🚀 Запуск polling (post_init уже снял webhook с drop_pending_updates=True)
-    app.run_polling()
+    if TELEGRAM_MODE == "webhook":
+        # 🚀 Апдейты приходят на aiohttp-сервер (post_init установил webhook)
+        run_webhook(app)
+    else:
+        # 🚀 Запуск polling (post_init уже снял webhook с drop_pending_updates=True)
+        app.run_polling()
 
-def log_payment(user_id, username):
+def log_payment(user_id, username, idem_key: str | None = None, plan: str = "lifetime",
+                expires_at: float | None = None):
     try:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        safe_append_row([str(user_id), username, timestamp])
-        logging.info(f"🧾 Записано в Google Sheets: {user_id}, {username}, {timestamp}")
+        # plan и срок — чтобы после потери локальной базы импорт из листа восстановил доступ как был
+        expires = datetime.fromtimestamp(expires_at).strftime("%Y-%m-%d %H:%M:%S") if expires_at else ""
+        row = [str(user_id), username, timestamp, plan, expires]
+        if safe_append_row(row, idem_key or f"payment:{user_id}:{timestamp}"):
+            logging.info(f"🧾 В очереди на запись в Google Sheets: {user_id}, {username}, {timestamp}, {plan}")
     except Exception as e:
         logging.error(f"❌ Ошибка при записи в Google Sheets: {e}")
 
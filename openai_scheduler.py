@@ -0,0 +1,202 @@
+"""
+Планировщик запросов к OpenAI: один на процесс, живёт в event loop бота.
+
+  • глобальный лимит одновременных запросов (слоты);
+  • бюджет токенов в минуту — скользящее окно, запрос ждёт, пока в окне не освободится место;
+  • честная очередь: внутри приоритета round-robin по пользователям, платные — вперёд.
+
+Сам планировщик в сеть не ходит: run() выдаёт слот и вызывает factory. Поэтому его можно
+проверять без OpenAI (tests/test_openai_scheduler.py), а весь путь бота — против
+tools/fake_openai.py через OPENAI_BASE_URL.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List
+
+from tracing import NOOP_SPAN
+
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+
+
+@dataclass(eq=False)
+class _OpenAITicket:
+    user_key: Any
+    priority: int
+    tokens: int
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class OpenAIScheduler:
+    """Асинхронный планировщик запросов к OpenAI (один на процесс, живёт в loop бота)."""
+
+    def __init__(self, max_concurrency: int = 8, tpm_budget: int = 0, tracer=None, window_sec: float = 60.0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.tpm_budget = max(0, tpm_budget)
+        self.window_sec = window_sec  # окно бюджета токенов (в тестах — доли секунды)
+        self._tracer = tracer
+        self._queues: Dict[int, "OrderedDict[Any, deque]"] = {
+            PRIORITY_PAID: OrderedDict(),
+            PRIORITY_FREE: OrderedDict(),
+        }
+        self._active = 0
+        self._window: deque = deque()  # (ts, tokens) за последние window_sec
+        self._window_tokens = 0
+        self._timer: asyncio.TimerHandle | None = None
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    # ---- бюджет токенов ----
+    def _trim_window(self, now: float) -> None:
+        while self._window and now - self._window[0][0] >= self.window_sec:
+            _, t = self._window.popleft()
+            self._window_tokens -= t
+
+    def _budget_wait(self, tokens: int, now: float) -> float:
+        if not self.tpm_budget:
+            return 0.0
+        self._trim_window(now)
+        if not self._window or self._window_tokens + tokens <= self.tpm_budget:
+            return 0.0
+        need = self._window_tokens + tokens - self.tpm_budget
+        freed = 0
+        for ts, t in self._window:
+            freed += t
+            if freed >= need:
+                return max(0.0, ts + self.window_sec - now)
+        return self.window_sec
+
+    # ---- очередь ----
+    def _head(self) -> tuple[int, Any] | None:
+        for prio in sorted(self._queues):
+            q = self._queues[prio]
+            if q:
+                return prio, next(iter(q))
+        return None
+
+    def _pop_head(self, prio: int, user_key: Any) -> _OpenAITicket:
+        q = self._queues[prio]
+        dq = q[user_key]
+        ticket = dq.popleft()
+        if dq:
+            q.move_to_end(user_key)  # round-robin: следующий запрос этого юзера — после остальных
+        else:
+            del q[user_key]
+        return ticket
+
+    def _discard(self, ticket: _OpenAITicket) -> None:
+        q = self._queues[ticket.priority]
+        dq = q.get(ticket.user_key)
+        if dq is None:
+            return
+        try:
+            dq.remove(ticket)
+        except ValueError:
+            return
+        if not dq:
+            del q[ticket.user_key]
+
+    def _pump(self) -> None:
+        now = time.monotonic()
+        while self._active < self.max_concurrency:
+            head = self._head()
+            if head is None:
+                return
+            prio, user_key = head
+            ticket = self._queues[prio][user_key][0]
+            if ticket.future.done():  # отменён, пока стоял в очереди
+                self._pop_head(prio, user_key)
+                continue
+            wait = self._budget_wait(ticket.tokens, now)
+            if wait > 0:
+                if self._timer is None:
+                    loop = asyncio.get_running_loop()
+                    self._timer = loop.call_later(wait, self._on_timer)
+                return
+            self._pop_head(prio, user_key)
+            self._active += 1
+            self._window.append((now, ticket.tokens))
+            self._window_tokens += ticket.tokens
+            ticket.future.set_result(None)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._pump()
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._pump()
+
+    def position(self, ticket: _OpenAITicket) -> int:
+        """Примерное число запросов впереди (с учётом приоритета и round-robin)."""
+        ahead = sum(len(dq) for prio, q in self._queues.items() if prio < ticket.priority for dq in q.values())
+        q = self._queues[ticket.priority]
+        own = q.get(ticket.user_key)
+        k = own.index(ticket) if own and ticket in own else 0
+        ahead += k + sum(min(len(dq), k + 1) for uk, dq in q.items() if uk != ticket.user_key)
+        return ahead
+
+    def queued(self) -> int:
+        return sum(len(dq) for q in self._queues.values() for dq in q.values())
+
+    async def run(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        *,
+        user_key: Any = None,
+        priority: int = PRIORITY_FREE,
+        tokens: int = 1000,
+        on_queued: Callable[[int], Awaitable[Any]] | None = None,
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        ticket = _OpenAITicket(
+            user_key=user_key if user_key is not None else "anon",
+            priority=priority if priority in self._queues else PRIORITY_FREE,
+            tokens=max(1, tokens),
+            future=loop.create_future(),
+            enqueued_at=time.monotonic(),
+        )
+        self._queues[ticket.priority].setdefault(ticket.user_key, deque()).append(ticket)
+        self._pump()
+
+        if not ticket.future.done():
+            span = self._tracer.span("openai.queue", ahead=self.position(ticket)) if self._tracer else NOOP_SPAN
+            with span:
+                # уведомление — внутри того же try: отмена во время отправки тоже снимает билет
+                try:
+                    if on_queued is not None:
+                        try:
+                            await on_queued(self.position(ticket))
+                        except Exception:
+                            logging.warning("[OpenAIScheduler] queue notify failed", exc_info=True)
+                    await ticket.future
+                except asyncio.CancelledError:
+                    if ticket.future.done() and not ticket.future.cancelled():
+                        self._release()  # слот уже выдан — вернуть
+                    else:
+                        ticket.future.cancel()
+                        self._discard(ticket)
+                    raise
+
+        waited = time.monotonic() - ticket.enqueued_at
+        self.completed += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            return await factory()
+        finally:
+            self._release()
+
+    def stats_lines(self) -> List[str]:
+        avg = (self.total_wait / self.completed) if self.completed else 0.0
+        self._trim_window(time.monotonic())
+        return [
+            f"• OpenAI: активно {self._active}/{self.max_concurrency}, в очереди {self.queued()}",
+            f"• OpenAI: ожидание avg {avg:.2f}s / max {self.max_wait:.2f}s, запросов {self.completed}",
+            f"• OpenAI: токенов за {self.window_sec:.0f}с ≈{self._window_tokens}" + (f" из {self.tpm_budget}" if self.tpm_budget else ""),
+        ]
@@ -0,0 +1,299 @@
+"""
+OpenAIScheduler (openai_scheduler.py) без сети: factory — корутина, которая отмечает порядок
+выдачи слотов. Проверяются приоритет платных, round-robin по пользователям, снятие билета
+при отмене в очереди и бюджет токенов (окно сжато до долей секунды).
+
+Весь путь openai_chat против HTTP — tools/fake_openai.py.
+"""
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai_scheduler import OpenAIScheduler, PRIORITY_FREE, PRIORITY_PAID  # noqa: E402
+
+
+async def _tick():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+class _Harness:
+    """Занимает все слоты «пробкой», ставит запросы в очередь по одному, потом открывает."""
+
+    def __init__(self, sched: OpenAIScheduler):
+        self.sched = sched
+        self.order = []
+        self.gate = asyncio.Event()
+        self.tasks = []
+
+    async def block(self):
+        for _ in range(self.sched.max_concurrency):
+            self.tasks.append(asyncio.create_task(self.sched.run(self.gate.wait, user_key="blocker")))
+        await _tick()
+
+    async def enqueue(self, label, **kw):
+        async def factory():
+            self.order.append(label)
+        task = asyncio.create_task(self.sched.run(factory, **kw))
+        self.tasks.append(task)
+        await _tick()
+        return task
+
+    async def release(self):
+        self.gate.set()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def test_paid_before_free():
+    async def main():
+        h = _Harness(OpenAIScheduler(max_concurrency=1))
+        await h.block()
+        await h.enqueue("free1", user_key=1, priority=PRIORITY_FREE)
+        await h.enqueue("free2", user_key=2, priority=PRIORITY_FREE)
+        await h.enqueue("paid", user_key=3, priority=PRIORITY_PAID)
+        await h.release()
+        return h.order
+
+    assert asyncio.run(main()) == ["paid", "free1", "free2"]
+
+
+def test_round_robin_between_users():
+    async def main():
+        h = _Harness(OpenAIScheduler(max_concurrency=1))
+        await h.block()
+        for i in range(3):
+            await h.enqueue(f"a{i}", user_key="a")
+        for i in range(2):
+            await h.enqueue(f"b{i}", user_key="b")
+        await h.enqueue("c0", user_key="c")
+        await h.release()
+        return h.order
+
+    # одна «жадная» очередь a не задерживает b и c дольше, чем на один свой запрос
+    assert asyncio.run(main()) == ["a0", "b0", "c0", "a1", "b1", "a2"]
+
+
+def test_position_counts_priority_and_round_robin():
+    async def main():
+        sched = OpenAIScheduler(max_concurrency=1)
+        h = _Harness(sched)
+        await h.block()
+        positions = {}
+
+        def remember(label):
+            async def on_queued(pos):
+                positions[label] = pos
+            return on_queued
+
+        await h.enqueue("a0", user_key="a", on_queued=remember("a0"))
+        await h.enqueue("a1", user_key="a", on_queued=remember("a1"))
+        await h.enqueue("b0", user_key="b", on_queued=remember("b0"))
+        await h.enqueue("p0", user_key="p", priority=PRIORITY_PAID, on_queued=remember("p0"))
+        await h.release()
+        return positions
+
+    # b0 встаёт перед a1 (round-robin), платный — в голову очереди
+    assert asyncio.run(main()) == {"a0": 0, "a1": 1, "b0": 1, "p0": 0}
+
+
+def test_cancel_while_queued_frees_place():
+    async def main():
+        sched = OpenAIScheduler(max_concurrency=1)
+        h = _Harness(sched)
+        await h.block()
+        doomed = await h.enqueue("doomed", user_key=1)
+        await h.enqueue("next", user_key=2)
+        assert sched.queued() == 2
+        doomed.cancel()
+        await _tick()
+        assert sched.queued() == 1
+        await h.release()
+        return sched, doomed, h.order
+
+    sched, doomed, order = asyncio.run(main())
+    assert doomed.cancelled()
+    assert order == ["next"]
+    assert sched._active == 0 and sched.queued() == 0
+
+
+def test_cancel_during_queue_notification():
+    async def main():
+        sched = OpenAIScheduler(max_concurrency=1)
+        h = _Harness(sched)
+        await h.block()
+        notified = asyncio.Event()
+
+        async def slow_notify(_pos):
+            notified.set()
+            await asyncio.sleep(10)  # например, reply_text завис на сети
+
+        task = await h.enqueue("doomed", user_key=1, on_queued=slow_notify)
+        await notified.wait()
+        task.cancel()
+        await _tick()
+        queued_after_cancel = sched.queued()
+        await h.enqueue("next", user_key=2)
+        await h.release()
+        return sched, queued_after_cancel, h.order
+
+    sched, queued_after_cancel, order = asyncio.run(main())
+    assert queued_after_cancel == 0
+    assert order == ["next"]
+    assert sched._active == 0
+
+
+def test_cancel_while_running_releases_slot():
+    async def main():
+        sched = OpenAIScheduler(max_concurrency=1)
+        running = asyncio.create_task(sched.run(lambda: asyncio.sleep(10), user_key=1))
+        await _tick()
+        assert sched._active == 1
+        running.cancel()
+        await _tick()
+        order = []
+
+        async def factory():
+            order.append("after")
+        await asyncio.wait_for(sched.run(factory, user_key=2), 1)
+        return sched, order
+
+    sched, order = asyncio.run(main())
+    assert order == ["after"]
+    assert sched._active == 0
+
+
+def test_failed_factory_releases_slot():
+    async def main():
+        sched = OpenAIScheduler(max_concurrency=1)
+
+        async def boom():
+            raise RuntimeError("upstream 500")
+        with pytest.raises(RuntimeError):
+            await sched.run(boom, user_key=1)
+        return sched
+
+    assert asyncio.run(main())._active == 0
+
+
+def test_concurrency_limit():
+    async def main():
+        sched = OpenAIScheduler(max_concurrency=3)
+        peak = current = 0
+
+        async def factory():
+            nonlocal peak, current
+            current += 1
+            peak = max(peak, current)
+            await asyncio.sleep(0.01)
+            current -= 1
+        await asyncio.gather(*(sched.run(factory, user_key=i % 4) for i in range(20)))
+        return sched, peak
+
+    sched, peak = asyncio.run(main())
+    assert peak == 3
+    assert sched.completed == 20 and sched._active == 0
+
+
+def test_tpm_budget_delays_until_window_frees():
+    window = 0.3
+
+    async def main():
+        sched = OpenAIScheduler(max_concurrency=4, tpm_budget=100, window_sec=window)
+        started = {}
+        t0 = time.monotonic()
+
+        async def factory(label):
+            started[label] = time.monotonic() - t0
+        await sched.run(lambda: factory("first"), user_key=1, tokens=60)
+        await sched.run(lambda: factory("fits"), user_key=2, tokens=40)
+        await sched.run(lambda: factory("over"), user_key=3, tokens=30)
+        return started
+
+    started = asyncio.run(main())
+    assert started["first"] < 0.05 and started["fits"] < 0.05
+    assert window - 0.05 <= started["over"] < window + 0.2
+
+
+def test_tpm_budget_does_not_block_oversized_request_forever():
+    async def main():
+        sched = OpenAIScheduler(max_concurrency=1, tpm_budget=100, window_sec=0.2)
+        done = []
+
+        async def factory():
+            done.append(True)
+        # больше бюджета целиком: пропускается при пустом окне, а не ждёт вечно
+        await asyncio.wait_for(sched.run(factory, user_key=1, tokens=500), 1)
+        return done
+
+    assert asyncio.run(main()) == [True]
+
+
+# ---------- через HTTP: настоящий AsyncOpenAI против tools/fake_openai.py ----------
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+
+from aiohttp import web  # noqa: E402
+from openai import AsyncOpenAI, RateLimitError  # noqa: E402
+
+from fake_openai import DEFAULT_REPLY, build_app  # noqa: E402
+
+
+async def _serve(app: web.Application):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    client = AsyncOpenAI(base_url=f"http://127.0.0.1:{port}/v1", api_key="test", max_retries=0)
+    return runner, client
+
+
+def test_fake_endpoint_sees_no_more_than_max_concurrency():
+    async def main():
+        app = build_app(latency_ms=30, chunk_ms=1)
+        runner, client = await _serve(app)
+        sched = OpenAIScheduler(max_concurrency=3)
+        messages = [{"role": "user", "content": "привет"}]
+        try:
+            async def plain():
+                resp = await client.chat.completions.create(model="gpt-4o", messages=messages)
+                return resp.choices[0].message.content
+
+            async def streamed():
+                stream = await client.chat.completions.create(model="gpt-4o", messages=messages, stream=True)
+                return "".join([c.choices[0].delta.content or "" async for c in stream if c.choices]).strip()
+
+            results = await asyncio.gather(
+                *(sched.run(plain, user_key=i % 4) for i in range(9)),
+                *(sched.run(streamed, user_key=i) for i in range(3)),
+            )
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return results, app["stats"], sched
+
+    results, stats, sched = asyncio.run(main())
+    assert results == [DEFAULT_REPLY] * 12
+    assert stats["requests"] == 12 and stats["stream"] == 3
+    assert stats["peak_active"] == 3
+    assert sched._active == 0
+
+
+def test_fake_endpoint_rate_limit_headers():
+    async def main():
+        runner, client = await _serve(build_app(rate_limit=1.0, retry_after=2.5))
+        try:
+            with pytest.raises(RateLimitError) as exc:
+                await client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": "x"}])
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return exc.value
+
+    err = asyncio.run(main())
+    assert err.code == "rate_limit_exceeded"
+    assert err.response.headers["retry-after-ms"] == "2500"
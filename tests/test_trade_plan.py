@@ -0,0 +1,169 @@
+"""
+Золотой корпус разбора торгового плана (trade_plan.py).
+
+LEGACY — что возвращали прежние re.search в handle_photo (вход, стоп, первый тейк);
+ожидаемое — текущий extract_trade_plan. Расхождения намеренные и помечены в комментариях.
+
+data/trade_plan_answers.json — ответы модели целиком (SMC из handle_photo и текстовый фолбэк
+стратегии) с ожидаемыми уровнями. Новые ответы из лога «Raw GPT analysis» добавлять туда же;
+tools/bench_trade_plan.py гоняет по ним и старый, и новый разбор.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "trade_plan_answers.json"),
+          encoding="utf-8") as _f:
+    ANSWERS = json.load(_f)
+
+from trade_plan import DcaStep, extract_trade_plan, parse_price, plan_from_json  # noqa: E402
+
+# (текст ответа модели, LEGACY (entry, stop, tp), ожидаемое (entry, stop, take_profits, bias))
+CORPUS = [
+    ("Entry: $65,000\nStopLoss: $63,500\nTakeProfit: $70,000",
+     (65000.0, 63500.0, 70000.0), (65000.0, 63500.0, [70000.0], None)),
+    ("Вход: 65 000\nСтоп: 63 500\nТейк: 70 000",
+     (65000.0, 63500.0, 70000.0), (65000.0, 63500.0, [70000.0], None)),
+    ("Entry: 1.0850\nStopLoss: 1.0800\nTakeProfit: 1.1000",
+     (1.085, 1.08, 1.1), (1.085, 1.08, [1.1], None)),
+    # изменено: запятая с 4 знаками — десятичная (раньше 10850)
+    ("Вход: 1,0850\nСтоп: 1,0800\nТейк: 1,1000",
+     (10850.0, 10800.0, 11000.0), (1.085, 1.08, [1.1], None)),
+    # изменено: «0,500» — 0.5, а не 500
+    ("Entry: 0,500\nStopLoss: 0,450\nTakeProfit: 0,650",
+     (500.0, 450.0, 650.0), (0.5, 0.45, [0.65], None)),
+    # изменено: «Stop loss» и «TP 2» / «TP1» распознаются, тейки — все в порядке текста
+    ("Entry 100\nStop loss 95\nTP 2: 120\nTP1: 110",
+     (100.0, None, None), (100.0, 95.0, [120.0, 110.0], None)),
+    # изменено: «Стоп-лосс» / «Тейк-профит» распознаются
+    ("Вход: 2500\nСтоп-лосс: 2400\nТейк-профит: 2800",
+     (2500.0, None, None), (2500.0, 2400.0, [2800.0], None)),
+    ("🎯 Entry: $3,100\n🚨 StopLoss: $3,000\n💰 TakeProfit: $3,400",
+     (3100.0, 3000.0, 3400.0), (3100.0, 3000.0, [3400.0], None)),
+    # тейки по эмодзи: все, первый совпадает с прежним
+    ("🎯 $3100\n🚨 $3000\n💰 $3400\n💰 $3600",
+     (3100.0, 3000.0, 3400.0), (3100.0, 3000.0, [3400.0, 3600.0], None)),
+    ("4️⃣ Bias: SELL\nEntry: 70000",
+     (70000.0, None, None), (70000.0, None, [], "SELL")),
+    ("Направление: ПОКУПКА\nВход: 1 234.5",
+     (1234.5, None, None), (1234.5, None, [], "ПОКУПКА")),
+    ("Нет уровней на графике", (None, None, None), (None, None, [], None)),
+]
+
+
+# Индексы CORPUS, где расхождение с LEGACY намеренное (см. комментарии выше)
+CHANGED = {3, 4, 5, 6}
+
+
+@pytest.mark.parametrize("text, legacy, expected", CORPUS)
+def test_corpus(text, legacy, expected):
+    plan = extract_trade_plan(text)
+    assert (plan.entry, plan.stop, plan.take_profits, plan.bias) == expected
+
+
+@pytest.mark.parametrize("text, legacy", [(t, l) for i, (t, l, _) in enumerate(CORPUS) if i not in CHANGED])
+def test_unchanged_cases_match_legacy(text, legacy):
+    plan = extract_trade_plan(text)
+    assert (plan.entry, plan.stop, plan.tp) == legacy
+
+
+@pytest.mark.parametrize("case", ANSWERS, ids=[c["id"] for c in ANSWERS])
+def test_model_answers(case):
+    plan = extract_trade_plan(case["text"])
+    got = {
+        "entry": plan.entry, "stop": plan.stop, "take_profits": plan.take_profits, "bias": plan.bias,
+        "dca": [[step.price, step.alloc_pct] for step in plan.dca],
+    }
+    assert got == case["expected"]
+
+
+# Номер тейка — часть метки, а не значение
+@pytest.mark.parametrize("text, tps", [
+    ("TP 120", [120.0]),
+    ("TP1: 110", [110.0]),
+    ("TP 1 120", [120.0]),
+    ("TP1 - 7.9", [7.9]),
+    ("Цель 3600", [3600.0]),
+    ("Цель 2", []),
+    ("стоп в безубыток после TP1.", []),
+])
+def test_tp_index_is_not_a_level(text, tps):
+    assert extract_trade_plan(text).take_profits == tps
+
+
+@pytest.mark.parametrize("raw, value", [
+    ("$65,000", 65000.0),
+    ("65 000", 65000.0),
+    ("65\u00a0000", 65000.0),  # неразрывный пробел
+    ("65\u202f000", 65000.0),
+    ("1,0850", 1.085),
+    ("0,500", 0.5),
+    ("0,5", 0.5),
+    ("1,234.56", 1234.56),
+    ("12.", 12.0),
+    ("", None),
+    ("abc", None),
+])
+def test_parse_price(raw, value):
+    assert parse_price(raw) == value
+
+
+def test_labelled_level_wins_over_emoji():
+    plan = extract_trade_plan("🎯 $99\nEntry: 100\n🚨 90")
+    assert (plan.entry, plan.stop) == (100.0, 90.0)
+
+
+def test_dca_steps():
+    text = "Купить 20% по $100\nBuy 30% at 90\nprice: 80, alloc_pct: 50%"
+    assert extract_trade_plan(text).dca == [DcaStep(100.0, 20.0), DcaStep(90.0, 30.0), DcaStep(80.0, 50.0)]
+
+
+def test_list_is_not_glued_into_one_number():
+    assert extract_trade_plan("TP: 100, 200").take_profits == [100.0]
+
+
+# ---- structured output ----
+def test_plan_from_json_smc():
+    raw = json.dumps({"analysis": " Разбор ", "entry": 65000, "stop": 63500.5,
+                      "take_profits": [70000, 72000], "bias": "buy"})
+    plan = plan_from_json(raw)
+    assert (plan.entry, plan.stop, plan.take_profits, plan.bias, plan.side, plan.analysis) == \
+        (65000.0, 63500.5, [70000.0, 72000.0], "BUY", "BUY", "Разбор")
+    assert plan.symbol is None  # ответ без поля symbol (старый кеш) — пары нет
+
+
+def test_plan_from_json_symbol():
+    raw = json.dumps({"analysis": "", "entry": 3455, "stop": 3540, "take_profits": [3200],
+                      "bias": "SELL", "symbol": " ETH/USDT "})
+    assert plan_from_json(raw).symbol == "ETH/USDT"
+    assert plan_from_json(json.dumps({"analysis": "", "symbol": ""})).symbol is None
+
+
+def test_plan_from_json_strategy():
+    raw = json.dumps({"entry": None, "avg_entry": "65,000", "take_profits": [],
+                      "dca": [{"price": 100, "alloc_pct": 20}, {"price": 0, "alloc_pct": 10}],
+                      "notes": [" Совет ", ""]})
+    plan = plan_from_json(raw)
+    assert plan.entry is None
+    assert plan.avg_entry == 65000.0
+    assert plan.dca == [DcaStep(100.0, 20.0)]  # нулевая цена — «нет значения»
+    assert plan.notes == ["Совет"]
+
+
+@pytest.mark.parametrize("raw", [
+    None, "", "not json", "[1, 2]",
+    '{"entry": true}',
+    '{"entry": "abc"}',
+    '{"take_profits": 5}',
+    '{"bias": "HOLD"}',
+    '{"analysis": 1}',
+    '{"dca": [1]}',
+    '{"entry": NaN}',
+    '{"symbol": 1}',
+])
+def test_plan_from_json_rejects_malformed(raw):
+    assert plan_from_json(raw) is None
@@ -0,0 +1,75 @@
+"""Общий генератор нагрузки для tools/*: N запросов с ограничением параллельности и темпа."""
+import asyncio
+import time
+from collections import Counter
+from typing import Awaitable, Callable, List, Tuple
+
+import aiohttp
+
+# make_request(session, i) → (HTTP-статус, тело ответа); исключение считается ошибкой
+RequestFn = Callable[[aiohttp.ClientSession, int], Awaitable[Tuple[int, str]]]
+
+
+class LoadResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.elapsed = 0.0
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        xs = sorted(self.latencies)
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+    def report(self, title: str) -> str:
+        total = len(self.latencies) + sum(self.errors.values())
+        rps = total / self.elapsed if self.elapsed else 0.0
+        lines = [
+            f"{title}: {total} запросов за {self.elapsed:.2f} с → {rps:.1f} req/s",
+            "  латентность: p50={:.1f}мс p95={:.1f}мс p99={:.1f}мс max={:.1f}мс".format(
+                self.percentile(0.50) * 1000, self.percentile(0.95) * 1000,
+                self.percentile(0.99) * 1000, (max(self.latencies) if self.latencies else 0.0) * 1000,
+            ),
+        ]
+        if self.statuses:
+            lines.append("  статусы: " + ", ".join(f"{k}×{v}" for k, v in sorted(self.statuses.items())))
+        if self.errors:
+            lines.append("  ошибки: " + ", ".join(f"{k}×{v}" for k, v in self.errors.most_common()))
+        return "\n".join(lines)
+
+
+async def run_load(make_request: RequestFn, total: int, concurrency: int, rate: float = 0.0,
+                   timeout: float = 30.0) -> LoadResult:
+    """
+    Отправляет total запросов, не более concurrency одновременно.
+    rate > 0 — равномерный темп (запросов в секунду), иначе — как можно быстрее.
+    """
+    result = LoadResult()
+    sem = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def one(i: int) -> None:
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    status, _ = await make_request(session, i)
+                except Exception as e:
+                    result.errors[type(e).__name__] += 1
+                    return
+                result.latencies.append(time.perf_counter() - t0)
+                result.statuses[status] += 1
+
+        start = time.perf_counter()
+        tasks = []
+        for i in range(total):
+            if rate > 0:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(i)))
+        await asyncio.gather(*tasks)
+        result.elapsed = time.perf_counter() - start
+    return result
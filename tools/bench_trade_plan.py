@@ -0,0 +1,143 @@
+"""
+Бенчмарк разбора торгового плана: extract_trade_plan (trade_plan.py) против прежнего разбора
+из handle_photo (шесть re.search + bias) и текстового фолбэка handle_strategy_photo (finditer
+по DCA + re.search по Entry/TP1..Цель3).
+
+Корпус — tests/data/trade_plan_answers.json; можно добавить свои ответы модели (JSON-список
+строк или объектов с "text"/"flow", либо JSONL) аргументом --extra.
+
+Запуск:
+  python tools/bench_trade_plan.py
+  python tools/bench_trade_plan.py --number 20000 --extra answers.jsonl
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from trade_plan import extract_trade_plan  # noqa: E402
+
+CORPUS_PATH = os.path.join(ROOT, "tests", "data", "trade_plan_answers.json")
+
+
+# ---------- прежний разбор (скопирован из handle_photo / handle_strategy_photo как был) ----------
+def legacy_smc(analysis: str):
+    def parse_price(raw_text):
+        if not raw_text:
+            return None
+        try:
+            cleaned = (
+                raw_text.replace(" ", "")
+                        .replace("\u00A0", "")
+                        .replace(",", "")
+                        .replace("$", "")
+                        .replace("—", "-")
+            )
+            return float(cleaned)
+        except Exception:
+            return None
+
+    entry_match = re.search(r'(Entry|Вход)[:\s]*\$?\s*([\d\s,.]+)', analysis, flags=re.IGNORECASE) \
+        or re.search(r'🎯[:\s]*\$?\s*([\d\s,.]+)', analysis)
+    stop_match = re.search(r'(StopLoss|Стоп)[:\s]*\$?\s*([\d\s,.]+)', analysis, flags=re.IGNORECASE) \
+        or re.search(r'🚨[:\s]*\$?\s*([\d\s,.]+)', analysis)
+    tp_match = re.search(r'(TakeProfit|Тейк)[:\s]*\$?\s*([\d\s,.]+)', analysis, flags=re.IGNORECASE) \
+        or re.search(r'💰[:\s]*\$?\s*([\d\s,.]+)', analysis)
+    bias_match = re.search(r'\b(BUY|SELL|ПОКУПКА|ПРОДАЖА)\b', analysis, flags=re.IGNORECASE)
+
+    entry = parse_price(entry_match.group(2) if entry_match and entry_match.lastindex == 2 else (entry_match.group(1) if entry_match else None))
+    stop = parse_price(stop_match.group(2) if stop_match and stop_match.lastindex == 2 else (stop_match.group(1) if stop_match else None))
+    tp = parse_price(tp_match.group(2) if tp_match and tp_match.lastindex == 2 else (tp_match.group(1) if tp_match else None))
+    return entry, stop, tp, (bias_match.group(1).upper() if bias_match else None)
+
+
+def legacy_strategy(txt: str):
+    def _sfloat(x):
+        try:
+            if x is None:
+                return None
+            return float(str(x).replace(" ", "").replace(",", "."))
+        except Exception:
+            return None
+
+    dca = []
+    for m in re.finditer(r'(?:Купить|Buy)\s*([0-9]+(?:\.[0-9]+)?)\s*%\D+\$?\s*([0-9]+(?:\.[0-9]+)?)', txt, re.I):
+        alloc = _sfloat(m.group(1)); price = _sfloat(m.group(2))
+        if price is not None and alloc is not None:
+            dca.append({"price": price, "alloc_pct": alloc})
+    for m in re.finditer(r'price\s*[:=]\s*\$?\s*([0-9]+(?:\.[0-9]+)?)\D+alloc(?:_pct)?\s*[:=]\s*([0-9]+(?:\.[0-9]+)?)\s*%', txt, re.I):
+        price = _sfloat(m.group(1)); alloc = _sfloat(m.group(2))
+        if price is not None and alloc is not None:
+            dca.append({"price": price, "alloc_pct": alloc})
+    entry = None
+    m = re.search(r'(?:Entry|Вход)\s*[:=]\s*\$?\s*([0-9]+(?:\.[0-9]+)?)', txt, re.I)
+    if m: entry = _sfloat(m.group(1))
+    tps = []
+    for label in ("TP1", "TP2", "TP3", "Цель1", "Цель2", "Цель3"):
+        m = re.search(rf'(?:{label})\s*[:=]\s*\$?\s*([0-9]+(?:\.[0-9]+)?)', txt, re.I)
+        if m:
+            v = _sfloat(m.group(1))
+            if v is not None:
+                tps.append(v)
+    return entry, tps, dca
+
+
+LEGACY = {"smc": legacy_smc, "strategy": legacy_strategy}
+
+
+# ---------- корпус ----------
+def load_cases(extra: str | None) -> list:
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        cases = [{"flow": c["flow"], "text": c["text"]} for c in json.load(f)]
+    if extra:
+        with open(extra, encoding="utf-8") as f:
+            raw = f.read().strip()
+        try:
+            items = json.loads(raw)
+        except ValueError:
+            items = [json.loads(line) for line in raw.splitlines() if line.strip()]
+        for item in items if isinstance(items, list) else [items]:
+            if isinstance(item, str):
+                cases.append({"flow": "smc", "text": item})
+            elif isinstance(item, dict) and isinstance(item.get("text"), str):
+                cases.append({"flow": item.get("flow", "smc"), "text": item["text"]})
+    return cases
+
+
+def bench(fn, texts: list, number: int) -> float:
+    """Лучшее из 5 повторов, мкс на один ответ."""
+    def run():
+        for t in texts:
+            fn(t)
+    best = min(timeit.repeat(run, number=number, repeat=5))
+    return best / number / len(texts) * 1e6
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="extract_trade_plan против прежнего разбора")
+    ap.add_argument("--number", type=int, default=5000, help="проходов по корпусу в одном повторе")
+    ap.add_argument("--extra", help="доп. ответы модели: JSON-список или JSONL")
+    args = ap.parse_args()
+
+    cases = load_cases(args.extra)
+    print(f"Корпус: {len(cases)} ответов, {args.number} проходов × 5 повторов (лучший)")
+    for flow, legacy in LEGACY.items():
+        texts = [c["text"] for c in cases if c["flow"] == flow]
+        if not texts:
+            continue
+        t_old = bench(legacy, texts, args.number)
+        t_new = bench(extract_trade_plan, texts, args.number)
+        avg_len = sum(map(len, texts)) / len(texts)
+        print(
+            f"  {flow:<8} {len(texts):>3} отв. (~{avg_len:.0f} симв.): "
+            f"прежний {t_old:7.2f} мкс, extract_trade_plan {t_new:7.2f} мкс → ×{t_old / t_new:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
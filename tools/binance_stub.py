@@ -0,0 +1,108 @@
+"""
+Локальная заглушка Binance REST для PriceService (bot.py).
+
+Отдаёт /api/v3/ticker/price в формате Binance:
+  ?symbol=BTCUSDT          → {"symbol": "BTCUSDT", "price": "65000.00000000"}
+  ?symbols=["BTCUSDT",...] → [{...}, ...]
+  без параметров           → все известные символы
+Неизвестный символ → 400 {"code": -1121, "msg": "Invalid symbol."} (как у Binance,
+в том числе для всего пакета — сервис тогда добирает символы по одному).
+
+Запуск:
+  python tools/binance_stub.py --port 8081 --latency-ms 20
+  BINANCE_API_URL=http://127.0.0.1:8081 python bot.py
+
+/stats заглушки — сколько запросов пришло (проверка склейки и кэша в PriceService).
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+DEFAULT_PRICES = {
+    "BTCUSDT": 65000.0,
+    "ETHUSDT": 3100.0,
+    "SOLUSDT": 150.0,
+    "BNBUSDT": 580.0,
+    "XRPUSDT": 0.5,
+    "TONUSDT": 6.5,
+    "ETHBTC": 0.0477,
+}
+
+INVALID_SYMBOL = {"code": -1121, "msg": "Invalid symbol."}
+
+
+def _row(symbol: str, price: float) -> dict:
+    return {"symbol": symbol, "price": f"{price:.8f}"}
+
+
+def build_app(prices: dict, latency_ms: float = 0.0, jitter: float = 0.0) -> web.Application:
+    stats = {"requests": 0, "single": 0, "batch": 0, "all": 0, "invalid": 0}
+
+    def _tick(symbol: str) -> float:
+        base = prices[symbol]
+        return base * (1 + random.uniform(-jitter, jitter)) if jitter else base
+
+    async def ticker_price(request: web.Request) -> web.Response:
+        stats["requests"] += 1
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+
+        symbol = request.query.get("symbol")
+        raw_symbols = request.query.get("symbols")
+        if symbol is not None:
+            stats["single"] += 1
+            if symbol not in prices:
+                stats["invalid"] += 1
+                return web.json_response(INVALID_SYMBOL, status=400)
+            return web.json_response(_row(symbol, _tick(symbol)))
+
+        if raw_symbols is not None:
+            stats["batch"] += 1
+            try:
+                symbols = json.loads(raw_symbols)
+            except ValueError:
+                symbols = None
+            if not isinstance(symbols, list) or not symbols:
+                return web.json_response({"code": -1100, "msg": "Illegal characters found in parameter 'symbols'."},
+                                         status=400)
+            if any(s not in prices for s in symbols):
+                stats["invalid"] += 1
+                return web.json_response(INVALID_SYMBOL, status=400)
+            return web.json_response([_row(s, _tick(s)) for s in symbols])
+
+        stats["all"] += 1
+        return web.json_response([_row(s, _tick(s)) for s in prices])
+
+    async def stub_stats(_request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_get("/api/v3/ticker/price", ticker_price)
+    app.router.add_get("/stats", stub_stats)
+    return app
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Заглушка Binance /api/v3/ticker/price")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="искусственная задержка ответа")
+    ap.add_argument("--jitter", type=float, default=0.0, help="разброс цены, доля (0.001 = ±0.1%%)")
+    ap.add_argument("--price", action="append", default=[], metavar="SYMBOL=PRICE",
+                    help="добавить/переопределить цену, можно несколько раз")
+    args = ap.parse_args()
+
+    prices = dict(DEFAULT_PRICES)
+    for item in args.price:
+        sym, _, val = item.partition("=")
+        prices[sym.strip().upper()] = float(val)
+
+    web.run_app(build_app(prices, args.latency_ms, args.jitter), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Локальная заглушка OpenAI Chat Completions для OpenAIScheduler / openai_chat (bot.py).
+
+POST /v1/chat/completions в формате OpenAI:
+  • обычный ответ — chat.completion с заголовками x-ratelimit-{limit,remaining,reset}-{requests,tokens};
+  • stream=true — SSE из chat.completion.chunk (по слову, --chunk-ms между кусками) и [DONE];
+  • response_format=json_schema — в content отдаётся --json-reply (по умолчанию пустой план).
+--rate-limit доля запросов получает 429 rate_limit_exceeded с Retry-After / retry-after-ms,
+как у OpenAI (проверка бэкоффа и AIMD в AdaptiveRateLimiter).
+
+Запуск:
+  python tools/fake_openai.py --port 8083 --latency-ms 800 --rate-limit 0.1
+  OPENAI_BASE_URL=http://127.0.0.1:8083/v1 OPENAI_API_KEY=test OPENAI_MAX_CONCURRENCY=4 python bot.py
+
+/stats заглушки — сколько запросов пришло, сколько 429 и пик одновременных запросов
+(не должен превышать OPENAI_MAX_CONCURRENCY бота).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+DEFAULT_REPLY = "Это ответ тестовой заглушки OpenAI: уровни не даются, просто текст для проверки потока."
+DEFAULT_JSON_REPLY = json.dumps({
+    "symbol": None, "bias": None, "entry": None, "stop": None, "take_profits": [], "analysis": DEFAULT_REPLY,
+}, ensure_ascii=False)
+
+RATE_LIMITED = {
+    "error": {
+        "message": "Rate limit reached for requests (fake_openai).",
+        "type": "requests",
+        "param": None,
+        "code": "rate_limit_exceeded",
+    }
+}
+
+
+def _limit_headers(limits: dict, used: dict) -> dict:
+    return {
+        "x-ratelimit-limit-requests": str(limits["requests"]),
+        "x-ratelimit-remaining-requests": str(max(0, limits["requests"] - used["requests"])),
+        "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-limit-tokens": str(limits["tokens"]),
+        "x-ratelimit-remaining-tokens": str(max(0, limits["tokens"] - used["tokens"])),
+        "x-ratelimit-reset-tokens": "6s",
+    }
+
+
+def _completion(model: str, content: str, prompt_tokens: int) -> dict:
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        "id": f"chatcmpl-fake{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content, "refusal": None},
+            "logprobs": None,
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def _chunk(cid: str, model: str, delta: dict, finish: str | None = None) -> bytes:
+    body = {
+        "id": cid,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish}],
+    }
+    return b"data: " + json.dumps(body, ensure_ascii=False).encode() + b"\n\n"
+
+
+def _prompt_tokens(messages) -> int:
+    total = 0
+    for m in messages or []:
+        content = m.get("content") if isinstance(m, dict) else None
+        if isinstance(content, str):
+            total += len(content) // 4
+        elif isinstance(content, list):
+            total += sum(len(p.get("text") or "") // 4 if p.get("type") == "text" else 1105 for p in content)
+    return total
+
+
+def build_app(reply: str = DEFAULT_REPLY, json_reply: str = DEFAULT_JSON_REPLY, latency_ms: float = 0.0,
+              chunk_ms: float = 0.0, rate_limit: float = 0.0, retry_after: float = 1.0,
+              rpm: int = 10000, tpm: int = 2000000) -> web.Application:
+    stats = {"requests": 0, "stream": 0, "rate_limited": 0, "active": 0, "peak_active": 0, "tokens": 0}
+    limits = {"requests": rpm, "tokens": tpm}
+    window = {"started": time.monotonic(), "requests": 0, "tokens": 0}
+
+    def _used() -> dict:
+        if time.monotonic() - window["started"] >= 60.0:
+            window.update(started=time.monotonic(), requests=0, tokens=0)
+        return window
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        stats["requests"] += 1
+        body = await request.json()
+        model = body.get("model") or "gpt-4o"
+        used = _used()
+
+        if rate_limit and random.random() < rate_limit:
+            stats["rate_limited"] += 1
+            headers = {"retry-after": f"{retry_after:g}", "retry-after-ms": str(int(retry_after * 1000))}
+            headers.update(_limit_headers(limits, {"requests": limits["requests"], "tokens": used["tokens"]}))
+            return web.json_response(RATE_LIMITED, status=429, headers=headers)
+
+        prompt_tokens = _prompt_tokens(body.get("messages"))
+        used["requests"] += 1
+        used["tokens"] += prompt_tokens + (body.get("max_tokens") or 0)
+        stats["tokens"] += prompt_tokens
+        rf = body.get("response_format") or {}
+        content = json_reply if rf.get("type") == "json_schema" else reply
+
+        stats["active"] += 1
+        stats["peak_active"] = max(stats["peak_active"], stats["active"])
+        try:
+            if latency_ms:
+                await asyncio.sleep(latency_ms / 1000)
+            headers = _limit_headers(limits, used)
+            if not body.get("stream"):
+                return web.json_response(_completion(model, content, prompt_tokens), headers=headers)
+
+            stats["stream"] += 1
+            resp = web.StreamResponse(headers={**headers, "Content-Type": "text/event-stream"})
+            await resp.prepare(request)
+            cid = f"chatcmpl-fake{random.getrandbits(32):08x}"
+            await resp.write(_chunk(cid, model, {"role": "assistant", "content": ""}))
+            for word in content.split(" "):
+                if chunk_ms:
+                    await asyncio.sleep(chunk_ms / 1000)
+                await resp.write(_chunk(cid, model, {"content": word + " "}))
+            await resp.write(_chunk(cid, model, {}, finish="stop"))
+            await resp.write(b"data: [DONE]\n\n")
+            await resp.write_eof()
+            return resp
+        finally:
+            stats["active"] -= 1
+
+    async def stub_stats(_request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)  # картинки приходят base64 в теле
+    app["stats"] = stats
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/stats", stub_stats)
+    return app
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Заглушка OpenAI /v1/chat/completions")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8083)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="задержка до первого байта ответа")
+    ap.add_argument("--chunk-ms", type=float, default=20.0, help="пауза между кусками стрима")
+    ap.add_argument("--rate-limit", type=float, default=0.0, help="доля запросов с ответом 429 (0..1)")
+    ap.add_argument("--retry-after", type=float, default=1.0, help="Retry-After в ответе 429, с")
+    ap.add_argument("--rpm", type=int, default=10000, help="x-ratelimit-limit-requests")
+    ap.add_argument("--tpm", type=int, default=2000000, help="x-ratelimit-limit-tokens")
+    ap.add_argument("--reply", default=DEFAULT_REPLY, help="текст ответа")
+    ap.add_argument("--json-reply", default=DEFAULT_JSON_REPLY, help="ответ на запросы с json_schema")
+    args = ap.parse_args()
+
+    web.run_app(
+        build_app(args.reply, args.json_reply, args.latency_ms, args.chunk_ms, args.rate_limit,
+                  args.retry_after, args.rpm, args.tpm),
+        host=args.host, port=args.port,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Нагрузочный тест IPN CryptoCloud: параллельные подписанные POST на /cryptocloud_webhook.
+
+Каждый запрос — оплаченный счёт с уникальным tx_id и подписью X-Signature-SHA256
+(HMAC-SHA256 тела на API_SECRET, как проверяет cryptocloud_webhook). Часть запросов можно
+сделать повторами уже отправленных tx_id (--duplicates) — проверка идемпотентности под нагрузкой.
+
+ВНИМАНИЕ: успешные IPN выдают доступ (EntitlementStore) и пишут в Google Sheets.
+Запускайте против тестового инстанса с отдельным DATA_DIR и тестовыми user_id.
+
+Пример:
+  API_SECRET=secret python tools/ipn_load_test.py --url http://127.0.0.1:5000 -n 2000 -c 50
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import time
+
+from _loadgen import run_load
+
+PLAN_AMOUNTS = {"monthly": "25", "lifetime": "199"}
+
+
+def sign(body: bytes, secret: str) -> str:
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def ipn_payload(user_id: int, plan: str, amount: str, tx_id: str, currency: str, network: str) -> dict:
+    return {
+        "status": "paid",
+        "order_id": f"user_{user_id}_loadtest_{plan}",
+        "tx_id": tx_id,
+        "amount": amount,
+        "currency": currency,
+        "network": network,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Нагрузочный тест /cryptocloud_webhook")
+    ap.add_argument("--url", default="http://127.0.0.1:5000", help="базовый адрес бота")
+    ap.add_argument("--secret", default=os.getenv("API_SECRET"), help="API_SECRET бота (по умолчанию из env)")
+    ap.add_argument("-n", "--requests", type=int, default=1000)
+    ap.add_argument("-c", "--concurrency", type=int, default=50)
+    ap.add_argument("--rate", type=float, default=0.0, help="запросов в секунду (0 — без ограничения)")
+    ap.add_argument("--plan", choices=sorted(PLAN_AMOUNTS), default="monthly")
+    ap.add_argument("--amount", help="сумма (по умолчанию — цена плана по умолчанию в боте)")
+    ap.add_argument("--currency", default="USDT")
+    ap.add_argument("--network", default="TRC20")
+    ap.add_argument("--users", type=int, default=100, help="сколько разных тестовых user_id")
+    ap.add_argument("--user-id-base", type=int, default=900_000_000)
+    ap.add_argument("--duplicates", type=float, default=0.0, help="доля повторных доставок (0..1)")
+    args = ap.parse_args()
+
+    if not args.secret:
+        sys.exit("Нужен --secret или переменная окружения API_SECRET")
+
+    url = args.url.rstrip("/") + "/cryptocloud_webhook"
+    amount = args.amount or PLAN_AMOUNTS[args.plan]
+    run_id = f"lt{int(time.time())}"
+    sent: list = []
+
+    async def make_request(session, i):
+        if sent and random.random() < args.duplicates:
+            tx_id = random.choice(sent)
+        else:
+            tx_id = f"{run_id}-{i}"
+            sent.append(tx_id)
+        user_id = args.user_id_base + i % args.users
+        body = json.dumps(
+            ipn_payload(user_id, args.plan, amount, tx_id, args.currency, args.network)
+        ).encode()
+        headers = {"Content-Type": "application/json", "X-Signature-SHA256": sign(body, args.secret)}
+        async with session.post(url, data=body, headers=headers) as resp:
+            return resp.status, await resp.text()
+
+    result = asyncio.run(run_load(make_request, args.requests, args.concurrency, args.rate))
+    print(result.report(f"IPN {url}"))
+    print(f"  уникальных tx_id: {len(sent)} (повторы отвечают 200 «duplicate ignored»)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Replay записанных апдейтов Telegram на /telegram_webhook (TELEGRAM_MODE=webhook).
+
+Апдейты берутся из файла: JSON-список, дамп getUpdates ({"ok": true, "result": [...]}) или
+JSONL (по апдейту на строку). Без файла — синтетические текстовые сообщения (--text).
+Каждой копии выдаётся новый update_id и текущая дата; --users раскладывает апдейты по
+N тестовым пользователям (параллельно между ними, по порядку внутри — как в проде).
+
+Меряется:
+  • приём — латентность POST до 200 (апдейт положен в очередь приложения);
+  • end-to-end (--fake-api) — от POST до первого вызова Bot API по этому чату/колбэку.
+    Скрипт поднимает заглушку Bot API, бот нужно запустить с
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:<порт>/bot и TELEGRAM_API_FILE_URL=http://127.0.0.1:<порт>/file/bot
+
+Перед отправкой скрипт ждёт health-check бота (GET /, до --wait секунд), так что его можно
+запустить первым, а бот — следом.
+
+Пример:
+  python tools/replay_updates.py --secret test -n 5000 -c 100 --rate 500 --fake-api 8082 &
+  TELEGRAM_MODE=webhook WEBHOOK_BASE_URL=http://127.0.0.1:5000 TELEGRAM_WEBHOOK_SECRET=test \\
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8082/bot python bot.py
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import sys
+import time
+from collections import defaultdict, deque
+from typing import Dict, List
+
+import aiohttp
+from aiohttp import web
+
+from _loadgen import LoadResult, run_load
+
+
+# ---------- апдейты ----------
+def load_updates(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        raw = f.read().strip()
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        data = [json.loads(line) for line in raw.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data.get("result", [data])
+    updates = [u for u in data if isinstance(u, dict) and "update_id" in u]
+    if not updates:
+        sys.exit(f"В {path} нет апдейтов")
+    return updates
+
+
+def synthetic_update(text: str) -> dict:
+    return {
+        "update_id": 0,
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Replay"},
+            "text": text,
+        },
+    }
+
+
+def prepare(template: dict, i: int, update_id: int, user_id: int | None) -> dict:
+    """Копия апдейта с новым update_id/датой и (опционально) другим пользователем."""
+    u = copy.deepcopy(template)
+    u["update_id"] = update_id
+    now = int(time.time())
+    for key in ("message", "edited_message"):
+        msg = u.get(key)
+        if isinstance(msg, dict):
+            msg["date"] = now
+            if user_id is not None:
+                msg.setdefault("from", {})["id"] = user_id
+                if msg.get("chat", {}).get("type", "private") == "private":
+                    msg.setdefault("chat", {"type": "private"})["id"] = user_id
+    cq = u.get("callback_query")
+    if isinstance(cq, dict):
+        cq["id"] = f"replay{i}"
+        if user_id is not None:
+            cq.setdefault("from", {})["id"] = user_id
+            m = cq.get("message")
+            if isinstance(m, dict) and m.get("chat", {}).get("type", "private") == "private":
+                m["chat"]["id"] = user_id
+    return u
+
+
+def reply_key(u: dict):
+    """По какому ключу ждать ответ бота: id колбэка или id чата."""
+    cq = u.get("callback_query")
+    if isinstance(cq, dict):
+        return str(cq.get("id"))
+    for key in ("message", "edited_message"):
+        msg = u.get(key)
+        if isinstance(msg, dict) and "chat" in msg:
+            return str(msg["chat"].get("id"))
+    return None
+
+
+# ---------- заглушка Bot API ----------
+class FakeBotApi:
+    """Отвечает на вызовы Bot API правдоподобными объектами и отмечает время первого ответа."""
+
+    def __init__(self):
+        self.pending: Dict[str, deque] = defaultdict(deque)  # ключ → время отправки апдейтов
+        self.e2e = LoadResult()
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._message_id = 1000
+        self.last_reply = 0.0
+
+    def expect(self, key: str, sent_at: float) -> None:
+        self.pending[key].append(sent_at)
+
+    def _message(self, chat_id, text="") -> dict:
+        self._message_id += 1
+        return {"message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id or 0), "type": "private"}, "text": text or ""}
+
+    def _result(self, method: str, params: dict):
+        m = method.lower()
+        if m == "getme":
+            return {"id": 1, "is_bot": True, "first_name": "ReplayBot", "username": "replay_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if m == "getwebhookinfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if m == "getfile":
+            return {"file_id": params.get("file_id", ""), "file_unique_id": "replay", "file_path": "photos/replay.jpg"}
+        if m.startswith("send") or m.startswith("edit") or m == "copymessage":
+            if m.startswith("edit") and params.get("inline_message_id"):
+                return True
+            return self._message(params.get("chat_id"), params.get("text") or params.get("caption"))
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        key = params.get("callback_query_id") or params.get("chat_id")
+        if key is not None and self.pending.get(str(key)):
+            self.last_reply = time.perf_counter()
+            self.e2e.latencies.append(self.last_reply - self.pending[str(key)].popleft())
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def handle_file(self, _request: web.Request) -> web.Response:
+        return web.Response(body=b"", content_type="image/jpeg")
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+    def outstanding(self) -> int:
+        return sum(len(q) for q in self.pending.values())
+
+
+async def start_fake_api(api: FakeBotApi, port: int) -> web.AppRunner:
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+# ---------- main ----------
+async def wait_for_bot(base_url: str, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(base_url.rstrip("/") + "/") as resp:
+                    if resp.status == 200:
+                        return True
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(0.5)
+    return False
+
+
+async def replay(args) -> None:
+    templates = load_updates(args.file) if args.file else [synthetic_update(args.text)]
+    url = args.url.rstrip("/") + "/telegram_webhook"
+    headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": args.secret}
+    base_id = int(time.time()) * 1000
+
+    api = FakeBotApi() if args.fake_api else None
+    runner = await start_fake_api(api, args.fake_api) if api else None
+    try:
+        if api is not None:
+            print(f"Заглушка Bot API: TELEGRAM_API_BASE_URL=http://127.0.0.1:{args.fake_api}/bot")
+        if not await wait_for_bot(args.url, args.wait):
+            sys.exit(f"Бот не ответил на {args.url}/ за {args.wait:.0f} с")
+
+        async def make_request(session, i):
+            user_id = args.user_id_base + i % args.users if args.users else None
+            update = prepare(templates[i % len(templates)], i, base_id + i, user_id)
+            if api is not None:
+                key = reply_key(update)
+                if key is not None:
+                    api.expect(key, time.perf_counter())
+            async with session.post(url, data=json.dumps(update), headers=headers) as resp:
+                return resp.status, await resp.text()
+
+        started = time.perf_counter()
+        result = await run_load(make_request, args.requests, args.concurrency, args.rate)
+        print(result.report(f"Приём {url}"))
+
+        if api is not None:
+            deadline = time.monotonic() + args.drain
+            while api.outstanding() and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            api.e2e.elapsed = max(api.last_reply - started, 0.0)
+            print(api.e2e.report("End-to-end (апдейт → первый вызов Bot API)"))
+            if api.outstanding():
+                print(f"  без ответа за {args.drain:.0f} с: {api.outstanding()}")
+            print("  вызовы Bot API: " + ", ".join(f"{k}×{v}" for k, v in sorted(api.calls.items())))
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Replay апдейтов Telegram на /telegram_webhook")
+    ap.add_argument("file", nargs="?", help="JSON / JSONL с апдейтами (по умолчанию — синтетика)")
+    ap.add_argument("--url", default="http://127.0.0.1:5000", help="базовый адрес бота")
+    ap.add_argument("--secret", default=os.getenv("TELEGRAM_WEBHOOK_SECRET", ""),
+                    help="TELEGRAM_WEBHOOK_SECRET бота (по умолчанию из env)")
+    ap.add_argument("-n", "--requests", type=int, default=1000)
+    ap.add_argument("-c", "--concurrency", type=int, default=50)
+    ap.add_argument("--rate", type=float, default=0.0, help="апдейтов в секунду (0 — без ограничения)")
+    ap.add_argument("--users", type=int, default=100, help="разложить по N тестовым user_id (0 — как в файле)")
+    ap.add_argument("--user-id-base", type=int, default=900_000_000)
+    ap.add_argument("--text", default="Привет", help="текст синтетических сообщений")
+    ap.add_argument("--fake-api", type=int, metavar="PORT", help="поднять заглушку Bot API и мерить end-to-end")
+    ap.add_argument("--wait", type=float, default=120.0, help="сколько ждать health-check бота перед стартом, с")
+    ap.add_argument("--drain", type=float, default=30.0, help="сколько ждать ответов бота после отправки, с")
+    args = ap.parse_args()
+
+    if not args.secret:
+        sys.exit("Нужен --secret или переменная окружения TELEGRAM_WEBHOOK_SECRET")
+    try:
+        asyncio.run(replay(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
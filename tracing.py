@@ -0,0 +1,362 @@
+"""
+Трассировка апдейтов: дерево спанов на contextvars, без внешних зависимостей.
+
+Корневой спан открывается на апдейт (Tracer.root), дочерние (Tracer.span) цепляются к текущему
+через ContextVar — он наследуется в await-цепочке и в задачах, созданных из хендлера. Вне трейса
+span() возвращает NOOP_SPAN: в фоновых задачах и при выключенной трассировке стоимость — один
+ContextVar.get().
+
+Решение о выгрузке принимается в конце трейса (tail sampling): записываются все трейсы,
+экспортируются выборка sample_rate и все медленные; медленный трейс дополнительно пишется
+в лог деревом. Экспорт — в отдельном потоке через ограниченную очередь: при переполнении
+трейс теряется, хендлер не ждёт.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+_CURRENT: ContextVar[Optional["Span"]] = ContextVar("trace_span", default=None)
+
+
+class _Trace:
+    __slots__ = ("trace_id", "epoch_offset_ns", "spans", "dropped", "finished")
+
+    def __init__(self):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        # perf_counter_ns → unix ns (для OTLP); длительности считаем по монотонным часам
+        self.epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+        self.spans = 0
+        self.dropped = 0
+        self.finished = False
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent", "trace", "attrs", "children", "start_ns", "end_ns",
+                 "error", "_tracer", "_token")
+
+    def __init__(self, tracer: "Tracer", name: str, trace: _Trace, parent: Optional["Span"],
+                 attrs: Dict[str, Any]):
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent = parent
+        self.trace = trace
+        self.attrs = {k: v for k, v in attrs.items() if v is not None}
+        self.children: List["Span"] = []
+        self.start_ns = 0
+        self.end_ns = 0
+        self.error: Optional[str] = None
+        self._tracer = tracer
+        self._token = None
+        trace.spans += 1
+        if parent is not None:
+            parent.children.append(self)
+
+    def set(self, key: str, value: Any) -> None:
+        if value is not None:
+            self.attrs[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns or time.perf_counter_ns()
+        return (end - self.start_ns) / 1e6
+
+    def __enter__(self) -> "Span":
+        self._token = _CURRENT.set(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.end_ns = time.perf_counter_ns()
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        _CURRENT.reset(self._token)
+        if self.parent is None:
+            self.trace.finished = True
+            self._tracer._finish(self)
+
+    # ---- выгрузка ----
+    def to_dict(self) -> dict:
+        """Вложенное дерево для JSONL-файла: смещения и длительности в мс от начала корня."""
+        def walk(span: "Span", base: int) -> dict:
+            node = {
+                "name": span.name,
+                "offset_ms": round((span.start_ns - base) / 1e6, 3),
+                "duration_ms": round(span.duration_ms, 3),
+            }
+            if span.attrs:
+                node["attrs"] = span.attrs
+            if span.error:
+                node["error"] = span.error
+            if span.children:
+                node["children"] = [walk(c, base) for c in span.children]
+            return node
+
+        out = walk(self, self.start_ns)
+        out["trace_id"] = self.trace.trace_id
+        out["ts"] = (self.start_ns + self.trace.epoch_offset_ns) / 1e9
+        if self.trace.dropped:
+            out["dropped_spans"] = self.trace.dropped
+        return out
+
+    def iter_spans(self):
+        yield self
+        for child in self.children:
+            yield from child.iter_spans()
+
+    def render(self) -> str:
+        """Дерево для лога медленных апдейтов: «имя  длительность  @смещение  атрибуты»."""
+        lines = []
+
+        def walk(span: "Span", depth: int) -> None:
+            attrs = " ".join(f"{k}={v}" for k, v in span.attrs.items())
+            line = (f"{'  ' * depth}{span.name} {span.duration_ms:.1f}ms"
+                    f" @+{(span.start_ns - self.start_ns) / 1e6:.0f}ms")
+            if attrs:
+                line += f" {attrs}"
+            if span.error:
+                line += f" !{span.error}"
+            lines.append(line)
+            for child in span.children:
+                walk(child, depth + 1)
+
+        walk(self, 0)
+        if self.trace.dropped:
+            lines.append(f"(+{self.trace.dropped} спанов сверх лимита)")
+        return "\n".join(lines)
+
+
+class _NoopSpan:
+    """Заглушка вне трейса: тот же интерфейс, ничего не пишет."""
+    __slots__ = ()
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+# =====================[ EXPORTERS ]=====================
+class TraceExporter:
+    """Базовый экспортёр: очередь + поток-писатель, пишет пачками до batch_size трейсов."""
+
+    def __init__(self, max_queue: int = 1000, batch_size: int = 50):
+        self.batch_size = max(1, batch_size)
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=max(1, max_queue))
+        self._thread: Optional[threading.Thread] = None
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def export(self, root: Span) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"trace-{type(self).__name__}", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(root)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Дописать очередь и остановить поток (вызывается на shutdown)."""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            batch = [] if item is None else [item]
+            while item is not None and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    batch.append(item)
+            if batch:
+                try:
+                    self._write(batch)
+                    self.exported += len(batch)
+                except Exception:
+                    self.errors += 1
+                    logging.warning(f"[trace] {type(self).__name__} export failed", exc_info=True)
+            if item is None:
+                return
+
+    def _write(self, batch: List[Span]) -> None:
+        raise NotImplementedError
+
+
+class JsonlExporter(TraceExporter):
+    """Один трейс — одна строка JSON (вложенное дерево) в локальном файле."""
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+
+    def _write(self, batch: List[Span]) -> None:
+        data = "".join(json.dumps(root.to_dict(), ensure_ascii=False, default=str) + "\n" for root in batch)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpHttpExporter(TraceExporter):
+    """OTLP/HTTP в JSON-кодировке (POST {endpoint}/v1/traces) — Jaeger, Tempo, otel-collector."""
+
+    def __init__(self, endpoint: str, service_name: str, headers: Optional[Dict[str, str]] = None,
+                 timeout: float = 5.0, **kwargs):
+        super().__init__(**kwargs)
+        endpoint = endpoint.rstrip("/")
+        self.url = endpoint if endpoint.endswith("/v1/traces") else endpoint + "/v1/traces"
+        self.service_name = service_name
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+        self.timeout = timeout
+
+    def _span_json(self, span: Span) -> dict:
+        offset = span.trace.epoch_offset_ns
+        out = {
+            "traceId": span.trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 2 if span.parent is None else 1,  # SERVER для корня, INTERNAL для остальных
+            "startTimeUnixNano": str(span.start_ns + offset),
+            "endTimeUnixNano": str((span.end_ns or span.start_ns) + offset),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attrs.items()],
+        }
+        if span.parent is not None:
+            out["parentSpanId"] = span.parent.span_id
+        if span.error:
+            out["status"] = {"code": 2, "message": span.error}
+        return out
+
+    def payload(self, batch: List[Span]) -> dict:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{
+                    "scope": {"name": "bot.tracing"},
+                    "spans": [self._span_json(s) for root in batch for s in root.iter_spans()],
+                }],
+            }]
+        }
+
+    def _write(self, batch: List[Span]) -> None:
+        body = json.dumps(self.payload(batch), default=str).encode("utf-8")
+        req = urllib.request.Request(self.url, data=body, headers=self.headers, method="POST")
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            resp.read()
+
+
+# =====================[ TRACER ]=====================
+class Tracer:
+    """
+    sample_rate — доля трейсов на экспорт (0..1); slow_ms — порог медленного апдейта
+    (экспорт + дерево в лог; 0 — выкл). Оба нуля и нет экспортёра — root() ничего не записывает.
+    max_spans — предел спанов в трейсе (стриминг правит сообщение десятки раз).
+    """
+
+    def __init__(self, sample_rate: float = 0.0, slow_ms: float = 0.0,
+                 exporters: Optional[List[TraceExporter]] = None, max_spans: int = 256):
+        self.sample_rate = min(1.0, max(0.0, sample_rate))
+        self.slow_ms = max(0.0, slow_ms)
+        self.exporters = list(exporters or [])
+        self.max_spans = max(1, max_spans)
+        self.enabled = bool(self.slow_ms or (self.sample_rate and self.exporters))
+        self.traces = 0
+        self.sampled = 0
+        self.slow = 0
+        self.max_ms = 0.0
+
+    def root(self, name: str, **attrs):
+        """Корневой спан апдейта. Внутри уже открытого трейса — обычный дочерний спан."""
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _CURRENT.get()
+        if parent is not None:
+            return self.span(name, **attrs)
+        return Span(self, name, _Trace(), None, attrs)
+
+    def span(self, name: str, **attrs):
+        parent = _CURRENT.get()
+        if parent is None:
+            return NOOP_SPAN
+        trace = parent.trace
+        if trace.finished:  # задача, пережившая хендлер
+            return NOOP_SPAN
+        if trace.spans >= self.max_spans:
+            trace.dropped += 1
+            return NOOP_SPAN
+        return Span(self, name, trace, parent, attrs)
+
+    def annotate(self, **attrs) -> None:
+        """Атрибуты на корневой спан текущего трейса (маршрут, тип апдейта ...)."""
+        span = _CURRENT.get()
+        if span is None:
+            return
+        while span.parent is not None:
+            span = span.parent
+        for key, value in attrs.items():
+            span.set(key, value)
+
+    def current(self):
+        return _CURRENT.get() or NOOP_SPAN
+
+    def _finish(self, root: Span) -> None:
+        duration = root.duration_ms
+        self.traces += 1
+        self.max_ms = max(self.max_ms, duration)
+        slow = bool(self.slow_ms) and duration >= self.slow_ms
+        if slow:
+            self.slow += 1
+            logging.warning(f"[trace] медленный апдейт {duration / 1000:.1f}s trace={root.trace.trace_id}\n"
+                            f"{root.render()}")
+        if slow or (self.sample_rate and random.random() < self.sample_rate):
+            self.sampled += 1
+            for exporter in self.exporters:
+                exporter.export(root)
+
+    def close(self) -> None:
+        for exporter in self.exporters:
+            exporter.close()
+
+    def stats_lines(self) -> List[str]:
+        if not self.enabled:
+            return ["• Трейсинг: выключен"]
+        line = (f"• Трейсинг: трейсов {self.traces}, выгружено {self.sampled} "
+                f"(выборка {self.sample_rate:.0%}), медленных {self.slow}, max {self.max_ms / 1000:.1f}s")
+        lost = sum(e.dropped for e in self.exporters)
+        errors = sum(e.errors for e in self.exporters)
+        if lost or errors:
+            line += f", потеряно {lost}, ошибок экспорта {errors}"
+        return [line]
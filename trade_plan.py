@@ -0,0 +1,276 @@
+"""
+Разбор торгового плана из ответа модели.
+
+Основной путь — structured output: модель отвечает JSON по схеме (SMC_RESPONSE_FORMAT /
+STRATEGY_RESPONSE_FORMAT), plan_from_json проверяет типы и собирает TradePlan.
+Запасной путь — extract_trade_plan по свободному тексту: все шаблоны компилируются один раз
+при импорте, текст проходится одним finditer по общему шаблону-токенизатору.
+"""
+import json
+import math
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+# Число в ответе модели: "65,000", "65 000.5", "1.0850", "0,5". Список "100, 200" — два числа.
+_NUM = r"\d{1,3}(?:[,\u00a0\u202f ]\d{3})+(?:\.\d+)?(?!\d)|\d+(?:[.,]\d+)?"
+
+# Номер тейка в метке (TP1 / Цель 2): одна цифра, за которой не идёт цифра или дробная часть.
+# Либо номер съедается меткой, либо его нет — иначе «TP 120» читалось бы как TP1 + 20,
+# а «после TP1.» — как тейк 1.0.
+_IDX = r"\s*\d(?!\d|[.,]\d)"
+_INDEXED = r"(?:" + _IDX + r"|(?!" + _IDX + r"))"
+
+# Первые буквы всех токенов. Ведущий lookahead по классу символов (и начало слова) отсекает
+# большинство позиций до перебора альтернатив — без него общий шаблон медленнее шести re.search.
+_TOKEN_HEADS = "BbКкPpEeВвSsСсTtТтЦцПп🎯🚨💰"
+
+_TOKEN_RE = re.compile(
+    r"(?=[" + _TOKEN_HEADS + r"])(?<!\w)(?:"
+    # DCA: «Купить 20% по $100» / «Buy 20% at 100»
+    r"(?P<buy>(?:Купить|Buy)\s*(?P<buy_pct>\d+(?:\.\d+)?)\s*%\D+?\$?\s*(?P<buy_px>\d+(?:\.\d+)?))"
+    # DCA: «price: 100, alloc_pct: 20%»
+    r"|(?P<kv>price\s*[:=]\s*\$?\s*(?P<kv_px>\d+(?:\.\d+)?)\D+?alloc(?:_pct)?\s*[:=]\s*(?P<kv_pct>\d+(?:\.\d+)?)\s*%)"
+    # Подписанные уровни: Entry / Вход / StopLoss / Стоп(-лосс) / TakeProfit / Тейк(-профит) / TP1 / Цель 2
+    r"|\b(?P<label>entry|вход|stop[\s-]*loss|стоп(?:[\s-]*лосс)?|take[\s-]*profit|тейк(?:[\s-]*профит)?"
+    r"|tp" + _INDEXED + r"|цель" + _INDEXED + r")\s*[:=\-–—]?\s*\$?\s*(?P<num>" + _NUM + r")"
+    # Уровни по эмодзи из формата ответа: 🎯 вход, 🚨 стоп, 💰 тейк
+    r"|(?P<emoji>[🎯🚨💰])[:\s]*\$?\s*(?P<enum>" + _NUM + r")"
+    # Направление сделки
+    r"|\b(?P<bias>BUY|SELL|ПОКУПКА|ПРОДАЖА)\b"
+    r")",
+    re.IGNORECASE,
+)
+
+# Вид подписанного уровня по первым двум буквам метки (Entry / StopLoss / TakeProfit / TP1 / Цель 2 ...)
+_LABEL_KIND = {"en": "entry", "вх": "entry", "st": "stop", "ст": "stop",
+               "ta": "tp", "те": "tp", "tp": "tp", "це": "tp"}
+_EMOJI_KIND = {"🎯": "entry", "🚨": "stop", "💰": "tp"}
+_BIAS_SIDE = {"BUY": "BUY", "ПОКУПКА": "BUY", "SELL": "SELL", "ПРОДАЖА": "SELL"}
+
+
+@dataclass
+class DcaStep:
+    price: float
+    alloc_pct: float
+
+
+@dataclass
+class TradePlan:
+    entry: Optional[float] = None
+    stop: Optional[float] = None
+    take_profits: List[float] = field(default_factory=list)
+    bias: Optional[str] = None  # как в тексте, в верхнем регистре (BUY / ПРОДАЖА / ...)
+    dca: List[DcaStep] = field(default_factory=list)
+    avg_entry: Optional[float] = None
+    notes: List[str] = field(default_factory=list)
+    analysis: str = ""  # текст для пользователя (RU); при разборе свободного текста — пусто
+    symbol: Optional[str] = None  # пара с графика, как её прочла модель ('BTCUSDT', 'ETH/USDT'); из текста не угадывается
+
+    @property
+    def tp(self) -> Optional[float]:
+        return self.take_profits[0] if self.take_profits else None
+
+    @property
+    def side(self) -> Optional[str]:
+        """Нормализованное направление: BUY / SELL."""
+        return _BIAS_SIDE.get(self.bias) if self.bias else None
+
+
+def parse_price(raw: Optional[str]) -> Optional[float]:
+    """
+    "$65,000" → 65000.0; "67 000" → 67000.0; "1,0850" → 1.085; "0,500" → 0.5.
+    Запятая — разделитель тысяч, если за ней ровно три цифры (и точки нет, и целая часть не 0),
+    иначе — десятичная.
+    """
+    if not raw:
+        return None
+    s = raw.strip().replace(" ", "").replace("\u00a0", "").replace("\u202f", "").replace("$", "").rstrip(".,")
+    if not s:
+        return None
+    if "," in s:
+        parts = s.split(",")
+        if "." in s or (parts[0] != "0" and all(len(part) == 3 for part in parts[1:])):
+            s = s.replace(",", "")
+        else:
+            s = s.replace(",", ".")
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+def extract_trade_plan(text: str) -> TradePlan:
+    """
+    Один проход по тексту. Подписанный уровень (Entry/Стоп/...) важнее эмодзи-маркера;
+    из нескольких подписанных берётся первый, тейки собираются все по порядку.
+    """
+    plan = TradePlan()
+    by_emoji = {}
+    emoji_tps: List[float] = []
+
+    # lastgroup — последняя закрытая именованная группа, по ней однозначно определяется ветка шаблона
+    for m in _TOKEN_RE.finditer(text or ""):
+        kind = m.lastgroup
+        if kind == "num":
+            value = parse_price(m.group("num"))
+            if value is None:
+                continue
+            kind = _LABEL_KIND[m.group("label")[:2].lower()]
+            if kind == "tp":
+                plan.take_profits.append(value)
+            elif getattr(plan, kind) is None:
+                setattr(plan, kind, value)
+        elif kind == "enum":
+            value = parse_price(m.group("enum"))
+            if value is None:
+                continue
+            kind = _EMOJI_KIND[m.group("emoji")]
+            if kind == "tp":
+                emoji_tps.append(value)
+            else:
+                by_emoji.setdefault(kind, value)
+        elif kind == "bias":
+            if plan.bias is None:
+                plan.bias = m.group("bias").upper()
+        elif kind == "buy":
+            plan.dca.append(DcaStep(price=float(m.group("buy_px")), alloc_pct=float(m.group("buy_pct"))))
+        else:
+            plan.dca.append(DcaStep(price=float(m.group("kv_px")), alloc_pct=float(m.group("kv_pct"))))
+
+    if plan.entry is None:
+        plan.entry = by_emoji.get("entry")
+    if plan.stop is None:
+        plan.stop = by_emoji.get("stop")
+    if not plan.take_profits:
+        plan.take_profits = emoji_tps
+    return plan
+
+
+# =====================[ STRUCTURED OUTPUT ]=====================
+_NULLABLE_NUMBER = {"type": ["number", "null"]}
+_NUMBERS = {"type": "array", "items": {"type": "number"}}
+
+
+def _json_schema(name: str, properties: dict) -> dict:
+    """response_format для chat.completions: strict-схема, все поля обязательны (null — «нет значения»)."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+SMC_RESPONSE_FORMAT = _json_schema("smc_trade_plan", {
+    "analysis": {
+        "type": "string",
+        "description": "Full answer for the user in Russian (Cyrillic), plain text, no markdown.",
+    },
+    "entry": _NULLABLE_NUMBER,
+    "stop": _NULLABLE_NUMBER,
+    "take_profits": _NUMBERS,
+    "bias": {"type": ["string", "null"], "enum": ["BUY", "SELL", None]},
+    "symbol": {
+        "type": ["string", "null"],
+        "description": "Trading pair exactly as shown on the chart (e.g. BTCUSDT, ETH/USDT); null if not visible.",
+    },
+})
+
+STRATEGY_RESPONSE_FORMAT = _json_schema("spot_dca_plan", {
+    "entry": _NULLABLE_NUMBER,
+    "avg_entry": _NULLABLE_NUMBER,
+    "take_profits": _NUMBERS,
+    "dca": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {"price": {"type": "number"}, "alloc_pct": {"type": "number"}},
+            "required": ["price", "alloc_pct"],
+            "additionalProperties": False,
+        },
+    },
+    "notes": {
+        "type": "array",
+        "items": {"type": "string"},
+        "description": "Short comments for a beginner in Russian (Cyrillic), plain text.",
+    },
+})
+
+
+def _number(value) -> Optional[float]:
+    """Число из JSON: int/float (не bool), конечное и > 0; строку «65,000» тоже примем. Иначе — ValueError."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"bool instead of number: {value!r}")
+    if isinstance(value, str):
+        parsed = parse_price(value)
+        if parsed is None:
+            raise ValueError(f"not a number: {value!r}")
+        value = parsed
+    if not isinstance(value, (int, float)):
+        raise ValueError(f"not a number: {value!r}")
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"not finite: {value!r}")
+    return value if value > 0 else None
+
+
+def _list(data: dict, key: str) -> list:
+    value = data.get(key)
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError(f"{key}: expected array")
+    return value
+
+
+def plan_from_json(raw: Optional[str]) -> Optional[TradePlan]:
+    """
+    Ответ модели в режиме structured output → TradePlan.
+    None, если это не JSON-объект или поля не того типа — тогда вызывающий откатывается
+    на extract_trade_plan по тексту.
+    """
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+        if not isinstance(data, dict):
+            return None
+        analysis = data.get("analysis") or ""
+        if not isinstance(analysis, str):
+            return None
+        bias = data.get("bias")
+        if bias is not None and (not isinstance(bias, str) or bias.upper() not in _BIAS_SIDE):
+            return None
+        symbol = data.get("symbol")
+        if symbol is not None and not isinstance(symbol, str):
+            return None
+        dca = []
+        for step in _list(data, "dca"):
+            if not isinstance(step, dict):
+                return None
+            price, alloc = _number(step.get("price")), _number(step.get("alloc_pct"))
+            if price is not None and alloc is not None:
+                dca.append(DcaStep(price=price, alloc_pct=alloc))
+        return TradePlan(
+            entry=_number(data.get("entry")),
+            stop=_number(data.get("stop")),
+            take_profits=[v for v in map(_number, _list(data, "take_profits")) if v is not None],
+            bias=bias.upper() if bias else None,
+            dca=dca,
+            avg_entry=_number(data.get("avg_entry")),
+            notes=[str(n).strip() for n in _list(data, "notes") if str(n).strip()],
+            analysis=analysis.strip(),
+            symbol=(symbol or "").strip() or None,
+        )
+    except (ValueError, TypeError):
+        return None